@@ -0,0 +1,248 @@
+"""قياس المسارات الحرجة المرتبطة بقاعدة البيانات كلٌّ على حدة، على قواعد اصطناعية من gen_dataset
+
+العمليات: upsert الخاص بـ /start عبر التثبيت الجماعي، تمرير احتساب الإحالات المعلقة، استعلامات
+العشرة/الخمسين الأوائل (SQL وفي الذاكرة)، تحميل الترتيب، بدء مسابقة (فترة جديدة)، اختيار الفائزين،
+التصدير والاستيراد. كل عملية تعمل على نسخة جديدة من القاعدة، والنسخ خارج الزمن المقاس.
+
+التشغيل:
+    python benchmarks/bench_db.py --users 10000 100000 --json results.json
+    python benchmarks/bench_db.py --users 100000 --compare results.json   # رمز خروج 1 عند تراجع الأداء
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.dirname(__file__))
+import gen_dataset  # noqa: E402  (يضبط البيئة ويستورد البوت)
+from gen_dataset import er  # noqa: E402
+
+logging.getLogger(er.__name__).setLevel(logging.WARNING)
+
+WORK_DIR = tempfile.mkdtemp(prefix="elite-bench-")
+START_WRITES = 5000  # عدد رسائل /start المتزامنة في قياس upsert
+
+
+def fresh_copy(dataset):
+    work = os.path.join(WORK_DIR, "work.db")
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(work + suffix):
+            os.remove(work + suffix)
+    shutil.copyfile(dataset, work)
+    return work
+
+
+# كل عملية: setup(database, dataset) خارج القياس يعيد الوسائط، ثم run(database, *args) يعيد عدد الصفوف
+async def setup_start(database, dataset):
+    count = database.writer.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+    now = datetime.now(timezone.utc).isoformat()
+    # نصفها مستخدمون عائدون (تحديث) ونصفها جدد (إدراج)
+    return [[(gen_dataset.USER_BASE + (i * 7919) % count if i % 2 else gen_dataset.USER_BASE + count + i,
+              f"user{i}", f"مستخدم {i}", now) for i in range(START_WRITES)]]
+
+
+async def run_start(database, rows):
+    await asyncio.gather(*(database.write(er.UPSERT_USER_SQL, params) for params in rows))
+    return len(rows)
+
+
+async def setup_credit(database, dataset):
+    pending = database.writer.execute("SELECT new_user FROM referrals WHERE counted = 0").fetchall()
+    return [[new_user for new_user, in pending]]
+
+
+async def run_credit(database, new_users):
+    await database.transaction(er._credit_referrals_tx, new_users, gen_dataset.POINTS)
+    return len(new_users)
+
+
+def top_sql(k):
+    async def run(database):
+        rows = await database.read(lambda connection: connection.execute("""
+            SELECT s.user_id, u.username, u.first_name, s.points
+            FROM contest_scores s JOIN users u ON u.user_id = s.user_id
+            WHERE s.contest_id = ? AND s.points > 0
+            ORDER BY s.points DESC, s.user_id
+            LIMIT ?
+        """, (er._score_period(connection), k)).fetchall())
+        return len(rows)
+    return None, run
+
+
+async def setup_memory(database, dataset):
+    board = er.Leaderboard()
+    board.load(database.writer.execute("SELECT s.user_id, u.username, u.first_name, s.points FROM contest_scores s JOIN users u USING (user_id) WHERE s.contest_id = 1").fetchall())
+    return [board]
+
+
+def top_memory(k):
+    async def run(database, board):
+        return len(board.top(k))
+    return setup_memory, run
+
+
+async def run_load(database):
+    rows = await database.transaction(er._leaderboard_rows, 1)
+    er.Leaderboard().load(rows)
+    return len(rows)
+
+
+async def run_contest_start(database):
+    await database.transaction(er._create_contest_tx, datetime.now(timezone.utc) + timedelta(hours=1), 10)
+    return 1
+
+
+async def run_end_contest(database):
+    winners = await database.transaction(er._freeze_contest_tx)
+    return len(winners or ())
+
+
+async def run_export(database):
+    path = os.path.join(WORK_DIR, "export.ndjson.gz")
+    rows, _ = await database.read(er._stream_export, path, True)
+    return rows
+
+
+async def setup_import(database, dataset):
+    path = os.path.join(WORK_DIR, "import.ndjson.gz")
+    await database.read(er._stream_export, path, True)
+    return [path]
+
+
+async def run_import(database, path):
+    counts = await database.transaction(er._stream_import, path)
+    return sum(counts.values())
+
+
+OPERATIONS = {
+    "start_upsert": (setup_start, run_start),
+    "credit_pass": (setup_credit, run_credit),
+    "top10_sql": top_sql(10),
+    "top50_sql": top_sql(50),
+    "top10_memory": top_memory(10),
+    "top50_memory": top_memory(50),
+    "leaderboard_load": (None, run_load),
+    "contest_start": (None, run_contest_start),
+    "end_contest_winners": (None, run_end_contest),
+    "export": (None, run_export),
+    "import": (setup_import, run_import),
+}
+# عمليات قراءة خالصة: تكفيها نسخة واحدة وتُكرر عليها أكثر
+READ_ONLY = {"top10_sql", "top50_sql", "top10_memory", "top50_memory", "leaderboard_load", "export"}
+
+
+async def measure(dataset, name, repeat):
+    setup, run = OPERATIONS[name]
+    times, rows = [], 0
+    database = None
+    for i in range(repeat):
+        if database is None or name not in READ_ONLY:
+            if database:
+                await database.group.flush()
+                database.close()
+            database = er.Database(fresh_copy(dataset), readers=1)
+            args = await setup(database, dataset) if setup else []
+        started = time.perf_counter()
+        rows = await run(database, *args)
+        times.append(time.perf_counter() - started)
+    await database.group.flush()
+    database.close()
+    best = min(times)
+    return {
+        "runs": [round(t, 6) for t in times],
+        "min_s": round(best, 6),
+        "median_s": round(statistics.median(times), 6),
+        "rows": rows,
+        "rows_per_s": round(rows / best, 1) if best and rows else None,
+    }
+
+
+def environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "commit": commit,
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "platform": platform.platform(),
+    }
+
+
+def compare(results, baseline, threshold):
+    """مقارنة min_s بنتائج سابقة؛ يعيد قائمة التراجعات التي تتجاوز العتبة"""
+    regressions = []
+    print(f"\n{'dataset':>9} {'operation':<22}{'before':>11}{'after':>11}{'change':>9}")
+    for users, data in results["datasets"].items():
+        before_ops = baseline.get("datasets", {}).get(users, {}).get("operations", {})
+        for name, after in data["operations"].items():
+            before = before_ops.get(name)
+            if not before:
+                continue
+            change = after["min_s"] / before["min_s"] - 1 if before["min_s"] else 0
+            flag = " ⚠️" if change > threshold else ""
+            print(f"{users:>9} {name:<22}{before['min_s'] * 1000:>9.2f}ms{after['min_s'] * 1000:>9.2f}ms{change:>+8.0%}{flag}")
+            if flag:
+                regressions.append((users, name, change))
+    return regressions
+
+
+async def run_all(args):
+    results = {"environment": environment(), "datasets": {}}
+    names = args.ops or list(OPERATIONS)
+    for users in args.users:
+        started = time.perf_counter()
+        dataset = gen_dataset.ensure(users, args.seed, args.data_dir)
+        print(f"\n📦 {users} مستخدم: {dataset} (جاهزة في {time.perf_counter() - started:.1f} ث)")
+        operations = {}
+        for name in names:
+            repeat = args.repeat * 5 if name in READ_ONLY else args.repeat
+            operations[name] = result = await measure(dataset, name, repeat)
+            rate = f"{result['rows_per_s']:>12,.0f} صف/ث" if result["rows_per_s"] else ""
+            print(f"   {name:<22}{result['min_s'] * 1000:>10.2f} ms  (الوسيط {result['median_s'] * 1000:.2f})  {rate}")
+        results["datasets"][str(users)] = {"size_bytes": os.path.getsize(dataset), "operations": operations}
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="قياس مسارات قاعدة البيانات الحرجة")
+    parser.add_argument("--users", type=int, nargs="+", default=[10_000, 100_000])
+    parser.add_argument("--ops", nargs="+", choices=list(OPERATIONS))
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--data-dir", default=gen_dataset.DATA_DIR)
+    parser.add_argument("--json", help="حفظ النتائج بصيغة JSON")
+    parser.add_argument("--compare", help="ملف JSON سابق للمقارنة")
+    parser.add_argument("--threshold", type=float, default=0.15, help="نسبة التباطؤ التي تُعد تراجعًا")
+    args = parser.parse_args()
+
+    try:
+        results = asyncio.run(run_all(args))
+    finally:
+        shutil.rmtree(WORK_DIR, ignore_errors=True)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        if regressions:
+            print(f"\n❌ {len(regressions)} تراجع في الأداء يتجاوز {args.threshold:.0%}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
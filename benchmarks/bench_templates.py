@@ -0,0 +1,46 @@
+"""قياس كلفة بناء لوحات المفاتيح ونصوص الرسائل لكل تحديث: مع الذاكرة المؤقتة مقابل البناء من الصفر
+
+التشغيل: python benchmarks/bench_templates.py
+"""
+import os
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+os.environ.setdefault("TOKEN", "0:bench")
+os.environ.setdefault("ADMIN_ID", "1")
+os.environ.setdefault("CHANNEL_USERNAME", "@bench")
+os.environ.setdefault("DB_PATH", os.path.join(tempfile.mkdtemp(), "bench.db"))
+
+import elite_referrals as er  # noqa: E402
+
+NUMBER = 20000
+LINK = er.referral_link_for("bench_bot", 123456789)
+
+CASES = {
+    "main_menu_keyboard": (lambda: er.main_menu_keyboard(is_admin=False), lambda: er.main_menu_keyboard.__wrapped__(is_admin=False)),
+    "admin_panel_keyboard": (er.admin_panel_keyboard, er.admin_panel_keyboard.__wrapped__),
+    "contest_status_keyboard": (lambda: er.contest_status_keyboard(True), lambda: er.contest_status_keyboard.__wrapped__(True)),
+    "start_contest_keyboard": (er.start_contest_keyboard, er.start_contest_keyboard.__wrapped__),
+    "referral_keyboard": (lambda: er.referral_keyboard(LINK), lambda: er.referral_keyboard.__wrapped__(LINK)),
+    "profile_keyboard": (lambda: er.profile_keyboard(123456789, LINK), lambda: er.profile_keyboard.__wrapped__(123456789, LINK)),
+    "help_text": (lambda: er.help_text(100, 10), lambda: er.help_text.__wrapped__(100, 10)),
+}
+
+
+def measure(fn):
+    fn()
+    return min(timeit.repeat(fn, number=NUMBER, repeat=5)) / NUMBER * 1e6
+
+
+def main():
+    print(f"{'case':<26}{'uncached µs':>14}{'cached µs':>12}{'speedup':>10}")
+    for name, (cached, uncached) in CASES.items():
+        before, after = measure(uncached), measure(cached)
+        print(f"{name:<26}{before:>14.2f}{after:>12.3f}{before / after:>9.0f}x")
+    er.db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+"""توليد قواعد بيانات elite_referrals.db اصطناعية بأحجام واقعية لقياس المسارات الحرجة
+
+المخطط (الجداول والفهارس والمشغّلات) يؤخذ من البوت نفسه، والبيانات:
+- مستخدمون بأسماء مستخدم لجزء منهم فقط، وجزء صغير لا يستقبل البث
+- إحالات بتوزيع منحرف: قلة من المحيلين الأوائل يجلبون معظم المستخدمين (--skew)
+- متأخرات معلقة: إحالات مستحقة لم تُحتسب بعد (--pending-ratio) لتمرير الاحتساب
+- نقاط الفترة الحالية محسوبة من الإحالات المحتسبة، ومسابقة نشطة
+
+التشغيل:
+    python benchmarks/gen_dataset.py --users 10000 100000 1000000
+"""
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+os.environ.setdefault("TOKEN", "0:bench")
+os.environ.setdefault("ADMIN_ID", "1")
+os.environ.setdefault("CHANNEL_USERNAME", "@bench")
+os.environ.setdefault("DB_PATH", os.path.join(tempfile.mkdtemp(), "schema.db"))
+
+import elite_referrals as er  # noqa: E402
+
+DATA_DIR = os.path.join(tempfile.gettempdir(), "elite-bench")
+USER_BASE = 100_000_000
+POINTS = 100
+DELAY = 10
+
+
+def dataset_path(users, seed=1, data_dir=DATA_DIR):
+    return os.path.join(data_dir, f"elite_{users}_s{seed}.db")
+
+
+def schema():
+    """عبارات إنشاء الجداول، ثم الفهارس والمشغّلات (تُبنى بعد التحميل كما في الاستيراد)"""
+    rows = er.db.writer.execute(
+        "SELECT type, sql FROM sqlite_master WHERE sql IS NOT NULL AND name NOT LIKE 'sqlite_%'"
+    ).fetchall()
+    tables = [sql for kind, sql in rows if kind == "table"]
+    later = [sql for kind, sql in rows if kind in ("index", "trigger")]
+    return tables, later
+
+
+def _users(n, rng, now):
+    for i in range(n):
+        username = f"user{i}" if rng.random() < 0.7 else None
+        last_seen = (now - timedelta(minutes=rng.randrange(60 * 24 * 30))).isoformat()
+        yield USER_BASE + i, username, f"مستخدم {i}", last_seen, 0 if rng.random() < 0.05 else 1
+
+
+def _referrals(n, rng, now, referred_ratio, skew, pending_ratio):
+    # المحيل من المستخدمين الأسبق: rng.random() ** skew يميل نحو أول القائمة (محيلون "نجوم")
+    for i in range(1, n):
+        if rng.random() >= referred_ratio:
+            continue
+        referrer = USER_BASE + int(i * rng.random() ** skew)
+        pending = rng.random() < pending_ratio
+        age = timedelta(minutes=DELAY + 1 + rng.randrange(60)) if pending else timedelta(minutes=rng.randrange(DELAY, 60 * 24 * 30))
+        yield USER_BASE + i, referrer, (now - age).isoformat(), 0 if pending else 1
+
+
+def generate(path, users, seed=1, referred_ratio=0.6, skew=3.0, pending_ratio=0.02):
+    """إنشاء قاعدة جديدة في path؛ يعيد عدد الصفوف لكل جدول"""
+    rng = random.Random(seed)
+    now = datetime.now(timezone.utc)
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+    tables, later = schema()
+    connection = sqlite3.connect(path)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=OFF")
+    for sql in tables:
+        connection.execute(sql)
+    with connection:
+        connection.executemany(
+            "INSERT INTO users (user_id, username, first_name, last_seen, can_receive_broadcast) VALUES (?, ?, ?, ?, ?)",
+            _users(users, rng, now),
+        )
+        connection.executemany(
+            "INSERT INTO referrals (new_user, referrer, joined_at, counted) VALUES (?, ?, ?, ?)",
+            _referrals(users, rng, now, referred_ratio, skew, pending_ratio),
+        )
+        connection.execute("""
+            INSERT INTO contest_scores (contest_id, user_id, points)
+            SELECT 1, referrer, ? * COUNT(*) FROM referrals WHERE counted = 1 GROUP BY referrer
+        """, (POINTS,))
+        connection.executemany("INSERT INTO settings VALUES (?, ?)", [
+            ("points", POINTS), ("delay", DELAY), ("score_period", 1),
+        ])
+        connection.execute(
+            "INSERT INTO contest (id, active, end_time, winners) VALUES (1, 1, ?, 10)",
+            ((now + timedelta(days=7)).isoformat(),)
+        )
+        connection.execute("INSERT INTO change_seq VALUES (1, 0)")
+        for sql in later:
+            connection.execute(sql)
+    counts = {
+        table: connection.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+        for table in ("users", "referrals", "contest_scores")
+    }
+    counts["pending"] = connection.execute("SELECT COUNT(*) FROM referrals WHERE counted = 0").fetchone()[0]
+    connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    connection.execute("ANALYZE")
+    connection.close()
+    return counts
+
+
+def ensure(users, seed=1, data_dir=DATA_DIR, **kwargs):
+    """مسار قاعدة بالحجم المطلوب، مع توليدها إن لم تكن موجودة"""
+    path = dataset_path(users, seed, data_dir)
+    if not os.path.exists(path):
+        generate(path, users, seed, **kwargs)
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description="توليد قواعد بيانات اصطناعية للقياس")
+    parser.add_argument("--users", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    parser.add_argument("--out-dir", default=DATA_DIR)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--referred-ratio", type=float, default=0.6, help="نسبة المستخدمين القادمين بإحالة")
+    parser.add_argument("--skew", type=float, default=3.0, help="انحراف توزيع المحيلين (1 = منتظم)")
+    parser.add_argument("--pending-ratio", type=float, default=0.02, help="نسبة الإحالات المستحقة غير المحتسبة")
+    args = parser.parse_args()
+    for users in args.users:
+        path = dataset_path(users, args.seed, args.out_dir)
+        started = time.perf_counter()
+        counts = generate(path, users, args.seed, args.referred_ratio, args.skew, args.pending_ratio)
+        size = os.path.getsize(path) / 1e6
+        print(f"{path}: {counts} ({size:.1f} MB في {time.perf_counter() - started:.1f} ث)")
+
+
+if __name__ == "__main__":
+    main()
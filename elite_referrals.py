@@ -2,18 +2,36 @@ import sqlite3
 import logging
 import asyncio
 import json
+import gzip
+import tempfile
+import shutil
 import os
 import re
 import html
+import time
+import threading
+import heapq
+import bisect
+import itertools
+import secrets
+from collections import OrderedDict
+from functools import lru_cache
+import httpx
+from sortedcontainers import SortedList
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 from datetime import datetime, timedelta, timezone
 from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardMarkup, KeyboardButton
+from telegram.error import RetryAfter, Forbidden, BadRequest, NetworkError
+from telegram.request import HTTPXRequest
 from telegram.ext import (
     ApplicationBuilder,
+    BaseUpdateProcessor,
     CommandHandler,
     MessageHandler,
     ContextTypes,
     CallbackQueryHandler,
+    ChatMemberHandler,
     filters,
 )
 
@@ -34,9 +52,82 @@ if not all([TOKEN, ADMIN_ID, CHANNEL_USERNAME]):
 if not CHANNEL_USERNAME.startswith("@"):
     CHANNEL_USERNAME = f"@{CHANNEL_USERNAME}"
 
+DB_PATH = os.getenv("DB_PATH", "elite_referrals.db")
+DB_READERS = int(os.getenv("DB_READERS", 4))
+# التثبيت الجماعي: تُجمع كتابات /start وتُثبَّت في معاملة واحدة كل بضع ميلي ثوانٍ أو عند امتلاء الدفعة
+GROUP_COMMIT_INTERVAL = float(os.getenv("GROUP_COMMIT_INTERVAL", 0.005))
+GROUP_COMMIT_MAX_ROWS = int(os.getenv("GROUP_COMMIT_MAX_ROWS", 500))
+
 DEFAULT_POINTS = 100
 DEFAULT_DELAY = 10
-BROADCAST_LIMIT = 20
+
+# حدود تيليجرام: ~30 رسالة/ثانية عامة، ورسالة واحدة/ثانية لكل محادثة
+GLOBAL_RATE_LIMIT = float(os.getenv("GLOBAL_RATE_LIMIT", 25))
+PER_CHAT_RATE_LIMIT = float(os.getenv("PER_CHAT_RATE_LIMIT", 1))
+BROADCAST_WORKERS = int(os.getenv("BROADCAST_WORKERS", 16))
+BROADCAST_MAX_RETRIES = 3
+BROADCAST_STOP_TIMEOUT = 10  # ثوانٍ لإنهاء الرسائل الجارية عند الإغلاق قبل إلغاء عمال البث
+MEMBERSHIP_CONCURRENCY = int(os.getenv("MEMBERSHIP_CONCURRENCY", 10))
+REFERRAL_RECHECK_INTERVAL = 60  # ثوانٍ قبل إعادة فحص إحالة لمستخدم غادر القناة
+SCHEDULER_BATCH_WINDOW = 1.0  # تجميع المواعيد المتقاربة في دفعة واحدة (ثوانٍ)
+BROADCAST_BATCH = 100  # عدد المستلمين المحجوزين من جدول المهمة في كل حجز (يُعاد الملء قبل نفاد الطابور)
+EXPORT_CHUNK = 1000  # عدد الصفوف المقروءة في كل دفعة أثناء التصدير
+IMPORT_BATCH = 5000  # عدد الصفوف في كل executemany أثناء الاستيراد
+
+# لقطات قاعدة البيانات الثنائية (backup API)
+SNAPSHOT_DIR = os.getenv("SNAPSHOT_DIR", "snapshots")
+SNAPSHOT_INTERVAL_HOURS = float(os.getenv("SNAPSHOT_INTERVAL_HOURS", 24))  # 0 لتعطيل اللقطات المجدولة
+SNAPSHOT_KEEP = int(os.getenv("SNAPSHOT_KEEP", 7))
+SNAPSHOT_COMPRESS = os.getenv("SNAPSHOT_COMPRESS", "1") == "1"
+SNAPSHOT_PAGES = 256  # صفحات تُنسخ في كل خطوة قبل إفساح المجال للكتّاب
+
+KEYBOARD_CACHE_SIZE = 10000  # لوحات مفاتيح الإحالة المحفوظة (واحدة لكل رابط)
+
+# مسودات البث: تُحفظ على الخادم ويحمل الزر معرّفًا قصيرًا فقط
+BROADCAST_DRAFT_TTL = int(os.getenv("BROADCAST_DRAFT_TTL", 3600))
+BROADCAST_DRAFT_MEMORY = 100  # ما زاد عنها يُنقل إلى قاعدة البيانات
+
+# ذاكرة العضوية المؤقتة (بالثواني)
+MEMBERSHIP_CACHE_TTL = int(os.getenv("MEMBERSHIP_CACHE_TTL", 300))
+MEMBERSHIP_CACHE_NEGATIVE_TTL = int(os.getenv("MEMBERSHIP_CACHE_NEGATIVE_TTL", 60))
+MEMBERSHIP_CACHE_SIZE = int(os.getenv("MEMBERSHIP_CACHE_SIZE", 50000))
+
+LEADERBOARD_DEPTH = 50  # أعمق ترتيب يُعرض؛ التغييرات تحته لا تُبطل النصوص المخزنة
+
+# نقطة المقاييس (صيغة Prometheus النصية) على /metrics؛ معطلة افتراضيًا (0)، مثلاً METRICS_PORT=9464
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", 0))
+
+# معالجة التحديثات بالتوازي: حد المعالجات المتزامنة، مع تسلسل تحديثات المستخدم الواحد (1 = معالجة تسلسلية)
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", 32))
+# كم تحديثًا يُقبل لكل خانة معالجة (ينتظر في طابور مستخدمه) قبل أن يتوقف جلب التحديثات الجديدة
+UPDATE_QUEUE_FACTOR = int(os.getenv("UPDATE_QUEUE_FACTOR", 16))
+# اتصالات HTTP المتزامنة مع Bot API: المعالجات + عمال البث + فحوص العضوية في الخلفية
+TELEGRAM_POOL_SIZE = int(os.getenv(
+    "TELEGRAM_POOL_SIZE", UPDATE_CONCURRENCY + BROADCAST_WORKERS + MEMBERSHIP_CONCURRENCY
+))
+
+# وضع التشغيل: polling (افتراضي) أو webhook، ويمكن تجاوزه من سطر الأوامر بـ --webhook / --polling
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # العنوان العام (https) الذي يرسل إليه تيليجرام التحديثات
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", os.getenv("PORT", 8443)))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram").strip("/")
+# يرسله تيليجرام في ترويسة X-Telegram-Bot-Api-Secret-Token؛ يُولَّد عشوائيًا عند كل تشغيل إن لم يُحدد
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or secrets.token_urlsafe(32)
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", 40))
+BOT_API_BASE_URL = os.getenv("BOT_API_BASE_URL")  # خادم Bot API بديل (محلي أو وهمي للاختبار)
+
+if BOT_MODE not in ("polling", "webhook"):
+    raise ValueError("❌ BOT_MODE يجب أن يكون polling أو webhook")
+if not re.fullmatch(r"[A-Za-z0-9_-]{1,256}", WEBHOOK_SECRET):
+    raise ValueError("❌ WEBHOOK_SECRET يقبل الأحرف A-Z و a-z و 0-9 و _ و - فقط (حتى 256 حرفًا)")
+if not 1 <= WEBHOOK_MAX_CONNECTIONS <= 100:
+    raise ValueError("❌ WEBHOOK_MAX_CONNECTIONS يجب أن يكون بين 1 و 100")
+if UPDATE_CONCURRENCY < 1:
+    raise ValueError("❌ UPDATE_CONCURRENCY يجب أن يكون 1 أو أكثر")
+if UPDATE_QUEUE_FACTOR < 1:
+    raise ValueError("❌ UPDATE_QUEUE_FACTOR يجب أن يكون 1 أو أكثر")
 # ==========================================
 
 logging.basicConfig(
@@ -45,9 +136,397 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# ================= METRICS =================
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+def _label_value(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+class Metric:
+    """مقياس بتسميات: القيم محفوظة حسب صف قيم التسميات (تُحدَّث من حلقة الأحداث فقط، فلا أقفال)"""
+    kind = "untyped"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+
+    def _labels(self, values, extra=""):
+        pairs = [f'{name}="{_label_value(value)}"' for name, value in zip(self.labelnames, values)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def samples(self):
+        for labels, value in self._values.items():
+            yield f"{self.name}{self._labels(labels)} {value}"
+
+    def render(self):
+        return "\n".join([f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}", *self.samples()])
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *labels, amount=1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+class Gauge(Metric):
+    """قيمة لحظية؛ مع fn تُحسب عند كل قراءة بدل تحديثها من الكود"""
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labelnames=(), fn=None):
+        super().__init__(name, documentation, labelnames)
+        self.fn = fn
+
+    def set(self, value, *labels):
+        self._values[labels] = value
+
+    def samples(self):
+        if self.fn is not None:
+            yield f"{self.name} {self.fn()}"
+        yield from super().samples()
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        entry = self._values.get(labels)
+        if entry is None:
+            # [عدادات الحاويات (غير تراكمية)، المجموع، العدد]
+            entry = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+        entry[2] += 1
+
+    def samples(self):
+        for labels, (counts, total, count) in self._values.items():
+            cumulative = 0
+            for bound, n in zip((*self.buckets, "+Inf"), counts):
+                cumulative += n
+                le = 'le="%s"' % bound
+                yield f"{self.name}_bucket{self._labels(labels, le)} {cumulative}"
+            yield f"{self.name}_sum{self._labels(labels)} {total}"
+            yield f"{self.name}_count{self._labels(labels)} {count}"
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+
+    def _register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=(), fn=None):
+        return self._register(Gauge(name, documentation, labelnames, fn))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self):
+        return "\n".join(metric.render() for metric in self._metrics) + "\n"
+
+metrics = MetricsRegistry()
+HANDLER_SECONDS = metrics.histogram("elite_handler_seconds", "Update handler latency", ["handler"])
+HANDLER_ERRORS = metrics.counter("elite_handler_errors_total", "Update handlers that raised", ["handler"])
+CALLBACK_SECONDS = metrics.histogram("elite_callback_seconds", "Callback route latency", ["route"])
+DB_SECONDS = metrics.histogram("elite_db_seconds", "DB operation latency including thread-pool wait", ["op"])
+DB_ERRORS = metrics.counter("elite_db_errors_total", "DB operations that raised", ["op"])
+TELEGRAM_SECONDS = metrics.histogram("elite_telegram_seconds", "Bot API request latency", ["method"])
+TELEGRAM_ERRORS = metrics.counter("elite_telegram_errors_total", "Bot API error responses", ["method", "code"])
+TELEGRAM_RETRY_AFTER = metrics.counter("elite_telegram_retry_after_total", "Bot API 429 responses", ["method"])
+TELEGRAM_RETRY_AFTER_SECONDS = metrics.counter("elite_telegram_retry_after_seconds_total", "Sum of retry_after in 429 responses", ["method"])
+BROADCAST_MESSAGES = metrics.counter("elite_broadcast_messages_total", "Broadcast deliveries by result", ["result"])
+SWEEP_SECONDS = metrics.histogram("elite_background_sweep_seconds", "Due-referral sweep duration")
+SWEEP_ERRORS = metrics.counter("elite_background_sweep_errors_total", "Due-referral sweeps that raised")
+REFERRALS_CREDITED = metrics.counter("elite_referrals_credited_total", "Referrals credited to referrers")
+UPDATES_IN_PROGRESS = metrics.gauge("elite_updates_in_progress", "Updates being handled right now")
+# تُقرأ عند كل طلب للمقاييس، فلا حاجة لتحديثها من الكود
+metrics.gauge("elite_referral_backlog", "Referrals waiting in the maturity schedule", fn=lambda: len(scheduler))
+metrics.gauge("elite_broadcast_rate_limit", "Current adaptive global send rate (msg/s)", fn=lambda: telegram_limiter.global_bucket.rate)
+metrics.gauge("elite_leaderboard_size", "Users with points in the current period", fn=lambda: len(leaderboard))
+
+def timed_handler(name, callback):
+    """تغليف معالج تحديثات لتسجيل زمنه وأخطائه"""
+    async def wrapper(update, context):
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except Exception:
+            HANDLER_ERRORS.inc(name)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - started, name)
+    return wrapper
+
+class InstrumentedRequest(HTTPXRequest):
+    """طلبات Bot API مع تسجيل الزمن والأخطاء وردود 429 لكل طريقة"""
+
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        api_method = url.rsplit("/", 1)[-1]
+        started = time.perf_counter()
+        try:
+            code, payload = await super().do_request(url, method, request_data, **kwargs)
+        except Exception as e:
+            TELEGRAM_ERRORS.inc(api_method, type(e).__name__)
+            raise
+        finally:
+            TELEGRAM_SECONDS.observe(time.perf_counter() - started, api_method)
+        if code >= 400:
+            TELEGRAM_ERRORS.inc(api_method, str(code))
+            if code == 429:
+                TELEGRAM_RETRY_AFTER.inc(api_method)
+                try:
+                    retry_after = json.loads(payload)["parameters"]["retry_after"]
+                    TELEGRAM_RETRY_AFTER_SECONDS.inc(api_method, amount=retry_after)
+                except (ValueError, KeyError, TypeError):
+                    pass
+        return code, payload
+
+metrics_server = None
+
+async def _serve_metrics(reader, writer):
+    try:
+        request_line = await reader.readline()
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass
+        parts = request_line.decode("latin-1").split()
+        if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+            status, body = "200 OK", metrics.render().encode()
+        else:
+            status, body = "404 Not Found", b"not found\n"
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+async def start_metrics_server():
+    global metrics_server
+    if not METRICS_PORT:
+        return
+    try:
+        metrics_server = await asyncio.start_server(_serve_metrics, METRICS_HOST, METRICS_PORT)
+    except OSError as e:
+        # المنفذ مشغول أو العنوان غير صالح: البوت يعمل بدون مقاييس بدل أن يفشل التشغيل
+        logger.warning(f"تعذر تشغيل نقطة المقاييس على {METRICS_HOST}:{METRICS_PORT}: {e}")
+        return
+    logger.info(f"📈 المقاييس متاحة على http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+
 # ================= DATABASE =================
-conn = sqlite3.connect("elite_referrals.db", check_same_thread=False)
-cursor = conn.cursor()
+class Database:
+    """طبقة وصول غير متزامنة: اتصال كتابة واحد في خيط مخصص واتصالات قراءة في مجمع خيوط (وضع WAL)"""
+
+    def __init__(self, path, readers=DB_READERS):
+        self.path = path
+        self._writer_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer")
+        self._reader_pool = ThreadPoolExecutor(max_workers=readers, thread_name_prefix="db-reader")
+        self._local = threading.local()
+        self._readers = []
+        self._readers_lock = threading.Lock()
+        self.writer = self._connect()
+        self.group = GroupCommitWriter(self)
+
+    def _connect(self, readonly=False):
+        connection = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+        connection.execute("PRAGMA journal_mode=WAL")
+        # NORMAL آمن مع WAL: قد تضيع آخر معاملة عند انقطاع الكهرباء لكن لا تتلف القاعدة
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.execute("PRAGMA cache_size=-16000")
+        connection.execute("PRAGMA mmap_size=268435456")
+        connection.execute("PRAGMA temp_store=MEMORY")
+        if readonly:
+            connection.execute("PRAGMA query_only=1")
+        return connection
+
+    def _reader(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = self._local.connection = self._connect(readonly=True)
+            with self._readers_lock:
+                self._readers.append(connection)
+        return connection
+
+    async def _submit(self, pool, fn, *args, name="query"):
+        # الزمن المسجل يشمل الانتظار في طابور الخيط: هو ما يدفعه المعالج فعلًا
+        started = time.perf_counter()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(pool, fn, *args)
+        except Exception:
+            DB_ERRORS.inc(name)
+            raise
+        finally:
+            DB_SECONDS.observe(time.perf_counter() - started, name)
+
+    async def fetchone(self, sql, params=()):
+        return await self._submit(self._reader_pool, lambda: self._reader().execute(sql, params).fetchone(), name="fetchone")
+
+    async def fetchall(self, sql, params=()):
+        return await self._submit(self._reader_pool, lambda: self._reader().execute(sql, params).fetchall(), name="fetchall")
+
+    async def read(self, fn, *args):
+        """تنفيذ fn(connection, *args) على اتصال قراءة (لعمليات القراءة متعددة الخطوات)"""
+        return await self._submit(self._reader_pool, lambda: fn(self._reader(), *args), name=f"read:{fn.__name__}")
+
+    async def execute(self, sql, params=()):
+        """تنفيذ عبارة كتابة واحدة وتثبيتها؛ يعيد المؤشر (rowcount / lastrowid)"""
+        def op():
+            result = self.writer.execute(sql, params)
+            self.writer.commit()
+            return result
+        return await self._submit(self._writer_pool, op, name="execute")
+
+    async def executemany(self, sql, seq_of_params):
+        def op():
+            result = self.writer.executemany(sql, seq_of_params)
+            self.writer.commit()
+            return result
+        return await self._submit(self._writer_pool, op, name="executemany")
+
+    async def transaction(self, fn, *args):
+        """تنفيذ fn(connection, *args) في معاملة واحدة على اتصال الكتابة مع التراجع عند الخطأ"""
+        def op():
+            try:
+                result = fn(self.writer, *args)
+                self.writer.commit()
+                return result
+            except Exception:
+                self.writer.rollback()
+                raise
+        return await self._submit(self._writer_pool, op, name=f"transaction:{fn.__name__}")
+
+    async def write(self, sql, params=()):
+        """كتابة عبر التثبيت الجماعي؛ تعود بعد تثبيت الدفعة التي تحتويها (rowcount)"""
+        return await self.group.submit(sql, params)
+
+    def write_nowait(self, sql, params=()):
+        """كتابة عبر التثبيت الجماعي دون انتظار التثبيت (لما لا يحتاج المعالج نتيجته)"""
+        self.group.submit(sql, params).add_done_callback(self.group.log_failure)
+
+    def _snapshot(self, path, pages):
+        source = sqlite3.connect(self.path, timeout=30)
+        target = sqlite3.connect(path)
+        try:
+            # معاملة قراءة مفتوحة تثبّت اللقطة: كتابات البوت أثناء النسخ لا تعيد تشغيله ولا تدخل فيه
+            source.execute("BEGIN")
+            source.execute("SELECT 1 FROM sqlite_master LIMIT 1").fetchall()
+            source.backup(target, pages=pages, sleep=0.005)
+            source.execute("COMMIT")
+        finally:
+            target.close()
+            source.close()
+
+    async def snapshot(self, path, pages=SNAPSHOT_PAGES):
+        """لقطة ثنائية متسقة عبر backup API على خطوات صغيرة في خيط مستقل (دون حجز اتصال الكتابة)"""
+        await asyncio.to_thread(self._snapshot, path, pages)
+
+    def close(self):
+        self._writer_pool.shutdown(wait=True)
+        self._reader_pool.shutdown(wait=True)
+        with self._readers_lock:
+            for connection in self._readers:
+                connection.close()
+            self._readers.clear()
+        self.writer.close()
+
+class GroupCommitWriter:
+    """يجمع عبارات الكتابة من المعالجات المتزامنة ويثبتها في معاملة واحدة بدل commit لكل رسالة"""
+
+    def __init__(self, database, interval=GROUP_COMMIT_INTERVAL, max_rows=GROUP_COMMIT_MAX_ROWS):
+        self.database = database
+        self.interval = interval
+        self.max_rows = max_rows
+        self._pending = []
+        self._has_work = asyncio.Event()
+        self._full = asyncio.Event()
+        self._task = None
+
+    def submit(self, sql, params=()):
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((sql, params, future))
+        if len(self._pending) >= self.max_rows:
+            self._full.set()
+        self._has_work.set()
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        return future
+
+    @staticmethod
+    def log_failure(future):
+        if not future.cancelled() and future.exception():
+            logger.error(f"فشل كتابة مجمّعة: {future.exception()}")
+
+    def _commit_batch(self, batch):
+        # كل عبارة مستقلة: فشل واحدة لا يُسقط بقية الدفعة
+        connection = self.database.writer
+        results = []
+        try:
+            for sql, params, _ in batch:
+                try:
+                    results.append(connection.execute(sql, params).rowcount)
+                except sqlite3.Error as e:
+                    results.append(e)
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+        return results
+
+    async def _flush(self):
+        batch, self._pending = self._pending[:self.max_rows], self._pending[self.max_rows:]
+        if len(self._pending) < self.max_rows:
+            self._full.clear()
+        if not self._pending:
+            self._has_work.clear()
+        try:
+            results = await self.database._submit(self.database._writer_pool, self._commit_batch, batch, name="group_commit")
+        except Exception as e:
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, _, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    async def _run(self):
+        while True:
+            await self._has_work.wait()
+            try:
+                await asyncio.wait_for(self._full.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            await self._flush()
+
+    async def flush(self):
+        """تثبيت كل ما في الطابور فورًا (يُستدعى عند الإغلاق)"""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        while self._pending:
+            await self._flush()
+
+db = Database(DB_PATH)
+cursor = db.writer.cursor()
 
 cursor.execute("""
 CREATE TABLE IF NOT EXISTS users (
@@ -85,31 +564,255 @@ CREATE TABLE IF NOT EXISTS contest (
 )
 """)
 
-cursor.execute("CREATE INDEX IF NOT EXISTS idx_referrals_counted ON referrals(counted, joined_at)")
-cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_points ON users(points DESC)")
-cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_broadcast ON users(can_receive_broadcast)")
+cursor.execute("""
+CREATE TABLE IF NOT EXISTS broadcast_jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    message TEXT,
+    status TEXT DEFAULT 'running',
+    created_at TEXT,
+    finished_at TEXT,
+    chat_id INTEGER,
+    status_message_id INTEGER,
+    payload TEXT
+)
+""")
+if "payload" not in [row[1] for row in cursor.execute("PRAGMA table_info(broadcast_jobs)")]:
+    cursor.execute("ALTER TABLE broadcast_jobs ADD COLUMN payload TEXT")
+
+cursor.execute("""
+CREATE TABLE IF NOT EXISTS broadcast_drafts (
+    id TEXT PRIMARY KEY,
+    payload TEXT,
+    expires_at REAL
+)
+""")
+
+# حالة كل مستلم: pending → sending → sent / failed / blocked
+# (unknown: كان قيد الإرسال عند توقف البوت، فلا يُعاد إرساله تفاديًا للتكرار)
+cursor.execute("""
+CREATE TABLE IF NOT EXISTS broadcast_recipients (
+    job_id INTEGER,
+    user_id INTEGER,
+    status TEXT DEFAULT 'pending',
+    PRIMARY KEY (job_id, user_id)
+) WITHOUT ROWID
+""")
+
+# نقاط كل فترة (مسابقة) على حدة: بدء مسابقة أو التصفير يفتح فترة جديدة بدل إعادة كتابة جدول المستخدمين،
+# والفترات السابقة تبقى قابلة للاستعلام. الفترة الحالية في الإعداد score_period
+# (عمود users.points قديم ولم يعد يُكتب بعد الترحيل)
+cursor.execute("""
+CREATE TABLE IF NOT EXISTS contest_scores (
+    contest_id INTEGER,
+    user_id INTEGER,
+    points INTEGER DEFAULT 0,
+    PRIMARY KEY (contest_id, user_id)
+) WITHOUT ROWID
+""")
+
+# فهارس الجداول التي يعيد الاستيراد تحميلها (تُحذف قبل التحميل الجماعي وتُبنى بعده)
+DATA_INDEXES = {
+    "idx_referrals_counted": "CREATE INDEX IF NOT EXISTS idx_referrals_counted ON referrals(counted, joined_at)",
+    "idx_contest_scores_rank": "CREATE INDEX IF NOT EXISTS idx_contest_scores_rank ON contest_scores(contest_id, points DESC, user_id)",
+    "idx_users_broadcast": "CREATE INDEX IF NOT EXISTS idx_users_broadcast ON users(can_receive_broadcast)",
+}
+
+# تتبع التغييرات للنسخ التفاضلية: عداد عام، وكل إدراج/تعديل يختم الصف بالقيمة التالية في عمود seq
+# (الصفوف المستوردة دفعة واحدة تبقى seq=0 أي جزءًا من النسخة الأساسية)
+cursor.execute("CREATE TABLE IF NOT EXISTS change_seq (id INTEGER PRIMARY KEY CHECK (id = 1), value INTEGER)")
+cursor.execute("INSERT OR IGNORE INTO change_seq VALUES (1, 0)")
+
+# الجدول ← (شرط تحديد الصف، الأعمدة التي يُعد تعديلها تغييرًا)
+CHANGE_TRACKED = {
+    "users": ("user_id = NEW.user_id", "username, first_name, last_seen, can_receive_broadcast"),
+    "referrals": ("new_user = NEW.new_user", "referrer, joined_at, counted"),
+    "contest_scores": ("contest_id = NEW.contest_id AND user_id = NEW.user_id", "points"),
+}
+CHANGE_TRIGGERS = {}
+for table, (match, columns) in CHANGE_TRACKED.items():
+    stamp = f"UPDATE change_seq SET value = value + 1; UPDATE {table} SET seq = (SELECT value FROM change_seq) WHERE {match};"
+    CHANGE_TRIGGERS[f"trg_{table}_seq_insert"] = f"CREATE TRIGGER IF NOT EXISTS trg_{table}_seq_insert AFTER INSERT ON {table} BEGIN {stamp} END"
+    CHANGE_TRIGGERS[f"trg_{table}_seq_update"] = f"CREATE TRIGGER IF NOT EXISTS trg_{table}_seq_update AFTER UPDATE OF {columns} ON {table} BEGIN {stamp} END"
+    if "seq" not in [row[1] for row in cursor.execute(f"PRAGMA table_info({table})")]:
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN seq INTEGER DEFAULT 0")
+    DATA_INDEXES[f"idx_{table}_seq"] = f"CREATE INDEX IF NOT EXISTS idx_{table}_seq ON {table}(seq)"
+
+cursor.execute("CREATE INDEX IF NOT EXISTS idx_broadcast_recipients_status ON broadcast_recipients(job_id, status)")
+for index_sql in DATA_INDEXES.values():
+    cursor.execute(index_sql)
+for trigger_sql in CHANGE_TRIGGERS.values():
+    cursor.execute(trigger_sql)
+cursor.execute("DROP INDEX IF EXISTS idx_users_points")
 
 cursor.execute("INSERT OR IGNORE INTO settings VALUES ('points', ?)", (DEFAULT_POINTS,))
 cursor.execute("INSERT OR IGNORE INTO settings VALUES ('delay', ?)", (DEFAULT_DELAY,))
-conn.commit()
+# ترحيل لمرة واحدة: أرصدة users.points الحالية تصبح الفترة الأولى
+if cursor.execute("INSERT OR IGNORE INTO settings VALUES ('score_period', 1)").rowcount:
+    cursor.execute("INSERT OR IGNORE INTO contest_scores (contest_id, user_id, points) SELECT 1, user_id, points FROM users WHERE points > 0")
+db.writer.commit()
+cursor.close()
 
 # ================= SETTINGS =================
+# نسخة في الذاكرة من جدول الإعدادات: القراءة لا تلمس قاعدة البيانات، والكتابة تمر عبرها
+settings_cache = {}
+
+async def load_settings():
+    """تحميل جدول الإعدادات إلى الذاكرة (عند التشغيل وبعد الاستيراد)"""
+    rows = await db.fetchall("SELECT key, value FROM settings")
+    settings_cache.clear()
+    settings_cache.update(rows)
+
 def get_setting(key):
-    cursor.execute("SELECT value FROM settings WHERE key=?", (key,))
-    result = cursor.fetchone()
-    return int(result[0]) if result else (DEFAULT_POINTS if key == "points" else DEFAULT_DELAY)
+    value = settings_cache.get(key)
+    return int(value) if value is not None else (DEFAULT_POINTS if key == "points" else DEFAULT_DELAY)
+
+async def set_setting(key, value):
+    await db.execute("""
+        INSERT INTO settings (key, value) VALUES (?, ?)
+        ON CONFLICT(key) DO UPDATE SET value=excluded.value
+    """, (key, value))
+    settings_cache[key] = value
+
+def _score_period(connection):
+    return int(connection.execute("SELECT value FROM settings WHERE key='score_period'").fetchone()[0])
+
+def _open_score_period_tx(connection):
+    """فتح فترة نقاط جديدة: تعديل صف واحد بدل تصفير كل المستخدمين"""
+    connection.execute("UPDATE settings SET value = CAST(value AS INTEGER) + 1 WHERE key='score_period'")
+    return _score_period(connection)
+
+async def open_score_period():
+    period = await db.transaction(_open_score_period_tx)
+    settings_cache["score_period"] = period
+    leaderboard.reset()
+    return period
+
+# ================= SNAPSHOTS =================
+def _compress_file(path):
+    with open(path, "rb") as source, gzip.open(path + ".gz", "wb", compresslevel=6) as target:
+        shutil.copyfileobj(source, target, 1 << 20)
+    os.remove(path)
+    return path + ".gz"
+
+def _prune_snapshots(keep):
+    snapshots = sorted(
+        name for name in os.listdir(SNAPSHOT_DIR)
+        if name.startswith("snapshot_") and name.endswith((".db", ".db.gz"))
+    )
+    stale = snapshots[:-keep] if keep > 0 else []
+    for name in stale:
+        os.remove(os.path.join(SNAPSHOT_DIR, name))
+    return len(stale)
+
+async def take_snapshot(compress=SNAPSHOT_COMPRESS):
+    """أخذ لقطة في SNAPSHOT_DIR مع تطبيق سياسة الاحتفاظ؛ يعيد (المسار، الحجم، المدة)"""
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+    path = os.path.join(SNAPSHOT_DIR, f"snapshot_{datetime.now(timezone.utc).strftime('%Y%m%d_%H%M%S')}.db")
+    started = time.monotonic()
+    await db.snapshot(path + ".tmp")
+    os.replace(path + ".tmp", path)
+    if compress:
+        path = await asyncio.to_thread(_compress_file, path)
+    pruned = await asyncio.to_thread(_prune_snapshots, SNAPSHOT_KEEP)
+    elapsed = time.monotonic() - started
+    size = os.path.getsize(path)
+    logger.info(f"لقطة قاعدة البيانات: {path} ({size / 1048576:.1f} MB في {elapsed:.1f} ث، حُذفت {pruned} قديمة)")
+    return path, size, elapsed
+
+def _last_snapshot_time():
+    if not os.path.isdir(SNAPSHOT_DIR):
+        return None
+    times = [
+        os.path.getmtime(os.path.join(SNAPSHOT_DIR, name))
+        for name in os.listdir(SNAPSHOT_DIR)
+        if name.startswith("snapshot_") and name.endswith((".db", ".db.gz"))
+    ]
+    return max(times, default=None)
+
+snapshot_task = None
 
-def set_setting(key, value):
-    cursor.execute("UPDATE settings SET value=? WHERE key=?", (value, key))
-    conn.commit()
+async def snapshot_loop():
+    """لقطات مجدولة كل SNAPSHOT_INTERVAL_HOURS؛ الموعد يُحسب من آخر لقطة موجودة فلا تتكرر عند إعادة التشغيل"""
+    interval = SNAPSHOT_INTERVAL_HOURS * 3600
+    while True:
+        last = _last_snapshot_time()
+        delay = max(0, last + interval - time.time()) if last else 0
+        await asyncio.sleep(delay)
+        try:
+            await take_snapshot()
+        except Exception as e:
+            logger.error(f"فشل أخذ لقطة قاعدة البيانات: {e}")
+            await asyncio.sleep(min(interval, 3600))
 
 # ================= SECURITY =================
+class MembershipCache:
+    """ذاكرة LRU لنتائج العضوية بمدة صلاحية منفصلة للنتائج الإيجابية والسلبية"""
+
+    def __init__(self, ttl, negative_ttl, maxsize):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def get(self, user_id):
+        """يعيد True/False من الذاكرة أو None إن لم تكن النتيجة موجودة أو انتهت صلاحيتها"""
+        entry = self._entries.get(user_id)
+        if entry is not None:
+            is_member, expires_at = entry
+            if time.monotonic() < expires_at:
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                return is_member
+            del self._entries[user_id]
+        self.misses += 1
+        return None
+
+    def set(self, user_id, is_member):
+        ttl = self.ttl if is_member else self.negative_ttl
+        if ttl <= 0:
+            return
+        self._entries[user_id] = (is_member, time.monotonic() + ttl)
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, user_id=None):
+        """حذف نتيجة مستخدم واحد، أو تفريغ الذاكرة كلها عند عدم تحديده"""
+        if user_id is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(user_id, None)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
+
+membership_cache = MembershipCache(MEMBERSHIP_CACHE_TTL, MEMBERSHIP_CACHE_NEGATIVE_TTL, MEMBERSHIP_CACHE_SIZE)
+
 async def is_valid_member(bot, user_id):
     try:
         if not user_id or user_id < 0:
             return False
+        cached = membership_cache.get(user_id)
+        if cached is not None:
+            return cached
+        await telegram_limiter.acquire()
         member = await bot.get_chat_member(CHANNEL_USERNAME, user_id)
-        return member.status in ["member", "administrator", "creator"]
+        telegram_limiter.on_success()
+        is_member = member.status in ["member", "administrator", "creator"]
+        membership_cache.set(user_id, is_member)
+        return is_member
+    except RetryAfter as e:
+        telegram_limiter.on_flood(retry_after_seconds(e))
+        logger.warning(f"فشل التحقق من العضوية للمستخدم {user_id}: {e}")
+        return False
     except Exception as e:
         logger.warning(f"فشل التحقق من العضوية للمستخدم {user_id}: {e}")
         return False
@@ -125,7 +828,416 @@ def escape_html(text):
 def is_admin(user_id):
     return user_id == ADMIN_ID
 
+# ================= RATE LIMITING =================
+def retry_after_seconds(error):
+    """تحويل قيمة RetryAfter (عدد صحيح أو timedelta) إلى ثوانٍ"""
+    value = error.retry_after
+    return value.total_seconds() if isinstance(value, timedelta) else float(value)
+
+class TokenBucket:
+    """دلو رموز غير متزامن: rate طلب/ثانية مع سعة انفجار capacity"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._refill(now)
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def paused(self):
+        return time.monotonic() < self._paused_until
+
+    def pause(self, seconds):
+        """إيقاف الدلو مؤقتًا (عند RetryAfter) وتفريغ الرموز المتراكمة"""
+        now = time.monotonic()
+        self._paused_until = max(self._paused_until, now + seconds)
+        self._tokens = 0
+        self._updated = self._paused_until
+
+class TelegramRateLimiter:
+    """محدد معدل مشترك لطلبات Bot API: دلو عام + دلو لكل محادثة، مع تراجع تكيفي (AIMD)"""
+
+    def __init__(self, global_rate, per_chat_rate, min_rate=1.0, max_chats=10000):
+        self.max_rate = global_rate
+        self.min_rate = min_rate
+        self.per_chat_rate = per_chat_rate
+        self.max_chats = max_chats
+        self.global_bucket = TokenBucket(global_rate)
+        self._chat_buckets = OrderedDict()
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = TokenBucket(self.per_chat_rate, capacity=1)
+            self._chat_buckets[chat_id] = bucket
+            if len(self._chat_buckets) > self.max_chats:
+                self._chat_buckets.popitem(last=False)
+        else:
+            self._chat_buckets.move_to_end(chat_id)
+        return bucket
+
+    async def acquire(self, chat_id=None):
+        if chat_id is not None:
+            await self._chat_bucket(chat_id).acquire()
+        await self.global_bucket.acquire()
+
+    def on_success(self):
+        """زيادة جمعية بطيئة للمعدل بعد كل طلب ناجح حتى الحد الأقصى"""
+        bucket = self.global_bucket
+        if bucket.rate < self.max_rate:
+            bucket.rate = min(self.max_rate, bucket.rate + 0.05)
+
+    def on_flood(self, retry_after):
+        """تخفيض المعدل للنصف مرة واحدة لكل موجة 429 وإيقاف جميع العمال حتى انتهاء مهلة تيليجرام"""
+        bucket = self.global_bucket
+        if bucket.paused():
+            # ردود الطلبات التي كانت قيد التنفيذ عند الموجة نفسها: نمدد الإيقاف فقط ولا نخفض المعدل مجددًا
+            bucket.pause(retry_after)
+            return
+        bucket.rate = max(self.min_rate, bucket.rate / 2)
+        bucket.pause(retry_after)
+        logger.warning(f"تجاوز حد تيليجرام - إيقاف {retry_after:.1f} ث وخفض المعدل إلى {bucket.rate:.1f}/ث")
+
+telegram_limiter = TelegramRateLimiter(GLOBAL_RATE_LIMIT, PER_CHAT_RATE_LIMIT)
+
+# ================= BROADCAST ENGINE =================
+def is_unreachable_error(error):
+    """هل الخطأ يعني أن المستخدم لن يستقبل الرسائل مجددًا (حظر البوت/حساب محذوف)"""
+    error_msg = str(error).lower()
+    return isinstance(error, Forbidden) or "bot was blocked" in error_msg or "user is deactivated" in error_msg
+
+def never_sent(error):
+    """هل فشل الطلب قبل أن يغادر البوت (اتصال مرفوض/مهلة اتصال/مجمع ممتلئ)؛ عندها فقط تكون إعادة الإرسال آمنة"""
+    return isinstance(error.__cause__, (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout))
+
+class BroadcastEngine:
+    """محرك بث بمجموعة عمال محدودة تتشارك محدد المعدل"""
+
+    def __init__(self, limiter, workers=BROADCAST_WORKERS, max_retries=BROADCAST_MAX_RETRIES):
+        self.limiter = limiter
+        self.workers = workers
+        self.max_retries = max_retries
+
+    async def _deliver(self, send, chat_id):
+        """إرسال رسالة واحدة مع إعادة المحاولة؛ يعيد 'sent' أو 'blocked' أو 'failed' أو 'unknown'"""
+        for attempt in range(self.max_retries + 1):
+            await self.limiter.acquire(chat_id)
+            try:
+                await send(chat_id)
+                self.limiter.on_success()
+                return "sent"
+            except RetryAfter as e:
+                self.limiter.on_flood(retry_after_seconds(e))
+            except Forbidden:
+                return "blocked"
+            except BadRequest as e:
+                logger.warning(f"فشل إرسال البث إلى {chat_id}: {e}")
+                return "blocked" if is_unreachable_error(e) else "failed"
+            except NetworkError as e:
+                # مهلة قراءة أو انقطاع بعد الإرسال: غالبًا قبلها تيليجرام، وإعادة الإرسال تكرر الرسالة
+                if not never_sent(e):
+                    logger.warning(f"نتيجة غير معروفة لإرسال البث إلى {chat_id}: {e}")
+                    return "unknown"
+                await asyncio.sleep(2 ** attempt)
+            except Exception as e:
+                if is_unreachable_error(e):
+                    return "blocked"
+                logger.warning(f"فشل إرسال البث إلى {chat_id}: {e}")
+                return "failed"
+        return "failed"
+
+    async def run(self, chat_ids, send, on_result=None, refill=None, stop=None):
+        """بث إلى chat_ids؛ send(chat_id) ترسل الرسالة، وon_result(chat_id, result) تُستدعى بعد كل محاولة
+
+        refill() (اختيارية) تعيد المستلمين التاليين ([] عند الانتهاء)، وتُستدعى كلما قارب الطابور النفاد
+        فيبقى العمال مشغولين بدل انتظار أبطأ مستلم في كل دفعة.
+        stop (asyncio.Event) يوقف سحب مستلمين جدد مع إكمال الجاري؛ من لم تبدأ محاولته يعود في stats["unstarted"]
+        """
+        queue = asyncio.Queue()
+        for chat_id in chat_ids:
+            queue.put_nowait(chat_id)
+
+        stats = {"total": queue.qsize(), "sent": 0, "failed": 0, "blocked": [], "unstarted": []}
+        refilling = asyncio.Lock()
+        exhausted = refill is None
+
+        async def top_up():
+            nonlocal exhausted
+            async with refilling:
+                if exhausted or queue.qsize() > self.workers:
+                    return
+                more = await refill()
+                exhausted = not more
+                stats["total"] += len(more)
+                for chat_id in more:
+                    queue.put_nowait(chat_id)
+
+        async def worker():
+            while not (stop and stop.is_set()):
+                # لا ينتظر العامل إعادة الملء الجارية ما دام في الطابور ما يرسله
+                if not exhausted and queue.qsize() <= self.workers and (queue.empty() or not refilling.locked()):
+                    await top_up()
+                try:
+                    chat_id = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                result = await self._deliver(send, chat_id)
+                BROADCAST_MESSAGES.inc(result)
+                if on_result:
+                    on_result(chat_id, result)
+                if result == "sent":
+                    stats["sent"] += 1
+                else:
+                    stats["failed"] += 1
+                    if result == "blocked":
+                        stats["blocked"].append(chat_id)
+
+        started = time.monotonic()
+        workers = self.workers if refill else min(self.workers, stats["total"]) or 1
+        await asyncio.gather(*(worker() for _ in range(workers)))
+        while not queue.empty():
+            stats["unstarted"].append(queue.get_nowait())
+        stats["elapsed"] = time.monotonic() - started
+        return stats
+
+broadcast_engine = BroadcastEngine(telegram_limiter)
+
+# ================= BROADCAST JOBS =================
+broadcast_tasks = {}
+broadcast_stop = asyncio.Event()  # يُضبط عند الإغلاق: العمال يكملون الجاري ولا يسحبون مستلمين جددًا
+
+class DraftStore:
+    """مسودات البث قبل التأكيد: ذاكرة LRU صغيرة تفيض إلى SQLite، وكل مسودة تنتهي بعد ttl ثانية"""
+
+    def __init__(self, ttl=BROADCAST_DRAFT_TTL, memory_limit=BROADCAST_DRAFT_MEMORY):
+        self.ttl = ttl
+        self.memory_limit = memory_limit
+        self._drafts = OrderedDict()
+
+    async def _spill(self, items):
+        await db.executemany(
+            "INSERT OR REPLACE INTO broadcast_drafts (id, payload, expires_at) VALUES (?, ?, ?)",
+            [(draft_id, json.dumps(payload, ensure_ascii=False), expires_at) for draft_id, (payload, expires_at) in items]
+        )
+
+    async def put(self, payload):
+        """حفظ مسودة وإرجاع معرّفها القصير (يتسع في callback_data)"""
+        draft_id = secrets.token_urlsafe(6)
+        now = time.time()
+        self._drafts[draft_id] = (payload, now + self.ttl)
+        for stale_id in [key for key, (_, expires_at) in self._drafts.items() if expires_at <= now]:
+            del self._drafts[stale_id]
+        overflow = []
+        while len(self._drafts) > self.memory_limit:
+            overflow.append(self._drafts.popitem(last=False))
+        if overflow:
+            await self._spill(overflow)
+            await db.execute("DELETE FROM broadcast_drafts WHERE expires_at <= ?", (now,))
+        return draft_id
+
+    async def take(self, draft_id):
+        """سحب المسودة وحذفها (التأكيد مرة واحدة فقط)؛ None إن انتهت أو لم توجد"""
+        entry = self._drafts.pop(draft_id, None)
+        if entry is None:
+            row = await db.fetchone("SELECT payload, expires_at FROM broadcast_drafts WHERE id=?", (draft_id,))
+            if row is None:
+                return None
+            await db.execute("DELETE FROM broadcast_drafts WHERE id=?", (draft_id,))
+            entry = (json.loads(row[0]), row[1])
+        payload, expires_at = entry
+        return payload if expires_at > time.time() else None
+
+    async def discard(self, draft_id):
+        if self._drafts.pop(draft_id, None) is None:
+            await db.execute("DELETE FROM broadcast_drafts WHERE id=?", (draft_id,))
+
+    async def flush(self):
+        """نقل المسودات المعلقة إلى القاعدة عند الإغلاق حتى يبقى زر التأكيد صالحًا بعد إعادة التشغيل"""
+        if self._drafts:
+            await self._spill(list(self._drafts.items()))
+            self._drafts.clear()
+
+broadcast_drafts = DraftStore()
+
+async def create_broadcast_job(message_text, chat_id, status_message_id, payload=None):
+    """تسجيل مهمة بث مع صف لكل مستلم في معاملة واحدة"""
+    def create(connection):
+        job_id = connection.execute(
+            "INSERT INTO broadcast_jobs (message, status, created_at, chat_id, status_message_id, payload) VALUES (?, 'running', ?, ?, ?, ?)",
+            (message_text, datetime.now(timezone.utc).isoformat(), chat_id, status_message_id,
+             json.dumps(payload, ensure_ascii=False) if payload else None)
+        ).lastrowid
+        connection.execute("""
+            INSERT INTO broadcast_recipients (job_id, user_id)
+            SELECT ?, user_id FROM users WHERE can_receive_broadcast=1
+        """, (job_id,))
+        return job_id
+
+    return await db.transaction(create)
+
+async def get_broadcast_progress(job_id):
+    """عدد المستلمين في كل حالة لمهمة بث"""
+    rows = await db.fetchall("SELECT status, COUNT(*) FROM broadcast_recipients WHERE job_id=? GROUP BY status", (job_id,))
+    return dict(rows)
+
+async def broadcast_progress_text(job_id):
+    job = await db.fetchone("SELECT status, created_at FROM broadcast_jobs WHERE id=?", (job_id,))
+    if not job:
+        return "📭 لا توجد مهمة بث بهذا المعرف"
+
+    counts = await get_broadcast_progress(job_id)
+    total = sum(counts.values())
+    remaining = counts.get("pending", 0) + counts.get("sending", 0)
+    failed = counts.get("failed", 0) + counts.get("blocked", 0) + counts.get("unknown", 0)
+    header = "✅ <b>اكتمل البث!</b>" if job[0] == "done" else "📤 <b>جاري البث...</b>"
+    return (
+        f"{header}\n\n"
+        f"🆔 المهمة: <code>{job_id}</code>\n"
+        f"✅ ناجح: {counts.get('sent', 0)}\n"
+        f"❌ فشل: {failed}\n"
+        f"⏳ متبقي: {remaining}\n"
+        f"👥 المجموع: {total}"
+    )
+
+def broadcast_progress_keyboard(job_id):
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("🔄 تحديث", callback_data=f"broadcast_progress_{job_id}")]
+    ])
+
+def _claim_broadcast_batch(connection, job_id):
+    """حجز دفعة من المستلمين (pending → sending) في معاملة الكتابة"""
+    batch = [row[0] for row in connection.execute(
+        "SELECT user_id FROM broadcast_recipients WHERE job_id=? AND status='pending' LIMIT ?",
+        (job_id, BROADCAST_BATCH)
+    )]
+    connection.executemany(
+        "UPDATE broadcast_recipients SET status='sending' WHERE job_id=? AND user_id=?",
+        [(job_id, user_id) for user_id in batch]
+    )
+    return batch
+
+def _release_broadcast_recipients(connection, job_id, user_ids):
+    """إعادة مستلمين محجوزين لم تبدأ محاولتهم إلى الانتظار (sending → pending)"""
+    connection.executemany(
+        "UPDATE broadcast_recipients SET status='pending' WHERE job_id=? AND user_id=? AND status='sending'",
+        [(job_id, user_id) for user_id in user_ids]
+    )
+
+def _record_broadcast_results(connection, results):
+    connection.executemany("UPDATE broadcast_recipients SET status=? WHERE job_id=? AND user_id=?", results)
+    connection.executemany(
+        "UPDATE users SET can_receive_broadcast=0 WHERE user_id=?",
+        [(user_id,) for result, _, user_id in results if result == "blocked"]
+    )
+
+async def run_broadcast_job(bot, job_id):
+    """تنفيذ مهمة بث بحجز متجدد: المستلمون يُحجزون على دفعات والنتائج تُسجل مع كل حجز جديد"""
+    message_text, chat_id, status_message_id, payload = await db.fetchone(
+        "SELECT message, chat_id, status_message_id, payload FROM broadcast_jobs WHERE id=?", (job_id,)
+    )
+    payload = json.loads(payload) if payload else {"kind": "text", "text": message_text}
+
+    if payload["kind"] == "copy":
+        # رسالة وسائط أو منسقة: تُنسخ كما هي من محادثة المشرف
+        async def send(user_id):
+            await bot.copy_message(
+                chat_id=user_id,
+                from_chat_id=payload["from_chat_id"],
+                message_id=payload["message_id"]
+            )
+    else:
+        safe_message = escape_html(payload["text"].strip())
+
+        async def send(user_id):
+            await bot.send_message(
+                chat_id=user_id,
+                text=f"📢 <b>إعلان:</b>\n\n{safe_message}",
+                parse_mode="HTML"
+            )
+
+    results = []
+
+    async def refill():
+        # تسجيل نتائج ما أُرسل منذ الحجز السابق ثم حجز الدفعة التالية، والعمال يواصلون الإرسال أثناء ذلك
+        done = results[:]
+        results.clear()
+        if done:
+            await db.transaction(_record_broadcast_results, done)
+        return await db.transaction(_claim_broadcast_batch, job_id)
+
+    try:
+        stats = await broadcast_engine.run(
+            [], send, on_result=lambda user_id, result: results.append((result, job_id, user_id)),
+            refill=refill, stop=broadcast_stop
+        )
+    finally:
+        # تُسجَّل النتائج حتى عند الإيقاف حتى لا تُعاد الرسائل المرسلة بعد الاستئناف
+        await db.transaction(_record_broadcast_results, results)
+    if broadcast_stop.is_set():
+        # إغلاق نظيف: المهمة تبقى running، ومن حُجز ولم تبدأ محاولته يُرسل إليه بعد الاستئناف
+        await db.transaction(_release_broadcast_recipients, job_id, stats["unstarted"])
+        logger.info(f"أُوقف البث #{job_id} مؤقتًا للإغلاق؛ أُعيد {len(stats['unstarted'])} مستلم للانتظار")
+        return
+
+    await db.execute(
+        "UPDATE broadcast_jobs SET status='done', finished_at=? WHERE id=?",
+        (datetime.now(timezone.utc).isoformat(), job_id)
+    )
+
+    result_msg = await broadcast_progress_text(job_id)
+    try:
+        await bot.edit_message_text(result_msg, chat_id=chat_id, message_id=status_message_id, parse_mode="HTML")
+    except Exception:
+        await bot.send_message(chat_id, result_msg, parse_mode="HTML")
+    counts = await get_broadcast_progress(job_id)
+    logger.info(f"اكتمل البث #{job_id}: ناجح {counts.get('sent', 0)} من أصل {sum(counts.values())}")
+
+def start_broadcast_job(bot, job_id):
+    """تشغيل مهمة البث في الخلفية حتى لا يبقى معالج الكول باك معلّقًا"""
+    async def runner():
+        try:
+            await run_broadcast_job(bot, job_id)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"خطأ في مهمة البث #{job_id}: {e}")
+        finally:
+            broadcast_tasks.pop(job_id, None)
+
+    broadcast_tasks[job_id] = asyncio.create_task(runner())
+
+async def resume_broadcast_jobs(bot):
+    """استئناف مهام البث غير المكتملة بعد إعادة التشغيل دون تكرار الإرسال"""
+    job_ids = [row[0] for row in await db.fetchall("SELECT id FROM broadcast_jobs WHERE status='running'")]
+    if not job_ids:
+        return
+    # لا نعرف إن وصلت الرسائل التي كانت قيد الإرسال لحظة التوقف، فلا نعيد إرسالها
+    await db.execute("UPDATE broadcast_recipients SET status='unknown' WHERE status='sending'")
+    for job_id in job_ids:
+        start_broadcast_job(bot, job_id)
+        logger.info(f"استئناف مهمة البث #{job_id}")
+
 # ================= KEYBOARDS =================
+# كائنات تيليجرام غير قابلة للتعديل بعد إنشائها، لذا تُبنى اللوحات الثابتة مرة واحدة وتُشارك بين كل الطلبات
+@lru_cache(maxsize=None)
 def main_menu_keyboard(is_admin=False):
     keyboard = [
         [KeyboardButton("👤 ملفي"), KeyboardButton("🔗 رابط الإحالة")],
@@ -136,6 +1248,7 @@ def main_menu_keyboard(is_admin=False):
     keyboard.append([KeyboardButton("ℹ️ كيفية الاستخدام")])
     return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
 
+@lru_cache(maxsize=None)
 def admin_panel_keyboard():
     return InlineKeyboardMarkup([
         [InlineKeyboardButton("🚀 بدء مسابقة", callback_data="start_new_contest"),
@@ -145,15 +1258,20 @@ def admin_panel_keyboard():
          InlineKeyboardButton("⏱️ إعدادات التأخير", callback_data="settings_delay")],
         [InlineKeyboardButton("📤 بث رسالة", callback_data="broadcast_menu"),
          InlineKeyboardButton("✉️ رسالة فردية", callback_data="send_menu")],
+        [InlineKeyboardButton("📊 حالة البث", callback_data="broadcast_status")],
         [InlineKeyboardButton("💾 نسخ احتياطي", callback_data="backup_menu"),
          InlineKeyboardButton("🔄 استيراد بيانات", callback_data="import_menu")],
         [InlineKeyboardButton("⬅️ العودة للقائمة", callback_data="main_menu")]
     ])
 
+def share_url(referral_link):
+    return f"https://t.me/share/url?url={referral_link}&text=انضم%20إلى%20مسابقتي%20واربح%20الجوائز!%20✨"
+
+@lru_cache(maxsize=KEYBOARD_CACHE_SIZE)
 def referral_keyboard(referral_link):
     return InlineKeyboardMarkup([
         [
-            InlineKeyboardButton("📤 مشاركة الرابط", url=f"https://t.me/share/url?url={referral_link}&text=انضم%20إلى%20مسابقتي%20واربح%20الجوائز!%20✨"),
+            InlineKeyboardButton("📤 مشاركة الرابط", url=share_url(referral_link)),
             InlineKeyboardButton("📋 نسخ الرابط", callback_data="copy_link_info")
         ],
         [
@@ -161,6 +1279,16 @@ def referral_keyboard(referral_link):
         ]
     ])
 
+@lru_cache(maxsize=KEYBOARD_CACHE_SIZE)
+def profile_keyboard(user_id, referral_link):
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("🔗 رابط الإحالة", callback_data=f"show_link_{user_id}")],
+        [InlineKeyboardButton("📤 مشاركة الرابط", url=share_url(referral_link))],
+        [InlineKeyboardButton("🏆 عرض الترتيب", callback_data="show_ranking")],
+        [InlineKeyboardButton("🎯 حالة المسابقة", callback_data="show_contest_status")]
+    ])
+
+@lru_cache(maxsize=None)
 def contest_status_keyboard(active):
     if active:
         return InlineKeyboardMarkup([
@@ -173,6 +1301,7 @@ def contest_status_keyboard(active):
             [InlineKeyboardButton("⬅️ العودة", callback_data="main_menu")]
         ])
 
+@lru_cache(maxsize=None)
 def start_contest_keyboard():
     return InlineKeyboardMarkup([
         [InlineKeyboardButton("⏱️ 30 دقيقة - 3 فائزين", callback_data="quick_contest_30_3")],
@@ -182,39 +1311,220 @@ def start_contest_keyboard():
         [InlineKeyboardButton("❌ إلغاء", callback_data="cancel_contest")]
     ])
 
+@lru_cache(maxsize=None)
+def back_keyboard():
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("⬅️ رجوع", callback_data="main_menu")]
+    ])
+
+@lru_cache(maxsize=None)
+def channel_keyboard():
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("عرض القناة 📢", url=f"https://t.me/{CHANNEL_USERNAME.replace('@', '')}")]
+    ])
+
+# ================= MESSAGE TEMPLATES =================
+# قوالب جاهزة: الأجزاء الثابتة تُبنى مرة، والمتغيرة تُملأ بـ format
+REFERRAL_LINK_TEMPLATE = (
+    "🔗 <b>رابط الإحالة الخاص بك:</b>\n<code>{link}</code>\n\n"
+    "🎯 شاركه مع أصدقائك لجمع النقاط!"
+)
+NO_CONTEST_TEXT = "📭 <b>لا توجد مسابقة نشطة حالياً</b>\n\n🚀 ابدأ مسابقة جديدة لجمع النقاط!"
+ACTIVE_CONTEST_TEMPLATE = (
+    "🎯 <b>مسابقة نشطة!</b>\n\n"
+    "⏰ الوقت المتبقي: <b>{remaining}</b> دقيقة\n"
+    "🏆 عدد الفائزين: <b>{winners}</b>\n"
+    "💎 النقاط لكل إحالة: <b>{points}</b>"
+)
+
+def referral_link_for(bot_username, user_id):
+    return f"https://t.me/{bot_username}?start={user_id}"
+
+@lru_cache(maxsize=16)
+def help_text(points, delay):
+    """نص المساعدة؛ يتغير فقط مع إعدادات النقاط والتأخير"""
+    return (
+        "🎯 <b>كيفية استخدام البوت:</b>\n\n"
+        f"1️⃣ اشترك أولاً في القناة: {CHANNEL_USERNAME}\n"
+        "2️⃣ اضغط على <b>رابط الإحالة</b> وشاركه مع أصدقائك\n"
+        f"3️⃣ كل صديق يشترك عبر رابطك يضيف <b>{points}</b> نقطة لحسابك بعد <b>{delay}</b> دقيقة\n"
+        "4️⃣ تصدر الترتيب واربح الجوائز في المسابقات! 🏆"
+    )
+
+# ================= LEADERBOARD =================
+def rank_display_name(username, first_name, fallback):
+    safe_username = sanitize_username(username)
+    return f"@{safe_username}" if safe_username else escape_html(first_name or fallback)
+
+def rank_medal(rank):
+    return "🥇" if rank == 1 else "🥈" if rank == 2 else "🥉" if rank == 3 else ""
+
+class Leaderboard:
+    """ترتيب النقاط في الذاكرة: قائمة مرتبة بمفتاح (-النقاط، المعرف) تُحدَّث مع كل تغيير، ونصوص مخزنة حسب الإصدار"""
+
+    def __init__(self, depth=LEADERBOARD_DEPTH):
+        self.depth = depth
+        self._ranking = SortedList()
+        self._points = {}
+        self._profiles = {}
+        self._version = 0
+        self._rendered = {}
+
+    def __len__(self):
+        return len(self._ranking)
+
+    def _in_top(self, user_id):
+        points = self._points.get(user_id)
+        return points is not None and self._ranking.index((-points, user_id)) < self.depth
+
+    def load(self, rows):
+        """إعادة البناء من (user_id, username, first_name, points) - عند التشغيل وبعد الاستيراد"""
+        self._points = {user_id: points for user_id, _, _, points in rows if points > 0}
+        self._profiles = {user_id: (username, first_name) for user_id, username, first_name, points in rows if points > 0}
+        self._ranking = SortedList((-points, user_id) for user_id, points in self._points.items())
+        self._version += 1
+
+    def update(self, user_id, points, username=None, first_name=None):
+        """تعيين رصيد مستخدم؛ لا يُبطل النصوص إلا إذا كان داخل الترتيب المعروض قبل التغيير أو بعده"""
+        touched = self._in_top(user_id)
+        old = self._points.pop(user_id, None)
+        if old is not None:
+            self._ranking.remove((-old, user_id))
+        if points > 0:
+            self._points[user_id] = points
+            self._ranking.add((-points, user_id))
+            if username is not None or first_name is not None:
+                self._profiles[user_id] = (username, first_name)
+        else:
+            self._profiles.pop(user_id, None)
+        if touched or self._in_top(user_id):
+            self._version += 1
+
+    def set_profile(self, user_id, username, first_name):
+        if user_id not in self._points or self._profiles.get(user_id) == (username, first_name):
+            return
+        self._profiles[user_id] = (username, first_name)
+        if self._in_top(user_id):
+            self._version += 1
+
+    def reset(self):
+        self.load([])
+
+    def points(self, user_id):
+        return self._points.get(user_id, 0)
+
+    def rank(self, user_id):
+        """مركز المستخدم بترتيب المنافسة (المتعادلون يتشاركون المركز) والفارق عن المركز الأعلى - O(log n)
+
+        يعيد (المركز، عدد المرتبين، الفارق) أو None لمن ليس له نقاط
+        """
+        points = self._points.get(user_id)
+        if points is None:
+            return None
+        ahead = self._ranking.bisect_left((-points,))
+        gap = -self._ranking[ahead - 1][0] - points if ahead else 0
+        return ahead + 1, len(self._ranking), gap
+
+    def top(self, k):
+        """أعلى k: قائمة (user_id, username, first_name, points)"""
+        return [
+            (user_id, *self._profiles.get(user_id, (None, None)), -neg_points)
+            for neg_points, user_id in self._ranking.islice(0, k)
+        ]
+
+    def render(self, k, header, empty, unit=" نقطة", medals=True):
+        """نص الترتيب الجاهز؛ يُعاد بناؤه فقط إذا تغير أعلى الترتيب منذ آخر عرض"""
+        key = (k, header, empty, unit, medals)
+        cached = self._rendered.get(key)
+        if cached and cached[0] == self._version:
+            return cached[1]
+
+        rows = self.top(k)
+        if not rows:
+            text = empty
+        else:
+            text = header
+            for i, (_, username, first_name, points) in enumerate(rows, 1):
+                display_name = rank_display_name(username, first_name, f"مستخدم #{i}")
+                prefix = f"{rank_medal(i)} " if medals else ""
+                text += f"{prefix}{i}. {display_name} | {points}{unit}\n"
+        self._rendered[key] = (self._version, text)
+        return text
+
+leaderboard = Leaderboard()
+
+def rank_text(user_id):
+    position = leaderboard.rank(user_id)
+    if position is None:
+        return "🏅 <b>مركزك:</b> غير مصنف بعد - اجمع أول نقطة لتدخل الترتيب"
+    rank, total, gap = position
+    text = f"🏅 <b>مركزك:</b> {rank} من {total}"
+    if rank > 1:
+        text += f"\n⬆️ الفارق عن المركز الأعلى: <b>{gap}</b> نقطة"
+    return text
+
+def _leaderboard_rows(connection, period):
+    return connection.execute("""
+        SELECT s.user_id, u.username, u.first_name, s.points
+        FROM contest_scores s JOIN users u ON u.user_id = s.user_id
+        WHERE s.contest_id = ? AND s.points > 0
+    """, (period,)).fetchall()
+
+async def load_leaderboard():
+    # القراءة على اتصال الكتابة تضعها في نفس طابور معاملات الاحتساب، فلا يضيع احتساب
+    # يُثبَّت بين القراءة والتحميل عند معالجة التحديثات بالتوازي (مثلًا أثناء /import)
+    rows = await db.transaction(_leaderboard_rows, get_setting("score_period"))
+    leaderboard.load(rows)
+    logger.info(f"تم تحميل الترتيب: {len(leaderboard)} مستخدم")
+
 # ================= CONTEST ENGINE =================
+def _freeze_contest_tx(connection):
+    result = connection.execute("SELECT winners, active FROM contest WHERE id=1").fetchone()
+    if not result or result[1] == 0:
+        return None
+
+    winners_count = result[0]
+    winners = connection.execute("""
+        SELECT s.user_id, u.username, u.first_name, s.points
+        FROM contest_scores s JOIN users u ON u.user_id = s.user_id
+        WHERE s.contest_id = ? AND s.points > 0
+        ORDER BY s.points DESC, s.user_id
+        LIMIT ?
+    """, (_score_period(connection), winners_count)).fetchall()
+
+    # الإيقاف في نفس المعاملة يمنع احتساب أي إحالة متأخرة ضمن النتيجة
+    connection.execute("UPDATE contest SET active=0 WHERE id=1")
+    return winners
+
+async def freeze_contest():
+    """تجميد الترتيب وإيقاف المسابقة في معاملة واحدة؛ يعيد قائمة الفائزين أو None إن لم تكن نشطة"""
+    winners = await db.transaction(_freeze_contest_tx)
+    if winners is None:
+        return None
+
+    winner_list = []
+    for i, (user_id, username, first_name, points) in enumerate(winners, 1):
+        display_name = rank_display_name(username, first_name, f"ID:{user_id}")
+        winner_list.append({
+            "rank": i,
+            "user_id": user_id,
+            "display_name": display_name,
+            "points": points
+        })
+    return winner_list
+
 async def end_contest(app, force_manual=False):
     try:
-        cursor.execute("SELECT winners, active FROM contest WHERE id=1")
-        result = cursor.fetchone()
-        if not result or result[1] == 0:
+        if force_manual:
+            contest_timer.cancel()
+
+        winner_list = await freeze_contest()
+        if winner_list is None:
             return False, "لا توجد مسابقة نشطة حالياً"
 
-        winners_count = result[0]
-        cursor.execute("""
-            SELECT user_id, username, first_name, points 
-            FROM users 
-            WHERE points > 0 
-            ORDER BY points DESC 
-            LIMIT ?
-        """, (winners_count,))
-        winners = cursor.fetchall()
-
-        if not winners:
-            cursor.execute("UPDATE contest SET active=0 WHERE id=1")
-            conn.commit()
+        if not winner_list:
             return False, "❌ لا توجد إحالات صالحة لإنهاء المسابقة"
 
-        winner_list = []
-        for i, (user_id, username, first_name, points) in enumerate(winners, 1):
-            display_name = f"@{sanitize_username(username)}" if username else escape_html(first_name or f"ID:{user_id}")
-            winner_list.append({
-                "rank": i,
-                "user_id": user_id,
-                "display_name": display_name,
-                "points": points
-            })
-
         admin_msg = "🏆 <b>انتهت المسابقة! الفائزون:</b>\n\n"
         for w in winner_list:
             admin_msg += f"🏅 المركز {w['rank']}: {w['display_name']} | {w['points']} نقطة\n"
@@ -239,9 +1549,7 @@ async def end_contest(app, force_manual=False):
                     f"💎 نقاطك: <b>{w['points']}</b>\n\n"
                     f"🎁 يرجى متابعة القناة لاستلام جائزتك قريباً!",
                     parse_mode="HTML",
-                    reply_markup=InlineKeyboardMarkup([
-                        [InlineKeyboardButton("عرض القناة 📢", url=f"https://t.me/{CHANNEL_USERNAME.replace('@', '')}")]
-                    ])
+                    reply_markup=channel_keyboard()
                 )
                 await asyncio.sleep(0.3)
             except Exception as e:
@@ -264,9 +1572,7 @@ async def end_contest(app, force_manual=False):
             except Exception as e2:
                 logger.error(f"فشل إرسال الإعلان حتى بدون HTML: {e2}")
 
-        cursor.execute("UPDATE contest SET active=0 WHERE id=1")
-        conn.commit()
-        logger.info(f"{'تم إنهاء المسابقة يدويًا' if force_manual else 'انتهت المسابقة تلقائيًا'} - الفائزون: {len(winners)}")
+        logger.info(f"{'تم إنهاء المسابقة يدويًا' if force_manual else 'انتهت المسابقة تلقائيًا'} - الفائزون: {len(winner_list)}")
 
         return True, winner_list
 
@@ -278,15 +1584,66 @@ async def end_contest(app, force_manual=False):
             pass
         return False, str(e)
 
+class ContestTimer:
+    """مؤقت مستقل ينهي المسابقة عند end_time بالضبط بمعزل عن دورة احتساب الإحالات"""
+
+    def __init__(self):
+        self.app = None
+        self._task = None
+
+    def attach(self, app):
+        self.app = app
+
+    def arm(self, end_time):
+        """ضبط المؤقت على end_time (datetime)، مع إلغاء أي مؤقت سابق"""
+        self.cancel()
+        if self.app is None:
+            return
+        self._task = asyncio.create_task(self._run(end_time))
+
+    def cancel(self):
+        if self._task and not self._task.done() and self._task is not asyncio.current_task():
+            self._task.cancel()
+        self._task = None
+
+    async def rearm_from_db(self):
+        """مزامنة المؤقت مع جدول المسابقة (عند التشغيل وبعد الاستيراد)"""
+        contest_data = await db.fetchone("SELECT active, end_time FROM contest WHERE id=1")
+        if contest_data and contest_data[0] == 1:
+            self.arm(datetime.fromisoformat(contest_data[1].replace("Z", "+00:00")))
+        else:
+            self.cancel()
+
+    async def _run(self, end_time):
+        while True:
+            remaining = (end_time - datetime.now(timezone.utc)).total_seconds()
+            if remaining <= 0:
+                break
+            # النوم على فترات قصيرة يتدارك أي انحراف في ساعة النظام
+            await asyncio.sleep(min(remaining, 60))
+
+        logger.info("تم الوصول لوقت انتهاء المسابقة - بدء عملية الإنهاء التلقائي")
+        success, result = await end_contest(self.app, force_manual=False)
+        if success:
+            logger.info("تم إنهاء المسابقة تلقائيًا بنجاح")
+        else:
+            logger.error(f"فشل إنهاء المسابقة التلقائي: {result}")
+
+contest_timer = ContestTimer()
+
 # ================= CONTEST HELPERS (آمنة للاستخدام في الكول باك) =================
+def _create_contest_tx(connection, end_time, winners):
+    connection.execute("DELETE FROM contest")
+    connection.execute("INSERT INTO contest (id, active, end_time, winners) VALUES (1, 1, ?, ?)", 
+                       (end_time.isoformat(), winners))
+    return _open_score_period_tx(connection)
+
 async def _create_contest_db(minutes: int, winners: int):
     """إنشاء مسابقة في قاعدة البيانات فقط (بدون إرسال رسائل)"""
     end_time = datetime.now(timezone.utc) + timedelta(minutes=minutes)
-    cursor.execute("DELETE FROM contest")
-    cursor.execute("INSERT INTO contest (id, active, end_time, winners) VALUES (1, 1, ?, ?)", 
-                  (end_time.isoformat(), winners))
-    cursor.execute("UPDATE users SET points=0")
-    conn.commit()
+    settings_cache["score_period"] = await db.transaction(_create_contest_tx, end_time, winners)
+    leaderboard.reset()
+    contest_timer.arm(end_time)
     logger.info(f"بدأت مسابقة جديدة: {minutes} دقيقة، {winners} فائزين")
     return minutes, winners
 
@@ -337,8 +1694,7 @@ async def end_contest_manual_command(update: Update, context: ContextTypes.DEFAU
         await update.message.reply_text("❌ هذا الأمر متاح للمشرفين فقط")
         return
 
-    cursor.execute("SELECT active, winners FROM contest WHERE id=1")
-    contest = cursor.fetchone()
+    contest = await db.fetchone("SELECT active, winners FROM contest WHERE id=1")
     if not contest or contest[0] == 0:
         await update.message.reply_text(
             "❌ لا توجد مسابقة نشطة حالياً",
@@ -349,21 +1705,9 @@ async def end_contest_manual_command(update: Update, context: ContextTypes.DEFAU
         return
 
     winners_count = contest[1]
-    cursor.execute("""
-        SELECT username, first_name, points 
-        FROM users 
-        WHERE points > 0 
-        ORDER BY points DESC 
-        LIMIT 10
-    """)
-    top_users = cursor.fetchall()
-    
-    preview = "📊 <b>الترتيب الحالي (أعلى 10):</b>\n\n"
-    for i, (username, first_name, points) in enumerate(top_users, 1):
-        display_name = f"@{sanitize_username(username)}" if username else escape_html(first_name or f"مستخدم #{i}")
-        preview += f"{i}. {display_name} | {points} نقطة\n"
-    if not top_users:
-        preview = "📭 لا توجد إحالات مسجلة بعد"
+    preview = leaderboard.render(
+        10, "📊 <b>الترتيب الحالي (أعلى 10):</b>\n\n", "📭 لا توجد إحالات مسجلة بعد", medals=False
+    )
 
     await update.message.reply_text(
         f"🛑 <b>هل أنت متأكد من إنهاء المسابقة يدويًا؟</b>\n\n"
@@ -380,67 +1724,231 @@ async def end_contest_manual_command(update: Update, context: ContextTypes.DEFAU
 # ================= REFERRAL ENGINE (بدون Job Queue) =================
 background_task = None
 
-async def background_tasks(app):
-    """المهمة الخلفية بدون الحاجة لـ Job Queue"""
-    while True:
-        await asyncio.sleep(30)
-        try:
-            delay = get_setting("delay")
-            points = get_setting("points")
-            now = datetime.now(timezone.utc)
+async def check_members(bot, user_ids):
+    """التحقق من عضوية مجموعة مستخدمين بالتوازي بحد أقصى MEMBERSHIP_CONCURRENCY؛ يعيد {user_id: bool}"""
+    semaphore = asyncio.Semaphore(MEMBERSHIP_CONCURRENCY)
+
+    async def check(user_id):
+        async with semaphore:
+            return await is_valid_member(bot, user_id)
+
+    results = await asyncio.gather(*(check(user_id) for user_id in user_ids))
+    return dict(zip(user_ids, results))
+
+def _credit_referrals_tx(connection, new_users, points):
+    connection.execute("CREATE TEMP TABLE IF NOT EXISTS credit_batch (new_user INTEGER PRIMARY KEY)")
+    connection.execute("CREATE TEMP TABLE IF NOT EXISTS credit_totals (referrer INTEGER PRIMARY KEY, n INTEGER)")
+    connection.execute("DELETE FROM credit_batch")
+    connection.execute("DELETE FROM credit_totals")
+    connection.executemany("INSERT OR IGNORE INTO credit_batch VALUES (?)", [(u,) for u in new_users])
+
+    # تجميع لكل محيل موجود (الإحالات لمحيل غير مسجل تبقى معلقة كما كانت)
+    connection.execute("""
+        INSERT INTO credit_totals (referrer, n)
+        SELECT r.referrer, COUNT(*)
+        FROM referrals r
+        JOIN credit_batch b ON b.new_user = r.new_user
+        JOIN users u ON u.user_id = r.referrer
+        WHERE r.counted = 0
+        GROUP BY r.referrer
+    """)
+    period = _score_period(connection)
+    connection.execute("""
+        INSERT INTO contest_scores (contest_id, user_id, points)
+        SELECT ?, referrer, ? * n FROM credit_totals WHERE true
+        ON CONFLICT(contest_id, user_id) DO UPDATE SET points = points + excluded.points
+    """, (period, points))
+    connection.execute("""
+        UPDATE referrals SET counted=1
+        WHERE counted=0
+          AND new_user IN (SELECT new_user FROM credit_batch)
+          AND referrer IN (SELECT referrer FROM credit_totals)
+    """)
+    credited = dict(connection.execute("SELECT referrer, n FROM credit_totals").fetchall())
+    standings = connection.execute("""
+        SELECT u.user_id, u.username, u.first_name, s.points
+        FROM credit_totals t
+        JOIN users u ON u.user_id = t.referrer
+        JOIN contest_scores s ON s.contest_id = ? AND s.user_id = t.referrer
+    """, (period,)).fetchall()
+    skipped = [new_user for new_user, in connection.execute(
+        "SELECT new_user FROM referrals WHERE counted=0 AND new_user IN (SELECT new_user FROM credit_batch)"
+    )]
+    return credited, skipped, standings
+
+async def credit_referrals(new_users, points):
+    """احتساب دفعة من الإحالات في معاملة واحدة؛ يعيد ({المحيل: عدد الإحالات المحتسبة}, الإحالات التي بقيت معلقة)"""
+    if not new_users:
+        return {}, []
+
+    credited, skipped, standings = await db.transaction(_credit_referrals_tx, new_users, points)
+    for user_id, username, first_name, total in standings:
+        leaderboard.update(user_id, total, username, first_name)
+    if skipped:
+        logger.warning(f"{len(skipped)} إحالة لمحيلين غير موجودين - لم تحتسب")
+    if credited:
+        REFERRALS_CREDITED.inc(amount=sum(credited.values()))
+        logger.info(f"تم احتساب {sum(credited.values())} إحالة لـ {len(credited)} محيل")
+    return credited, skipped
+
+async def notify_referrers(bot, credited, points):
+    """إشعار كل محيل برسالة واحدة تجمع إحالاته المحتسبة في هذه الدورة"""
+    async def send(referrer):
+        count = credited[referrer]
+        text = (
+            f"🎉 <b>تم احتساب إحالة جديدة!</b>\n+{points} نقطة 💎" if count == 1
+            else f"🎉 <b>تم احتساب {count} إحالات جديدة!</b>\n+{points * count} نقطة 💎"
+        )
+        await bot.send_message(referrer, text, parse_mode="HTML")
 
-            cursor.execute("SELECT new_user, referrer, joined_at FROM referrals WHERE counted=0")
-            rows = cursor.fetchall()
+    stats = await broadcast_engine.run(list(credited), send)
+    if stats["failed"]:
+        logger.warning(f"فشل إرسال {stats['failed']} إشعار للمحيلين")
 
-            for new_user, referrer, joined_at in rows:
-                try:
-                    joined_time = datetime.fromisoformat(joined_at.replace("Z", "+00:00"))
-                    if (now - joined_time) < timedelta(minutes=delay):
-                        continue
-
-                    if not await is_valid_member(app.bot, new_user):
-                        logger.info(f"المستخدم {new_user} غادر القناة - لن تحتسب إحالته")
-                        continue
-
-                    cursor.execute("SELECT user_id FROM users WHERE user_id=?", (referrer,))
-                    if not cursor.fetchone():
-                        logger.warning(f"محيل غير موجود: {referrer}")
-                        continue
-
-                    cursor.execute("UPDATE users SET points = points + ? WHERE user_id=?", (points, referrer))
-                    cursor.execute("UPDATE referrals SET counted=1 WHERE new_user=?", (new_user,))
-                    conn.commit()
-
-                    try:
-                        await app.bot.send_message(
-                            referrer,
-                            f"🎉 <b>تم احتساب إحالة جديدة!</b>\n+{points} نقطة 💎",
-                            parse_mode="HTML"
-                        )
-                        logger.info(f"تم احتساب إحالة: {new_user} ← {referrer}")
-                    except Exception as e:
-                        logger.warning(f"فشل إرسال إشعار للمحيل {referrer}: {e}")
-
-                except Exception as e:
-                    logger.error(f"خطأ في معالجة إحالة {new_user}: {e}")
-                    continue
+class DeadlineScheduler:
+    """كومة صغرى من مواعيد الاستحقاق: الحلقة تنام حتى أقرب موعد فقط ولا تستيقظ بلا عمل"""
+
+    def __init__(self, batch_window=SCHEDULER_BATCH_WINDOW):
+        self.batch_window = batch_window
+        self._heap = []
+        self._counter = itertools.count()
+        self._wakeup = asyncio.Event()
+
+    def __len__(self):
+        return len(self._heap)
+
+    def schedule(self, due, kind, key=None):
+        """إضافة حدث (kind, key) يستحق عند due (datetime)"""
+        entry = (due.timestamp(), next(self._counter), kind, key)
+        heapq.heappush(self._heap, entry)
+        if self._heap[0] is entry:
+            self._wakeup.set()
+
+    def clear(self):
+        self._heap.clear()
+        self._wakeup.set()
+
+    async def _wait(self, timeout):
+        self._wakeup.clear()
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
 
-            cursor.execute("SELECT active, end_time, winners FROM contest WHERE id=1")
-            contest_data = cursor.fetchone()
-            if contest_data and contest_data[0] == 1:
-                end_time = datetime.fromisoformat(contest_data[1].replace("Z", "+00:00"))
-                if now >= end_time:
-                    logger.info("تم الوصول لوقت انتهاء المسابقة - بدء عملية الإنهاء التلقائي")
-                    success, result = await end_contest(app, force_manual=False)
-                    if success:
-                        logger.info("تم إنهاء المسابقة تلقائيًا بنجاح")
-                    else:
-                        logger.error(f"فشل إنهاء المسابقة التلقائي: {result}")
+    async def wait_due(self):
+        """الانتظار حتى يستحق أقرب موعد ثم إعادة كل الأحداث المستحقة خلال نافذة التجميع"""
+        while True:
+            if not self._heap:
+                await self._wait(None)
+                continue
+            remaining = self._heap[0][0] - time.time()
+            if remaining > 0:
+                await self._wait(remaining)
+                continue
+
+            horizon = time.time() + self.batch_window
+            due, last = [], 0.0
+            while self._heap and self._heap[0][0] <= horizon:
+                last, _, kind, key = heapq.heappop(self._heap)
+                due.append((kind, key))
+            # ننتظر آخر موعد في الدفعة بدلاً من معالجته مبكرًا
+            lag = last - time.time()
+            if lag > 0:
+                await asyncio.sleep(lag)
+            return due
+
+scheduler = DeadlineScheduler()
+
+def schedule_referral(new_user, joined_at):
+    """جدولة نضج إحالة عند joined_at + مدة التأخير"""
+    joined_time = datetime.fromisoformat(joined_at.replace("Z", "+00:00"))
+    scheduler.schedule(joined_time + timedelta(minutes=get_setting("delay")), "referral", new_user)
+
+async def rebuild_schedule():
+    """إعادة بناء الكومة من قاعدة البيانات (عند التشغيل، بعد الاستيراد، أو عند تغيير التأخير)"""
+    rows = await db.fetchall("SELECT new_user, joined_at FROM referrals WHERE counted=0")
+    scheduler.clear()
+    for new_user, joined_at in rows:
+        try:
+            schedule_referral(new_user, joined_at)
+        except (TypeError, ValueError):
+            logger.warning(f"وقت انضمام غير صالح للإحالة {new_user}: {joined_at}")
+    logger.info(f"تمت جدولة {len(scheduler)} موعد من قاعدة البيانات")
+
+def reschedule_referrals(new_users):
+    """إعادة إحالات مسحوبة من الكومة لفحص لاحق بعد REFERRAL_RECHECK_INTERVAL بدل إسقاطها"""
+    recheck_at = datetime.now(timezone.utc) + timedelta(seconds=REFERRAL_RECHECK_INTERVAL)
+    for new_user in new_users:
+        scheduler.schedule(recheck_at, "referral", new_user)
+
+async def process_due_referrals(app, new_users):
+    """احتساب الإحالات المستحقة: تحقق متوازٍ من العضوية ثم كتابة دفعية واحدة"""
+    points = get_setting("points")
+    cutoff = (datetime.now(timezone.utc) - timedelta(minutes=get_setting("delay"))).isoformat()
+
+    def select_unconfirmed(connection):
+        rows = []
+        for i in range(0, len(new_users), 500):
+            chunk = new_users[i:i + 500]
+            placeholders = ",".join("?" * len(chunk))
+            rows.extend(connection.execute(
+                f"SELECT new_user, joined_at FROM referrals WHERE counted=0 AND new_user IN ({placeholders})",
+                chunk
+            ).fetchall())
+        return rows
+
+    # ما لم ينضج بعد حسب الساعة الحالية (انحراف الساعة أو زيادة التأخير) يعود للكومة ولا يُسقط
+    pending, not_due = [], []
+    for new_user, joined_at in await db.read(select_unconfirmed):
+        (pending if joined_at and joined_at <= cutoff else not_due).append(new_user)
+    reschedule_referrals(not_due)
+
+    # جمع نتائج التحقق كلها قبل الكتابة الدفعية في قاعدة البيانات
+    membership = await check_members(app.bot, pending)
+    valid_users, left = [], []
+    for new_user in pending:
+        if membership[new_user]:
+            valid_users.append(new_user)
+        else:
+            logger.info(f"المستخدم {new_user} غادر القناة - لن تحتسب إحالته")
+            left.append(new_user)
+    reschedule_referrals(left)
 
+    credited, skipped = await credit_referrals(valid_users, points)
+    reschedule_referrals(skipped)
+    if credited:
+        await notify_referrers(app.bot, credited, points)
+
+async def background_tasks(app):
+    """المهمة الخلفية: تنام حتى أقرب موعد مستحق في الكومة بدلاً من الاستطلاع الدوري"""
+    await rebuild_schedule()
+    while True:
+        due = await scheduler.wait_due()
+        referrals = [key for kind, key in due if kind == "referral"]
+        if not referrals:
+            continue
+        started = time.perf_counter()
+        try:
+            await process_due_referrals(app, referrals)
         except Exception as e:
+            SWEEP_ERRORS.inc()
             logger.error(f"خطأ في المهمة الخلفية: {e}")
+            # الدفعة سُحبت من الكومة؛ نعيدها كلها (ما احتُسب منها سيُتجاهل في الفحص القادم)
+            reschedule_referrals(referrals)
+        finally:
+            # الدورات الفاشلة تُقاس أيضًا، فالبطيئة ثم الفاشلة لا تختفي من المدرج
+            SWEEP_SECONDS.observe(time.perf_counter() - started)
 
 # ================= START & PROFILE =================
+UPSERT_USER_SQL = """
+    INSERT INTO users (user_id, username, first_name, last_seen) 
+    VALUES (?, ?, ?, ?)
+    ON CONFLICT(user_id) DO UPDATE SET 
+        username=excluded.username, 
+        first_name=excluded.first_name,
+        last_seen=excluded.last_seen
+"""
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     if not user:
@@ -450,15 +1958,9 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     safe_first_name = escape_html(user.first_name)[:50] if user.first_name else "مستخدم"
     now = datetime.now(timezone.utc).isoformat()
     
-    cursor.execute("""
-        INSERT INTO users (user_id, username, first_name, last_seen) 
-        VALUES (?, ?, ?, ?)
-        ON CONFLICT(user_id) DO UPDATE SET 
-            username=excluded.username, 
-            first_name=excluded.first_name,
-            last_seen=excluded.last_seen
-    """, (user.id, safe_username, safe_first_name, now))
-    conn.commit()
+    # لا ننتظر تثبيت تحديث البيانات الشخصية؛ إدخال الإحالة أدناه يمر بنفس الطابور وبنفس الترتيب
+    db.write_nowait(UPSERT_USER_SQL, (user.id, safe_username, safe_first_name, now))
+    leaderboard.set_profile(user.id, safe_username, safe_first_name)
 
     referrer_id = None
     if context.args:
@@ -470,21 +1972,20 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
             pass
 
     if referrer_id and referrer_id != user.id:
-        cursor.execute("SELECT user_id FROM users WHERE user_id=?", (referrer_id,))
-        if cursor.fetchone() and await is_valid_member(context.bot, user.id):
-            cursor.execute("""
+        referrer_exists = await db.fetchone("SELECT user_id FROM users WHERE user_id=?", (referrer_id,))
+        if referrer_exists and await is_valid_member(context.bot, user.id):
+            inserted = await db.write("""
                 INSERT OR IGNORE INTO referrals (new_user, referrer, joined_at)
                 VALUES (?, ?, ?)
             """, (user.id, referrer_id, now))
-            conn.commit()
-            logger.info(f"تسجيل إحالة جديدة: {user.id} ← {referrer_id}")
+            if inserted == 1:
+                schedule_referral(user.id, now)
+                logger.info(f"تسجيل إحالة جديدة: {user.id} ← {referrer_id}")
 
     # ✅ رابط صحيح بدون مسافات
-    bot_username = context.bot.username
-    referral_link = f"https://t.me/{bot_username}?start={user.id}"
+    referral_link = referral_link_for(context.bot.username, user.id)
 
-    cursor.execute("SELECT points FROM users WHERE user_id=?", (user.id,))
-    points = cursor.fetchone()[0] or 0
+    points = leaderboard.points(user.id)
 
     display_name = f"@{safe_username}" if safe_username else safe_first_name
 
@@ -503,8 +2004,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def me(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    cursor.execute("SELECT points, username, first_name FROM users WHERE user_id=?", (user.id,))
-    result = cursor.fetchone()
+    result = await db.fetchone("SELECT username, first_name FROM users WHERE user_id=?", (user.id,))
     
     if not result:
         await update.message.reply_text(
@@ -513,15 +2013,14 @@ async def me(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
 
-    points, username, first_name = result
+    username, first_name = result
+    points = leaderboard.points(user.id)
     safe_username = sanitize_username(username)
     display_name = f"@{safe_username}" if safe_username else escape_html(first_name or "مستخدم")
     
-    bot_username = context.bot.username
-    referral_link = f"https://t.me/{bot_username}?start={user.id}"
+    referral_link = referral_link_for(context.bot.username, user.id)
 
-    cursor.execute("SELECT active, end_time FROM contest WHERE id=1")
-    contest = cursor.fetchone()
+    contest = await db.fetchone("SELECT active, end_time FROM contest WHERE id=1")
     contest_info = ""
     if contest and contest[0] == 1:
         end_time = datetime.fromisoformat(contest[1].replace("Z", "+00:00"))
@@ -535,18 +2034,14 @@ async def me(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"🆔 <b>معرفك:</b> <code>{user.id}</code>\n"
         f"🏷 <b>اسمك:</b> {display_name}\n"
         f"💎 <b>نقاطك:</b> {points}\n"
+        f"{rank_text(user.id)}\n"
         f"📊 {contest_info}"
     )
     
     await update.message.reply_text(
         profile_msg,
         parse_mode="HTML",
-        reply_markup=InlineKeyboardMarkup([
-            [InlineKeyboardButton("🔗 رابط الإحالة", callback_data=f"show_link_{user.id}")],
-            [InlineKeyboardButton("📤 مشاركة الرابط", url=f"https://t.me/share/url?url={referral_link}&text=انضم%20إلى%20مسابقتي%20واربح%20الجوائز!%20✨")],
-            [InlineKeyboardButton("🏆 عرض الترتيب", callback_data="show_ranking")],
-            [InlineKeyboardButton("🎯 حالة المسابقة", callback_data="show_contest_status")]
-        ])
+        reply_markup=profile_keyboard(user.id, referral_link)
     )
 
 # ================= ADMIN COMMANDS =================
@@ -566,27 +2061,16 @@ async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
         reply_markup=admin_panel_keyboard()
     )
 
-async def top_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    cursor.execute("""
-        SELECT username, first_name, points 
-        FROM users 
-        WHERE points > 0 
-        ORDER BY points DESC 
-        LIMIT 10
-    """)
-    rows = cursor.fetchall()
-
-    if not rows:
-        await update.message.reply_text("📭 لا توجد نقاط مسجلة بعد.")
-        return
-
-    text = "🏆 <b>الترتيب العام (أعلى 10):</b>\n\n"
-    for i, (username, first_name, points) in enumerate(rows, 1):
-        safe_username = sanitize_username(username)
-        display_name = f"@{safe_username}" if safe_username else escape_html(first_name or f"مستخدم #{i}")
-        medal = "🥇" if i == 1 else "🥈" if i == 2 else "🥉" if i == 3 else ""
-        text += f"{medal} {i}. {display_name} | {points} نقطة\n"
+async def rank_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    points = leaderboard.points(user.id)
+    await update.message.reply_text(
+        f"💎 <b>نقاطك:</b> {points}\n{rank_text(user.id)}",
+        parse_mode="HTML"
+    )
 
+async def top_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    text = leaderboard.render(10, "🏆 <b>الترتيب العام (أعلى 10):</b>\n\n", "📭 لا توجد نقاط مسجلة بعد.")
     await update.message.reply_text(text, parse_mode="HTML")
 
 async def set_points_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -607,7 +2091,7 @@ async def set_points_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
         value = int(context.args[0])
         if value < 1:
             raise ValueError
-        set_setting("points", value)
+        await set_setting("points", value)
         await update.message.reply_text(f"✅ تم تعيين النقاط لكل إحالة: <b>{value}</b>", parse_mode="HTML")
         logger.info(f"تم تغيير قيمة النقاط إلى {value} بواسطة {update.effective_user.id}")
     except:
@@ -631,7 +2115,8 @@ async def set_delay_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         value = int(context.args[0])
         if value < 1 or value > 1440:
             raise ValueError
-        set_setting("delay", value)
+        await set_setting("delay", value)
+        await rebuild_schedule()
         await update.message.reply_text(f"✅ تم تعيين مدة التأخير: <b>{value}</b> دقيقة", parse_mode="HTML")
         logger.info(f"تم تغيير مدة التأخير إلى {value} دقيقة بواسطة {update.effective_user.id}")
     except:
@@ -642,10 +2127,70 @@ async def reset_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ هذا الأمر متاح للمشرفين فقط")
         return
         
-    cursor.execute("UPDATE users SET points=0")
-    conn.commit()
+    period = await open_score_period()
     await update.message.reply_text("✅ تم تصفير جميع النقاط بنجاح")
-    logger.warning(f"تم تصفير النقاط بواسطة {update.effective_user.id}")
+    logger.warning(f"تم تصفير النقاط (فترة جديدة {period}) بواسطة {update.effective_user.id}")
+
+async def cache_stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text("❌ هذا الأمر متاح للمشرفين فقط")
+        return
+
+    stats = membership_cache.stats()
+    await update.message.reply_text(
+        f"🧠 <b>ذاكرة التحقق من العضوية</b>\n\n"
+        f"📦 الحجم: {stats['size']} / {MEMBERSHIP_CACHE_SIZE}\n"
+        f"✅ إصابات: {stats['hits']}\n"
+        f"❌ إخفاقات: {stats['misses']}\n"
+        f"📈 نسبة الإصابة: {stats['hit_ratio']:.1%}\n"
+        f"⏱️ الصلاحية: {MEMBERSHIP_CACHE_TTL} ث (إيجابي) / {MEMBERSHIP_CACHE_NEGATIVE_TTL} ث (سلبي)",
+        parse_mode="HTML"
+    )
+
+async def callback_stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text("❌ هذا الأمر متاح للمشرفين فقط")
+        return
+
+    processor = context.application.update_processor
+    text = ""
+    if isinstance(processor, PerUserUpdateProcessor):
+        p = processor.stats()
+        text = (
+            f"⚙️ <b>المعالجة المتوازية:</b> {p['running']} / {p['limit']} قيد التنفيذ، "
+            f"{p['owners']} مستخدم نشط، {p['serialized']} تحديث انتظر دوره\n\n"
+        )
+
+    stats = sorted(callback_router.stats.items(), key=lambda item: item[1][0], reverse=True)
+    if not stats:
+        await update.message.reply_text(text + "📭 لم تُضغط أي أزرار بعد", parse_mode="HTML")
+        return
+
+    text += "⏱️ <b>زمن معالجة الأزرار</b> (عدد | متوسط | أقصى)\n\n"
+    for name, (count, total, worst) in stats[:25]:
+        text += f"<code>{escape_html(name)}</code>: {count} | {total / count * 1000:.1f} ms | {worst * 1000:.1f} ms\n"
+    await update.message.reply_text(text, parse_mode="HTML")
+
+async def snapshot_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text("❌ هذا الأمر متاح للمشرفين فقط")
+        return
+
+    # /snapshot raw لحفظ ملف .db غير مضغوط
+    compress = not (context.args and context.args[0].lower() == "raw")
+    status = await update.message.reply_text("🔄 جاري أخذ لقطة من قاعدة البيانات...")
+    try:
+        path, size, elapsed = await take_snapshot(compress=compress)
+        await status.edit_text(
+            f"✅ <b>تم حفظ اللقطة</b>\n\n"
+            f"📁 <code>{escape_html(path)}</code>\n"
+            f"📦 {size / 1048576:.1f} MB في {elapsed:.1f} ث\n"
+            f"🗂 يُحتفظ بآخر {SNAPSHOT_KEEP} لقطات",
+            parse_mode="HTML"
+        )
+    except Exception as e:
+        logger.error(f"فشل أخذ اللقطة: {e}")
+        await status.edit_text(f"❌ فشل أخذ اللقطة: {e}")
 
 async def send_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_admin(update.effective_user.id):
@@ -671,8 +2216,7 @@ async def send_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         safe_message = escape_html(message_text.strip())
 
-        cursor.execute("SELECT user_id, username, first_name FROM users WHERE user_id=?", (user_id,))
-        user = cursor.fetchone()
+        user = await db.fetchone("SELECT user_id, username, first_name FROM users WHERE user_id=?", (user_id,))
         if not user:
             await update.message.reply_text(f"❌ المستخدم {user_id} غير مسجل في النظام")
             return
@@ -696,8 +2240,7 @@ async def send_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         error_msg = str(e)
         if "bot was blocked" in error_msg.lower():
             await update.message.reply_text(f"❌ فشل الإرسال: المستخدم حظر البوت")
-            cursor.execute("UPDATE users SET can_receive_broadcast=0 WHERE user_id=?", (user_id,))
-            conn.commit()
+            await db.execute("UPDATE users SET can_receive_broadcast=0 WHERE user_id=?", (user_id,))
         else:
             await update.message.reply_text(f"❌ خطأ في الإرسال: {error_msg}")
         logger.error(f"فشل إرسال رسالة فردية إلى {user_id}: {e}")
@@ -707,74 +2250,361 @@ async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ هذا الأمر متاح للمشرفين فقط")
         return
 
-    if not context.args:
+    replied = update.message.reply_to_message
+    if not context.args and not replied:
         await update.message.reply_text(
             "📢 <b>بث رسالة جماعية</b>\n\n"
             "الاستخدام:\n<code>/broadcast &lt;الرسالة&gt;</code>\n\n"
-            "مثال:\n<code>/broadcast مسابقة جديدة تبدأ بعد ساعة! 🚀</code>",
+            "مثال:\n<code>/broadcast مسابقة جديدة تبدأ بعد ساعة! 🚀</code>\n\n"
+            "🖼 لبث صورة أو رسالة منسقة: رد عليها بالأمر <code>/broadcast</code>",
             parse_mode="HTML"
         )
         return
 
-    message_text = " ".join(context.args).strip()
-    if not message_text:
-        await update.message.reply_text("❌ الرسالة فارغة!")
-        return
+    if context.args:
+        message_text = " ".join(context.args).strip()
+        if not message_text:
+            await update.message.reply_text("❌ الرسالة فارغة!")
+            return
 
-    if len(message_text) > 4000:
-        await update.message.reply_text("❌ الرسالة طويلة جدًا (الحد الأقصى 4000 حرف)")
-        return
+        if len(message_text) > 4000:
+            await update.message.reply_text("❌ الرسالة طويلة جدًا (الحد الأقصى 4000 حرف)")
+            return
+
+        payload = {"kind": "text", "text": message_text}
+        preview = escape_html(message_text[:100] + "..." if len(message_text) > 100 else message_text)
+    else:
+        message_text = replied.text or replied.caption or "📎 وسائط"
+        payload = {"kind": "copy", "from_chat_id": replied.chat_id, "message_id": replied.message_id}
+        preview = "📎 الرسالة التي رددت عليها (تُنسخ كما هي بتنسيقها ووسائطها)"
 
-    preview = message_text[:100] + "..." if len(message_text) > 100 else message_text
+    draft_id = await broadcast_drafts.put(payload | {"summary": message_text[:200]})
     keyboard = InlineKeyboardMarkup([
-        [InlineKeyboardButton("✅ تأكيد الإرسال", callback_data=f"confirm_broadcast|{message_text}")],
-        [InlineKeyboardButton("❌ إلغاء", callback_data="cancel_broadcast")]
+        [InlineKeyboardButton("✅ تأكيد الإرسال", callback_data=f"confirm_broadcast|{draft_id}")],
+        [InlineKeyboardButton("❌ إلغاء", callback_data=f"cancel_broadcast|{draft_id}")]
     ])
     
     await update.message.reply_text(
-        f"📢 <b>معاينة البث:</b>\n\n{escape_html(preview)}\n\n"
+        f"📢 <b>معاينة البث:</b>\n\n{preview}\n\n"
         f"هل تريد إرسال هذه الرسالة لجميع المستخدمين؟",
         reply_markup=keyboard,
         parse_mode="HTML"
     )
 
+# كل سطر في النسخة الاحتياطية سجل JSON مستقل: {"table": ..., "row": {...}}، والسطر الأول بيانات وصفية
+EXPORT_QUERIES = {
+    "users": "SELECT user_id, username, first_name, last_seen, can_receive_broadcast FROM users",
+    "referrals": "SELECT new_user, referrer, joined_at, counted FROM referrals",
+    "settings": "SELECT key, value FROM settings WHERE key NOT IN ('export_seq', 'restored_seq')",
+    "contest": "SELECT id, active, end_time, winners FROM contest",
+    "contest_scores": "SELECT contest_id, user_id, points FROM contest_scores",
+}
+
+def _stream_export(connection, path, compress, since=None):
+    """كتابة الجداول سطرًا سطرًا بدفعات fetchmany؛ الذاكرة محدودة بدفعة واحدة مهما كبرت القاعدة
+
+    مع since تُكتب فقط الصفوف المتغيرة بعد نقطة المرجع (الإعدادات والمسابقة تُنسخ كاملة لصغرها)
+    يعيد (عدد السجلات، رقم التسلسل الذي تمثله النسخة)
+    """
+    opener = gzip.open if compress else open
+    rows_written = 0
+    # معاملة قراءة واحدة: كل الجداول من نفس اللقطة
+    connection.execute("BEGIN")
+    try:
+        seq = connection.execute("SELECT value FROM change_seq WHERE id=1").fetchone()[0]
+        with opener(path, "wt", encoding="utf-8") as f:
+            metadata = {
+                "exported_at": datetime.now(timezone.utc).isoformat(),
+                "version": "3.1",
+                "channel": CHANNEL_USERNAME,
+                "mode": "full" if since is None else "delta",
+                "seq": seq,
+            }
+            if since is not None:
+                metadata["base_seq"] = since
+            f.write(json.dumps({"table": "metadata", "row": metadata}, ensure_ascii=False) + "\n")
+            for table, sql in EXPORT_QUERIES.items():
+                if since is not None and table in CHANGE_TRACKED:
+                    table_cursor = connection.execute(f"{sql} WHERE seq > ?", (since,))
+                else:
+                    table_cursor = connection.execute(sql)
+                columns = [desc[0] for desc in table_cursor.description]
+                while True:
+                    rows = table_cursor.fetchmany(EXPORT_CHUNK)
+                    if not rows:
+                        break
+                    f.writelines(
+                        json.dumps({"table": table, "row": dict(zip(columns, row))}, ensure_ascii=False, separators=(",", ":")) + "\n"
+                        for row in rows
+                    )
+                    rows_written += len(rows)
+    finally:
+        connection.execute("COMMIT")
+    return rows_written, seq
+
 async def export_data_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_admin(update.effective_user.id):
         await update.message.reply_text("❌ هذا الأمر متاح للمشرفين فقط")
         return
 
-    try:
-        data = {
-            "metadata": {
-                "exported_at": datetime.now(timezone.utc).isoformat(),
-                "version": "2.1",
-                "channel": CHANNEL_USERNAME
-            },
-            "users": [],
-            "referrals": [],
-            "settings": [],
-            "contest": []
-        }
-
-        for table in ["users", "referrals", "settings", "contest"]:
-            cursor.execute(f"SELECT * FROM {table}")
-            columns = [desc[0] for desc in cursor.description]
-            rows = cursor.fetchall()
-            data[table] = [dict(zip(columns, row)) for row in rows]
+    # /export [plain] [delta [رقم التسلسل]]: plain لملف غير مضغوط، delta للتغييرات منذ آخر تصدير
+    args = [arg.lower() for arg in (context.args or [])]
+    compress = "plain" not in args
+    since = None
+    if "delta" in args:
+        explicit = [int(arg) for arg in args if arg.isdigit()]
+        since = explicit[0] if explicit else settings_cache.get("export_seq")
+        if since is None:
+            await update.message.reply_text("❌ لا توجد نقطة مرجعية بعد - أنشئ نسخة كاملة أولًا بـ /export")
+            return
+        since = int(since)
 
-        filename = f"backup_{datetime.now(timezone.utc).strftime('%Y%m%d_%H%M%S')}.json"
-        with open(filename, "w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
+    kind = "delta" if since is not None else "backup"
+    filename = f"{kind}_{datetime.now(timezone.utc).strftime('%Y%m%d_%H%M%S')}.ndjson" + (".gz" if compress else "")
+    path = os.path.join(tempfile.gettempdir(), filename)
 
-        await update.message.reply_document(
-            document=open(filename, "rb"),
-            caption="✅ تم إنشاء نسخة احتياطية بنجاح"
-        )
-        os.remove(filename)
-        logger.info("تم تصدير البيانات بنجاح")
+    try:
+        started = time.monotonic()
+        rows_written, seq = await db.read(_stream_export, path, compress, since)
+        elapsed = max(time.monotonic() - started, 0.001)
+        size = os.path.getsize(path)
+
+        with open(path, "rb") as document:
+            await update.message.reply_document(
+                document=document,
+                filename=filename,
+                caption=(
+                    f"✅ تم إنشاء {'نسخة تفاضلية منذ #' + str(since) if since is not None else 'نسخة احتياطية'} بنجاح\n"
+                    f"📦 {rows_written} سجل | {size / 1024:.1f} KB | {rows_written / elapsed:.0f} سجل/ث\n"
+                    f"🔖 نقطة المرجع: #{seq}"
+                )
+            )
+        await set_setting("export_seq", seq)
+        logger.info(f"تم تصدير البيانات بنجاح ({kind}): {rows_written} سجل، {size} بايت، {rows_written / elapsed:.0f} سجل/ث")
     except Exception as e:
         logger.error(f"فشل التصدير: {e}")
         await update.message.reply_text(f"❌ خطأ في التصدير: {e}")
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+
+BACKUP_VERSIONS = ["1.1", "1.2", "1.3", "2.0", "2.1", "2.2", "3.0", "3.1"]
+BACKUP_EXTENSIONS = (".ndjson.gz", ".json.gz", ".ndjson", ".json")
+
+class LegacyBackupReader:
+    """قراءة تدريجية لصيغة JSON القديمة (1.1 - 2.2): يعيد (القسم، السجل) دون تحميل الملف كاملًا
+
+    يكفي هذا لبنية {"قسم": [سجلات], ...} التي كان يكتبها التصدير؛ كل سجل يُفك بـ raw_decode
+    """
+
+    def __init__(self, f, chunk_size=1 << 16):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+        self.sections = set()
+
+    def _fill(self):
+        chunk = self.f.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def _peek(self):
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in " \t\r\n":
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill():
+                raise ValueError("نهاية غير متوقعة لملف النسخة الاحتياطية")
+
+    def _next(self, expected):
+        char = self._peek()
+        if char not in expected:
+            raise ValueError(f"ملف JSON غير صالح: متوقع {expected} ووُجد {char!r}")
+        self.pos += 1
+        return char
+
+    def _value(self):
+        self._peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+                # قيمة تنتهي عند حد المخزن قد تكون مبتورة؛ نقرأ المزيد قبل قبولها
+                if end < len(self.buffer) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self._fill()
+
+    def __iter__(self):
+        self._next("{")
+        if self._peek() == "}":
+            return
+        while True:
+            section = self._value()
+            self._next(":")
+            self.sections.add(section)
+            if self._peek() == "[":
+                self.pos += 1
+                if self._peek() == "]":
+                    self.pos += 1
+                else:
+                    while True:
+                        yield section, self._value()
+                        if self._next(",]") == "]":
+                            break
+            else:
+                yield section, self._value()
+            if self._next(",}") == "}":
+                return
+
+def _iter_ndjson_backup(f):
+    for line in f:
+        if line.strip():
+            record = json.loads(line)
+            yield record["table"], record["row"]
+
+def _validate_user(user):
+    if not isinstance(user.get("user_id"), int) or user["user_id"] <= 0:
+        raise ValueError(f"بيانات مستخدم غير صالحة: {user}")
+    if (user.get("points") or 0) < 0:
+        raise ValueError("النقاط لا يمكن أن تكون سالبة")
+
+IMPORT_STATEMENTS = {
+    "users": "INSERT INTO users (user_id, username, first_name, last_seen, can_receive_broadcast) VALUES (?, ?, ?, ?, ?)",
+    "referrals": "INSERT INTO referrals (new_user, referrer, joined_at, counted) VALUES (?, ?, ?, ?)",
+    "settings": "INSERT INTO settings (key, value) VALUES (?, ?)",
+    "contest": "INSERT INTO contest (id, active, end_time, winners) VALUES (?, ?, ?, ?)",
+    "contest_scores": "INSERT INTO contest_scores (contest_id, user_id, points) VALUES (?, ?, ?)",
+    "legacy_points": "INSERT OR REPLACE INTO import_points (user_id, points) VALUES (?, ?)",
+}
+
+def _import_rows(table, row):
+    """تحويل سجل من النسخة الاحتياطية إلى صفوف إدراج: [(الجدول، القيم)]"""
+    if table == "users":
+        _validate_user(row)
+        rows = [("users", (
+            row["user_id"],
+            sanitize_username(row.get("username")),
+            escape_html(row.get("first_name", "مستخدم"))[:50],
+            row.get("last_seen") or datetime.now(timezone.utc).isoformat(),
+            row.get("can_receive_broadcast", 1)
+        ))]
+        # النسخ السابقة لـ 2.2 تحمل النقاط في المستخدمين
+        if row.get("points"):
+            rows.append(("legacy_points", (row["user_id"], row["points"])))
+        return rows
+    if table == "referrals":
+        return [("referrals", (row["new_user"], row["referrer"], row["joined_at"], row["counted"]))]
+    if table == "settings":
+        return [("settings", (row["key"], row["value"]))]
+    if table == "contest":
+        return [("contest", (row["id"], row["active"], row["end_time"], row["winners"]))]
+    if table == "contest_scores":
+        return [("contest_scores", (row["contest_id"], row["user_id"], max(0, row["points"])))]
+    return []
+
+def _stream_import(connection, path):
+    """تحميل النسخة الاحتياطية في معاملة واحدة: قراءة ودفعات executemany، والفهارس تُبنى مرة في النهاية
+
+    النسخة التفاضلية (mode=delta) تُطبَّق فوق البيانات الحالية دون حذف ولا إعادة بناء للفهارس،
+    بشرط أن تقع آخر نسخة مستوردة بين base_seq و seq: لا فجوة قبلها، ولا نسخة أقدم تعيد الصفوف إلى قيم سابقة
+    """
+    opener = gzip.open if path.endswith(".gz") else open
+    counts = {}
+    with opener(path, "rt", encoding="utf-8") as f:
+        records = _iter_ndjson_backup(f) if ".ndjson" in path else LegacyBackupReader(f)
+        records_iter = iter(records)
+
+        first = next(records_iter, None)
+        if not first or first[0] != "metadata":
+            raise ValueError("هيكل الملف غير صالح - البيانات الوصفية مفقودة")
+        metadata = first[1]
+        version = metadata.get("version", "1.0")
+        if version not in BACKUP_VERSIONS:
+            raise ValueError(f"إصدار النسخة الاحتياطية ({version}) غير متوافق")
+        delta = metadata.get("mode") == "delta"
+
+        if not connection.in_transaction:
+            connection.execute("BEGIN")
+        if delta:
+            restored = connection.execute("SELECT value FROM settings WHERE key='restored_seq'").fetchone()
+            base_seq, seq = metadata["base_seq"], metadata["seq"]
+            if restored is None:
+                raise ValueError(
+                    f"النسخة التفاضلية (#{base_seq} ← #{seq}) تتطلب بيانات من نسخة مستوردة - استورد النسخة الأساسية أولًا"
+                )
+            restored = int(restored[0])
+            if restored < base_seq:
+                raise ValueError(
+                    f"النسخة التفاضلية تبدأ من #{base_seq} والبيانات الحالية عند #{restored} - استورد النسخ السابقة أولًا"
+                )
+            if restored >= seq:
+                raise ValueError(
+                    f"النسخة التفاضلية تنتهي عند #{seq} والبيانات الحالية عند #{restored} - "
+                    f"النسخة أقدم أو مطبقة مسبقًا وتطبيقها يعيد صفوفًا إلى قيم سابقة"
+                )
+        else:
+            for table in ["users", "referrals", "settings", "contest", "contest_scores"]:
+                connection.execute(f"DELETE FROM {table}")
+            for name in DATA_INDEXES:
+                connection.execute(f"DROP INDEX IF EXISTS {name}")
+        connection.execute("CREATE TEMP TABLE IF NOT EXISTS import_points (user_id INTEGER PRIMARY KEY, points INTEGER)")
+        connection.execute("DELETE FROM import_points")
+        # الصفوف المستوردة لا تُختم بتسلسل محلي: هي جزء من النسخة الأساسية لهذه القاعدة
+        for name in CHANGE_TRIGGERS:
+            connection.execute(f"DROP TRIGGER IF EXISTS {name}")
+
+        statements = {
+            table: sql.replace("INSERT INTO", "INSERT OR REPLACE INTO", 1) if delta else sql
+            for table, sql in IMPORT_STATEMENTS.items()
+        }
+        batches = {table: [] for table in IMPORT_STATEMENTS}
+        def flush(table):
+            connection.executemany(statements[table], batches[table])
+            counts[table] = counts.get(table, 0) + len(batches[table])
+            batches[table].clear()
+
+        for table, row in records_iter:
+            for target, values in _import_rows(table, row):
+                batches[target].append(values)
+                if len(batches[target]) >= IMPORT_BATCH:
+                    flush(target)
+        for table in batches:
+            if batches[table]:
+                flush(table)
+
+        if isinstance(records, LegacyBackupReader) and not delta:
+            missing = {"users", "referrals", "settings", "contest"} - records.sections
+            if missing:
+                raise ValueError(f"هيكل الملف غير صالح - مفقود أقسام أساسية: {', '.join(sorted(missing))}")
+
+    connection.execute("INSERT OR IGNORE INTO settings VALUES ('score_period', 1)")
+    if not counts.get("contest_scores"):
+        connection.execute(
+            "INSERT INTO contest_scores (contest_id, user_id, points) SELECT ?, user_id, points FROM import_points WHERE points > 0",
+            (_score_period(connection),)
+        )
+    connection.execute("DELETE FROM import_points")
+    if "seq" in metadata:
+        connection.execute(
+            "INSERT OR REPLACE INTO settings VALUES ('restored_seq', ?)", (metadata["seq"],)
+        )
+    for index_sql in DATA_INDEXES.values():
+        connection.execute(index_sql)
+    for trigger_sql in CHANGE_TRIGGERS.values():
+        connection.execute(trigger_sql)
+    counts.pop("legacy_points", None)
+    return counts
 
 async def import_data_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_admin(update.effective_user.id):
@@ -785,80 +2615,39 @@ async def import_data_command(update: Update, context: ContextTypes.DEFAULT_TYPE
         await update.message.reply_text("❌ الرجاء الرد على ملف JSON صالح")
         return
 
-    if not update.message.reply_to_message.document.file_name.endswith('.json'):
-        await update.message.reply_text("❌ الملف يجب أن يكون بصيغة JSON")
+    file_name = update.message.reply_to_message.document.file_name or ""
+    suffix = next((ext for ext in BACKUP_EXTENSIONS if file_name.endswith(ext)), None)
+    if not suffix:
+        await update.message.reply_text("❌ الملف يجب أن يكون بصيغة JSON أو NDJSON")
         return
 
+    path = os.path.join(tempfile.gettempdir(), f"import_{update.effective_user.id}_{int(time.time())}{suffix}")
+
     try:
         file = await update.message.reply_to_message.document.get_file()
-        await file.download_to_drive("import_temp.json")
-
-        with open("import_temp.json", "r", encoding="utf-8") as f:
-            data = json.load(f)
-
-        required_keys = {"users", "referrals", "settings", "contest", "metadata"}
-        if not all(key in data for key in required_keys):
-            raise ValueError("هيكل الملف غير صالح - مفقود أقسام أساسية")
-
-        version = data["metadata"].get("version", "1.0")
-        if version not in ["1.1", "1.2", "1.3", "2.0", "2.1"]:
-            raise ValueError(f"إصدار النسخة الاحتياطية ({version}) غير متوافق")
-
-        for user in data["users"]:
-            if not isinstance(user.get("user_id"), int) or user["user_id"] <= 0:
-                raise ValueError(f"بيانات مستخدم غير صالحة: {user}")
-            if user.get("points", 0) < 0:
-                raise ValueError("النقاط لا يمكن أن تكون سالبة")
-
-        conn.execute("BEGIN TRANSACTION")
-        try:
-            for table in ["users", "referrals", "settings", "contest"]:
-                cursor.execute(f"DELETE FROM {table}")
-
-            for user in data["users"]:
-                cursor.execute(
-                    "INSERT INTO users (user_id, username, first_name, points, last_seen, can_receive_broadcast) VALUES (?, ?, ?, ?, ?, ?)",
-                    (
-                        user["user_id"],
-                        sanitize_username(user.get("username")),
-                        escape_html(user.get("first_name", "مستخدم"))[:50],
-                        max(0, user.get("points", 0)),
-                        user.get("last_seen") or datetime.now(timezone.utc).isoformat(),
-                        user.get("can_receive_broadcast", 1)
-                    )
-                )
-
-            for ref in data["referrals"]:
-                cursor.execute(
-                    "INSERT INTO referrals (new_user, referrer, joined_at, counted) VALUES (?, ?, ?, ?)",
-                    (ref["new_user"], ref["referrer"], ref["joined_at"], ref["counted"])
-                )
-
-            for setting in data["settings"]:
-                cursor.execute(
-                    "INSERT INTO settings (key, value) VALUES (?, ?)",
-                    (setting["key"], setting["value"])
-                )
-
-            for contest in data["contest"]:
-                cursor.execute(
-                    "INSERT INTO contest (id, active, end_time, winners) VALUES (?, ?, ?, ?)",
-                    (contest["id"], contest["active"], contest["end_time"], contest["winners"])
-                )
-
-            conn.commit()
-            logger.info("تم استيراد البيانات بنجاح")
-            await update.message.reply_text("✅ تم الاستيراد بنجاح مع التحقق الأمني")
-        except Exception as e:
-            conn.rollback()
-            raise e
+        await file.download_to_drive(path)
+
+        started = time.monotonic()
+        counts = await db.transaction(_stream_import, path)
+        elapsed = max(time.monotonic() - started, 0.001)
+
+        await load_settings()
+        await load_leaderboard()
+        await rebuild_schedule()
+        await contest_timer.rearm_from_db()
+        total = sum(counts.values())
+        logger.info(f"تم استيراد البيانات بنجاح: {total} سجل في {elapsed:.1f} ث ({counts})")
+        await update.message.reply_text(
+            f"✅ تم الاستيراد بنجاح مع التحقق الأمني\n"
+            f"📦 {total} سجل في {elapsed:.1f} ث ({total / elapsed:.0f} سجل/ث)"
+        )
 
     except Exception as e:
         logger.error(f"فشل الاستيراد الآمن: {e}")
         await update.message.reply_text(f"❌ خطأ في الاستيراد الآمن: {e}")
     finally:
-        if os.path.exists("import_temp.json"):
-            os.remove("import_temp.json")
+        if os.path.exists(path):
+            os.remove(path)
 
 # ================= MESSAGE HANDLERS =================
 async def handle_menu_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -871,48 +2660,34 @@ async def handle_menu_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE
     if text == "👤 ملفي":
         await me(update, context)
     elif text == "🔗 رابط الإحالة":
-        bot_username = context.bot.username
-        referral_link = f"https://t.me/{bot_username}?start={user_id}"
+        referral_link = referral_link_for(context.bot.username, user_id)
         
         await update.message.reply_text(
-            f"🔗 <b>رابط الإحالة الخاص بك:</b>\n<code>{referral_link}</code>\n\n"
-            f"🎯 شاركه مع أصدقائك لجمع النقاط!",
+            REFERRAL_LINK_TEMPLATE.format(link=referral_link),
             parse_mode="HTML",
             reply_markup=referral_keyboard(referral_link)
         )
     elif text == "🏆 الترتيب":
         await top_command(update, context)
     elif text == "🎯 حالة المسابقة":
-        cursor.execute("SELECT active, end_time, winners FROM contest WHERE id=1")
-        contest = cursor.fetchone()
+        contest = await db.fetchone("SELECT active, end_time, winners FROM contest WHERE id=1")
         
         if not contest or contest[0] == 0:
-            msg = "📭 <b>لا توجد مسابقة نشطة حالياً</b>\n\n🚀 ابدأ مسابقة جديدة لجمع النقاط!"
+            msg = NO_CONTEST_TEXT
             keyboard = contest_status_keyboard(False)
         else:
             end_time = datetime.fromisoformat(contest[1].replace("Z", "+00:00"))
             remaining = max(0, int((end_time - datetime.now(timezone.utc)).total_seconds() / 60))
-            msg = (
-                f"🎯 <b>مسابقة نشطة!</b>\n\n"
-                f"⏰ الوقت المتبقي: <b>{remaining}</b> دقيقة\n"
-                f"🏆 عدد الفائزين: <b>{contest[2]}</b>\n"
-                f"💎 النقاط لكل إحالة: <b>{get_setting('points')}</b>"
-            )
+            msg = ACTIVE_CONTEST_TEMPLATE.format(remaining=remaining, winners=contest[2], points=get_setting("points"))
             keyboard = contest_status_keyboard(True)
         
         await update.message.reply_text(msg, parse_mode="HTML", reply_markup=keyboard)
     elif text == "ℹ️ كيفية الاستخدام":
         await update.message.reply_text(
-            "🎯 <b>كيفية استخدام البوت:</b>\n\n"
-            f"1️⃣ اشترك أولاً في القناة: {CHANNEL_USERNAME}\n"
-            "2️⃣ اضغط على <b>رابط الإحالة</b> وشاركه مع أصدقائك\n"
-            f"3️⃣ كل صديق يشترك عبر رابطك يضيف <b>{get_setting('points')}</b> نقطة لحسابك بعد <b>{get_setting('delay')}</b> دقيقة\n"
-            "4️⃣ تصدر الترتيب واربح الجوائز في المسابقات! 🏆",
+            help_text(get_setting("points"), get_setting("delay")),
             parse_mode="HTML",
             disable_web_page_preview=True,
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("عرض القناة 📢", url=f"https://t.me/{CHANNEL_USERNAME.replace('@', '')}")]
-            ])
+            reply_markup=channel_keyboard()
         )
     elif text == "👑 لوحة التحكم":
         if is_admin(user_id):
@@ -920,481 +2695,601 @@ async def handle_menu_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE
         else:
             await update.message.reply_text("❌ هذا القسم متاح للمشرفين فقط")
 
-async def unified_callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    user_id = query.from_user.id
-    
-    # ✅ الإجابة الفورية لتجنب مؤشر التحميل الأبدي
-    try:
-        await query.answer()
-    except Exception as e:
-        logger.warning(f"فشل الإجابة على الكول باك: {e}")
-    
-    try:
-        data = query.data
-        
-        # معالجة نسخ الرابط
-        if data == "copy_link_info":
-            await query.answer(
-                "✅ للنسخ: اضغط مطولًا على الرابط أعلاه واختر 'نسخ الرابط'",
-                show_alert=True
-            )
-            return
-        
-        # العودة للقائمة الرئيسية
-        if data == "main_menu":
-            await query.message.reply_text(
-                "🏠 <b>القائمة الرئيسية</b>",
-                reply_markup=main_menu_keyboard(is_admin=is_admin(user_id)),
-                parse_mode="HTML"
-            )
-            try:
-                await query.message.delete()
-            except:
-                pass
-            return
-        
-        # عرض رابط الإحالة
-        if data.startswith("show_link_"):
-            target_user_id = int(data.split("_")[2])
-            cursor.execute("SELECT points FROM users WHERE user_id=?", (target_user_id,))
-            points = cursor.fetchone()[0] or 0
-            
-            bot_username = context.bot.username
-            referral_link = f"https://t.me/{bot_username}?start={target_user_id}"  # ✅ رابط صحيح
-            
-            await query.message.reply_text(
-                f"🔗 <b>رابط الإحالة:</b>\n<code>{referral_link}</code>\n\n💎 <b>نقاطك:</b> {points}",
-                parse_mode="HTML",
-                reply_markup=referral_keyboard(referral_link)
-            )
-            try:
-                await query.message.delete()
-            except:
-                pass
-            return
-        
-        # عرض الترتيب
-        if data == "show_ranking":
-            cursor.execute("""
-                SELECT username, first_name, points 
-                FROM users 
-                WHERE points > 0 
-                ORDER BY points DESC 
-                LIMIT 10
-            """)
-            rows = cursor.fetchall()
-            
-            text = "🏆 <b>العشرة الأوائل:</b>\n\n" if rows else "📭 لا توجد نقاط بعد"
-            for i, (username, first_name, points) in enumerate(rows, 1):
-                display_name = f"@{sanitize_username(username)}" if username else escape_html(first_name or f"مستخدم {i}")
-                medal = "🥇" if i == 1 else "🥈" if i == 2 else "🥉" if i == 3 else ""
-                text += f"{medal} {i}. {display_name} | {points} نقطة\n"
-            
-            await query.message.reply_text(
-                text,
-                parse_mode="HTML",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("⬅️ رجوع", callback_data="main_menu")]
-                ])
-            )
-            return
-        
-        # حالة المسابقة
-        if data == "show_contest_status":
-            cursor.execute("SELECT active, end_time, winners FROM contest WHERE id=1")
-            contest = cursor.fetchone()
-            
-            if not contest or contest[0] == 0:
-                msg = "📭 <b>لا توجد مسابقة نشطة</b>"
-                keyboard = contest_status_keyboard(False)
-            else:
-                end_time = datetime.fromisoformat(contest[1].replace("Z", "+00:00"))
-                remaining = max(0, int((end_time - datetime.now(timezone.utc)).total_seconds() / 60))
-                msg = f"🎯 <b>مسابقة نشطة!</b>\n⏰ متبقي: <b>{remaining}</b> دقيقة\n🏆 فائزون: <b>{contest[2]}</b>"
-                keyboard = contest_status_keyboard(True)
-            
-            await query.message.reply_text(msg, parse_mode="HTML", reply_markup=keyboard)
-            return
-        
-        # بدء مسابقة جديدة (من لوحة التحكم)
-        if data == "start_new_contest":
-            if not is_admin(user_id):
-                await query.answer("❌ هذا الإجراء متاح للمشرفين فقط", show_alert=True)
-                return
-            await query.message.reply_text(
-                "🎯 <b>بدء مسابقة جديدة</b>\n\nاختر الإعدادات السريعة:",
-                reply_markup=start_contest_keyboard(),
-                parse_mode="HTML"
-            )
-            try:
-                await query.message.delete()
-            except:
-                pass
-            return
-        
-        # إنهاء المسابقة (تحذير أولي)
-        if data == "confirm_end_contest_warning":
-            if not is_admin(user_id):
-                await query.answer("❌ هذا الإجراء متاح للمشرفين فقط", show_alert=True)
-                return
-                
-            cursor.execute("SELECT active, winners FROM contest WHERE id=1")
-            contest = cursor.fetchone()
-            if not contest or contest[0] == 0:
-                await query.answer("لا توجد مسابقة نشطة", show_alert=True)
-                return
-                
-            # عرض معاينة الترتيب
-            cursor.execute("""
-                SELECT username, first_name, points 
-                FROM users 
-                WHERE points > 0 
-                ORDER BY points DESC 
-                LIMIT 10
-            """)
-            top_users = cursor.fetchall()
-            
-            preview = "📊 <b>الترتيب الحالي (أعلى 10):</b>\n\n"
-            for i, (username, first_name, points) in enumerate(top_users, 1):
-                display_name = f"@{sanitize_username(username)}" if username else escape_html(first_name or f"مستخدم #{i}")
-                preview += f"{i}. {display_name} | {points} نقطة\n"
-            if not top_users:
-                preview = "📭 لا توجد إحالات مسجلة بعد"
-            
-            await query.message.reply_text(
-                f"🛑 <b>تأكيد إنهاء المسابقة</b>\n\n"
-                f"هل أنت متأكد من إنهاء المسابقة يدويًا؟\n"
-                f"سيتم اختيار الفائزين فورًا وإعلانهم.\n\n"
-                f"🏆 سيتم اختيار <b>{contest[1]}</b> فائزين:\n{preview}\n\n"
-                f"⚠️ لا يمكن التراجع بعد التأكيد!",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("✅ نعم، أنهِ الآن", callback_data="confirm_end_contest")],
-                    [InlineKeyboardButton("❌ إلغاء", callback_data="cancel_end_contest")]
-                ]),
-                parse_mode="HTML"
-            )
-            try:
-                await query.message.delete()
-            except:
-                pass
-            return
-        
-        # تأكيد إنهاء المسابقة
-        if data == "confirm_end_contest":
-            if not is_admin(user_id):
-                await query.answer("❌ هذا الإجراء متاح للمشرفين فقط", show_alert=True)
-                return
-                
-            await query.edit_message_text("🔄 جاري إنهاء المسابقة وإعلان الفائزين...")
-            success, result = await end_contest(context.application, force_manual=True)
-            if success:
-                summary = "✅ <b>تم إنهاء المسابقة بنجاح!</b>\n\n🏆 الفائزون:\n"
-                for w in result:
-                    medal = "🥇" if w['rank'] == 1 else "🥈" if w['rank'] == 2 else "🥉" if w['rank'] == 3 else "🏅"
-                    summary += f"{medal} {w['rank']}. {w['display_name']} ({w['points']} نقطة)\n"
-                await query.edit_message_text(summary, parse_mode="HTML")
-            else:
-                await query.edit_message_text(f"❌ فشل إنهاء المسابقة:\n{result}")
-            return
-        
-        # إلغاء العمليات
-        if data in ["cancel_end_contest", "cancel_contest"]:
-            await query.edit_message_text("❌ تم إلغاء العملية")
-            return
-        
-        # بدء مسابقة سريعة - ✅ الإصلاح الرئيسي هنا
-        if data.startswith("quick_contest_"):
-            if not is_admin(user_id):
-                await query.answer("❌ هذا الإجراء متاح للمشرفين فقط", show_alert=True)
-                return
-                
-            parts = data.replace("quick_contest_", "").split("_")
-            minutes, winners = int(parts[0]), int(parts[1])
-            
-            # ✅ استخدام الدوال الآمنة للكول باك
-            await _create_contest_db(minutes, winners)
-            contest_msg, keyboard = _get_contest_start_message(minutes, winners)
-            
-            # ✅ استخدام query.message.reply_text بدلاً من update.effective_message
-            await query.message.reply_text(
-                contest_msg,
-                parse_mode="HTML",
-                reply_markup=keyboard
-            )
-            
-            try:
-                await query.message.delete()
-            except:
-                pass
-            return
-        
-        # عرض الترتيب الكامل (للمشرفين)
-        if data == "show_full_ranking":
-            if not is_admin(user_id):
-                await query.answer("❌ هذا الإجراء متاح للمشرفين فقط", show_alert=True)
-                return
-                
-            cursor.execute("""
-                SELECT username, first_name, points 
-                FROM users 
-                WHERE points > 0 
-                ORDER BY points DESC 
-                LIMIT 50
-            """)
-            rows = cursor.fetchall()
-            
-            if not rows:
-                text = "📭 لا توجد نقاط مسجلة بعد"
-            else:
-                text = "🏆 <b>الترتيب الكامل (أعلى 50):</b>\n\n"
-                for i, (username, first_name, points) in enumerate(rows, 1):
-                    display_name = f"@{sanitize_username(username)}" if username else escape_html(first_name or f"مستخدم {i}")
-                    medal = "🥇" if i == 1 else "🥈" if i == 2 else "🥉" if i == 3 else ""
-                    text += f"{medal} {i}. {display_name} | {points}\n"
-            
-            await query.message.reply_text(
-                text,
-                parse_mode="HTML",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("⬅️ رجوع", callback_data="main_menu")]
-                ])
-            )
-            return
-        
-        # عرض الترتيب الحالي للمسابقة
-        if data == "show_contest_ranking":
-            cursor.execute("""
-                SELECT username, first_name, points 
-                FROM users 
-                WHERE points > 0 
-                ORDER BY points DESC 
-                LIMIT 10
-            """)
-            rows = cursor.fetchall()
-            
-            text = "📊 <b>الترتيب الحالي للمسابقة:</b>\n\n" if rows else "📭 لا توجد نقاط بعد"
-            for i, (username, first_name, points) in enumerate(rows, 1):
-                display_name = f"@{sanitize_username(username)}" if username else escape_html(first_name or f"مستخدم {i}")
-                medal = "🥇" if i == 1 else "🥈" if i == 2 else "🥉" if i == 3 else ""
-                text += f"{medal} {i}. {display_name} | {points}\n"
-            
-            await query.message.reply_text(
-                text,
-                parse_mode="HTML",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("⬅️ رجوع", callback_data="main_menu")]
-                ])
-            )
-            return
-        
-        # إعدادات النقاط
-        if data == "settings_points":
-            if not is_admin(user_id):
-                await query.answer("❌ هذا الإجراء متاح للمشرفين فقط", show_alert=True)
-                return
-                
-            current = get_setting("points")
-            await query.message.reply_text(
-                f"⚙️ <b>إعدادات النقاط الحالية:</b> {current}\n\n"
-                f"للتغيير، استخدم الأمر:\n<code>/setpoints &lt;القيمة&gt;</code>",
-                parse_mode="HTML"
-            )
-            try:
-                await query.message.delete()
-            except:
-                pass
-            return
-        
-        # إعدادات التأخير
-        if data == "settings_delay":
-            if not is_admin(user_id):
-                await query.answer("❌ هذا الإجراء متاح للمشرفين فقط", show_alert=True)
-                return
-                
-            current = get_setting("delay")
-            await query.message.reply_text(
-                f"⏱️ <b>إعدادات التأخير الحالية:</b> {current} دقيقة\n\n"
-                f"للتغيير، استخدم الأمر:\n<code>/setdelay &lt;القيمة&gt;</code>",
-                parse_mode="HTML"
-            )
-            try:
-                await query.message.delete()
-            except:
-                pass
-            return
-        
-        # قائمة البث
-        if data == "broadcast_menu":
-            if not is_admin(user_id):
-                await query.answer("❌ هذا الإجراء متاح للمشرفين فقط", show_alert=True)
-                return
-                
-            await query.message.reply_text(
-                "📢 <b>بث رسالة جماعية</b>\n\n"
-                f"لإرسال بث، استخدم الأمر:\n<code>/broadcast &lt;الرسالة&gt;</code>\n\n"
-                "مثال:\n<code>/broadcast مسابقة جديدة تبدأ بعد ساعة! 🚀</code>",
-                parse_mode="HTML"
-            )
-            try:
-                await query.message.delete()
-            except:
-                pass
-            return
-        
-        # قائمة الرسائل الفردية
-        if data == "send_menu":
-            if not is_admin(user_id):
-                await query.answer("❌ هذا الإجراء متاح للمشرفين فقط", show_alert=True)
-                return
-                
-            await query.message.reply_text(
-                "✉️ <b>إرسال رسالة فردية</b>\n\n"
-                f"لإرسال رسالة، استخدم الأمر:\n<code>/send &lt;user_id&gt; &lt;الرسالة&gt;</code>\n\n"
-                "مثال:\n<code>/send 123456789 مرحباً! تم قبول إحالتك ✅</code>",
-                parse_mode="HTML"
-            )
-            try:
-                await query.message.delete()
-            except:
-                pass
-            return
-        
-        # قائمة النسخ الاحتياطي
-        if data == "backup_menu":
-            if not is_admin(user_id):
-                await query.answer("❌ هذا الإجراء متاح للمشرفين فقط", show_alert=True)
-                return
-                
-            await query.message.reply_text(
-                "💾 <b>النسخ الاحتياطي</b>\n\n"
-                f"لإنشاء نسخة احتياطية، استخدم الأمر:\n<code>/export</code>\n\n"
-                "سيتم إرسال ملف JSON يحتوي على جميع البيانات.",
-                parse_mode="HTML"
-            )
-            try:
-                await query.message.delete()
-            except:
-                pass
+async def channel_member_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """إبطال نتيجة العضوية المخزنة عند انضمام مستخدم للقناة أو مغادرتها"""
+    member_update = update.chat_member
+    if not member_update or not member_update.chat.username:
+        return
+    if f"@{member_update.chat.username}".lower() != CHANNEL_USERNAME.lower():
+        return
+    membership_cache.invalidate(member_update.new_chat_member.user.id)
+
+# ================= CALLBACK ROUTER =================
+class CallbackRouter:
+    """توجيه أزرار الكول باك: قاموس للمطابقة التامة O(1) وشجرة بادئات (trie) للأزرار ذات المعاملات
+
+    يُحدَّد المعالج مرة واحدة لكل تحديث، ويُسجَّل زمن تنفيذ كل مسار
+    """
+
+    def __init__(self):
+        self._exact = {}
+        self._trie = {}
+        self.stats = {}
+
+    def route(self, *keys):
+        def register(handler):
+            for key in keys:
+                self._exact[key] = (key, handler)
+            return handler
+        return register
+
+    def prefix(self, *prefixes):
+        def register(handler):
+            for prefix in prefixes:
+                node = self._trie
+                for char in prefix:
+                    node = node.setdefault(char, {})
+                node[None] = (f"{prefix}*", handler)
+            return handler
+        return register
+
+    def resolve(self, data):
+        """المطابقة التامة أولًا، ثم أطول بادئة مسجلة"""
+        route = self._exact.get(data)
+        if route:
+            return route
+        node, match = self._trie, None
+        for char in data:
+            node = node.get(char)
+            if node is None:
+                break
+            match = node.get(None, match)
+        return match
+
+    def _record(self, name, elapsed):
+        entry = self.stats.get(name)
+        if entry is None:
+            entry = self.stats[name] = [0, 0.0, 0.0]
+        entry[0] += 1
+        entry[1] += elapsed
+        entry[2] = max(entry[2], elapsed)
+        CALLBACK_SECONDS.observe(elapsed, name)
+
+    async def dispatch(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        query = update.callback_query
+
+        # ✅ الإجابة الفورية لتجنب مؤشر التحميل الأبدي
+        try:
+            await query.answer()
+        except Exception as e:
+            logger.warning(f"فشل الإجابة على الكول باك: {e}")
+
+        data = query.data or ""
+        route = self.resolve(data)
+        if route is None:
+            logger.warning(f"كول باك غير معروف: {data[:64]}")
             return
-        
-        # قائمة الاستيراد
-        if data == "import_menu":
-            if not is_admin(user_id):
-                await query.answer("❌ هذا الإجراء متاح للمشرفين فقط", show_alert=True)
-                return
-                
-            await query.message.reply_text(
-                "🔄 <b>استيراد البيانات</b>\n\n"
-                "1. قم بتصدير ملف احتياطي سابق (باستخدام /export)\n"
-                "2. أرسل الملف هنا في المحادثة\n"
-                "3. رد على الملف بأمر:\n<code>/import</code>",
-                parse_mode="HTML"
-            )
+
+        name, handler = route
+        started = time.perf_counter()
+        try:
+            await handler(query, context, data)
+        except Exception as e:
+            logger.error(f"خطأ في معالج الكول باك ({name}): {e}")
             try:
-                await query.message.delete()
+                await query.answer(f"❌ حدث خطأ: {str(e)[:50]}", show_alert=True)
             except:
                 pass
-            return
+        finally:
+            self._record(name, time.perf_counter() - started)
 
-    except Exception as e:
-        logger.error(f"خطأ في معالج الكول باك: {e}")
-        try:
-            await query.answer(f"❌ حدث خطأ: {str(e)[:50]}", show_alert=True)
-        except:
-            pass
+callback_router = CallbackRouter()
 
-async def broadcast_callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
-    
-    if query.data == "cancel_broadcast":
-        await query.edit_message_text("❌ تم إلغاء عملية البث")
+# معالجة نسخ الرابط
+@callback_router.route("copy_link_info")
+async def _cb_copy_link_info(query, context, data):
+    await query.answer(
+        "✅ للنسخ: اضغط مطولًا على الرابط أعلاه واختر 'نسخ الرابط'",
+        show_alert=True
+    )
+
+# العودة للقائمة الرئيسية
+@callback_router.route("main_menu")
+async def _cb_main_menu(query, context, data):
+    user_id = query.from_user.id
+    await query.message.reply_text(
+        "🏠 <b>القائمة الرئيسية</b>",
+        reply_markup=main_menu_keyboard(is_admin=is_admin(user_id)),
+        parse_mode="HTML"
+    )
+    try:
+        await query.message.delete()
+    except:
+        pass
+
+# عرض رابط الإحالة
+@callback_router.prefix("show_link_")
+async def _cb_show_link(query, context, data):
+    target_user_id = int(data.split("_")[2])
+    points = leaderboard.points(target_user_id)
+
+    referral_link = referral_link_for(context.bot.username, target_user_id)
+
+    await query.message.reply_text(
+        f"🔗 <b>رابط الإحالة:</b>\n<code>{referral_link}</code>\n\n💎 <b>نقاطك:</b> {points}",
+        parse_mode="HTML",
+        reply_markup=referral_keyboard(referral_link)
+    )
+    try:
+        await query.message.delete()
+    except:
+        pass
+
+# عرض الترتيب
+@callback_router.route("show_ranking")
+async def _cb_show_ranking(query, context, data):
+    text = leaderboard.render(10, "🏆 <b>العشرة الأوائل:</b>\n\n", "📭 لا توجد نقاط بعد")
+
+    await query.message.reply_text(
+        text,
+        parse_mode="HTML",
+        reply_markup=back_keyboard()
+    )
+
+# حالة المسابقة
+@callback_router.route("show_contest_status")
+async def _cb_show_contest_status(query, context, data):
+    contest = await db.fetchone("SELECT active, end_time, winners FROM contest WHERE id=1")
+
+    if not contest or contest[0] == 0:
+        msg = "📭 <b>لا توجد مسابقة نشطة</b>"
+        keyboard = contest_status_keyboard(False)
+    else:
+        end_time = datetime.fromisoformat(contest[1].replace("Z", "+00:00"))
+        remaining = max(0, int((end_time - datetime.now(timezone.utc)).total_seconds() / 60))
+        msg = f"🎯 <b>مسابقة نشطة!</b>\n⏰ متبقي: <b>{remaining}</b> دقيقة\n🏆 فائزون: <b>{contest[2]}</b>"
+        keyboard = contest_status_keyboard(True)
+
+    await query.message.reply_text(msg, parse_mode="HTML", reply_markup=keyboard)
+
+# بدء مسابقة جديدة (من لوحة التحكم)
+@callback_router.route("start_new_contest")
+async def _cb_start_new_contest(query, context, data):
+    user_id = query.from_user.id
+    if not is_admin(user_id):
+        await query.answer("❌ هذا الإجراء متاح للمشرفين فقط", show_alert=True)
         return
+    await query.message.reply_text(
+        "🎯 <b>بدء مسابقة جديدة</b>\n\nاختر الإعدادات السريعة:",
+        reply_markup=start_contest_keyboard(),
+        parse_mode="HTML"
+    )
+    try:
+        await query.message.delete()
+    except:
+        pass
 
-    if query.data.startswith("confirm_broadcast|"):
-        if not is_admin(query.from_user.id):
-            await query.answer("❌ هذا الإجراء متاح للمشرفين فقط", show_alert=True)
-            return
-            
-        message_text = query.data.split("|", 1)[1]
-        safe_message = escape_html(message_text.strip())
+# إنهاء المسابقة (تحذير أولي)
+@callback_router.route("confirm_end_contest_warning")
+async def _cb_confirm_end_contest_warning(query, context, data):
+    user_id = query.from_user.id
+    if not is_admin(user_id):
+        await query.answer("❌ هذا الإجراء متاح للمشرفين فقط", show_alert=True)
+        return
 
-        cursor.execute("SELECT user_id FROM users WHERE can_receive_broadcast=1")
-        users = cursor.fetchall()
-        total = len(users)
-        
-        status_msg = await query.edit_message_text(
-            f"📤 جاري إرسال البث إلى {total} مستخدم..."
+    contest = await db.fetchone("SELECT active, winners FROM contest WHERE id=1")
+    if not contest or contest[0] == 0:
+        await query.answer("لا توجد مسابقة نشطة", show_alert=True)
+        return
+
+    # عرض معاينة الترتيب
+    preview = leaderboard.render(
+        10, "📊 <b>الترتيب الحالي (أعلى 10):</b>\n\n", "📭 لا توجد إحالات مسجلة بعد", medals=False
+    )
+
+    await query.message.reply_text(
+        f"🛑 <b>تأكيد إنهاء المسابقة</b>\n\n"
+        f"هل أنت متأكد من إنهاء المسابقة يدويًا؟\n"
+        f"سيتم اختيار الفائزين فورًا وإعلانهم.\n\n"
+        f"🏆 سيتم اختيار <b>{contest[1]}</b> فائزين:\n{preview}\n\n"
+        f"⚠️ لا يمكن التراجع بعد التأكيد!",
+        reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton("✅ نعم، أنهِ الآن", callback_data="confirm_end_contest")],
+            [InlineKeyboardButton("❌ إلغاء", callback_data="cancel_end_contest")]
+        ]),
+        parse_mode="HTML"
+    )
+    try:
+        await query.message.delete()
+    except:
+        pass
+
+# تأكيد إنهاء المسابقة
+@callback_router.route("confirm_end_contest")
+async def _cb_confirm_end_contest(query, context, data):
+    user_id = query.from_user.id
+    if not is_admin(user_id):
+        await query.answer("❌ هذا الإجراء متاح للمشرفين فقط", show_alert=True)
+        return
+
+    await query.edit_message_text("🔄 جاري إنهاء المسابقة وإعلان الفائزين...")
+    success, result = await end_contest(context.application, force_manual=True)
+    if success:
+        summary = "✅ <b>تم إنهاء المسابقة بنجاح!</b>\n\n🏆 الفائزون:\n"
+        for w in result:
+            medal = "🥇" if w['rank'] == 1 else "🥈" if w['rank'] == 2 else "🥉" if w['rank'] == 3 else "🏅"
+            summary += f"{medal} {w['rank']}. {w['display_name']} ({w['points']} نقطة)\n"
+        await query.edit_message_text(summary, parse_mode="HTML")
+    else:
+        await query.edit_message_text(f"❌ فشل إنهاء المسابقة:\n{result}")
+
+# إلغاء العمليات
+@callback_router.route("cancel_end_contest", "cancel_contest")
+async def _cb_cancel_end_contest(query, context, data):
+    await query.edit_message_text("❌ تم إلغاء العملية")
+
+# بدء مسابقة سريعة - ✅ الإصلاح الرئيسي هنا
+@callback_router.prefix("quick_contest_")
+async def _cb_quick_contest(query, context, data):
+    user_id = query.from_user.id
+    if not is_admin(user_id):
+        await query.answer("❌ هذا الإجراء متاح للمشرفين فقط", show_alert=True)
+        return
+
+    parts = data.replace("quick_contest_", "").split("_")
+    minutes, winners = int(parts[0]), int(parts[1])
+
+    # ✅ استخدام الدوال الآمنة للكول باك
+    await _create_contest_db(minutes, winners)
+    contest_msg, keyboard = _get_contest_start_message(minutes, winners)
+
+    # ✅ استخدام query.message.reply_text بدلاً من update.effective_message
+    await query.message.reply_text(
+        contest_msg,
+        parse_mode="HTML",
+        reply_markup=keyboard
+    )
+
+    try:
+        await query.message.delete()
+    except:
+        pass
+
+# عرض الترتيب الكامل (للمشرفين)
+@callback_router.route("show_full_ranking")
+async def _cb_show_full_ranking(query, context, data):
+    user_id = query.from_user.id
+    if not is_admin(user_id):
+        await query.answer("❌ هذا الإجراء متاح للمشرفين فقط", show_alert=True)
+        return
+
+    text = leaderboard.render(50, "🏆 <b>الترتيب الكامل (أعلى 50):</b>\n\n", "📭 لا توجد نقاط مسجلة بعد", unit="")
+
+    await query.message.reply_text(
+        text,
+        parse_mode="HTML",
+        reply_markup=back_keyboard()
+    )
+
+# عرض الترتيب الحالي للمسابقة
+@callback_router.route("show_contest_ranking")
+async def _cb_show_contest_ranking(query, context, data):
+    text = leaderboard.render(10, "📊 <b>الترتيب الحالي للمسابقة:</b>\n\n", "📭 لا توجد نقاط بعد", unit="")
+
+    await query.message.reply_text(
+        text,
+        parse_mode="HTML",
+        reply_markup=back_keyboard()
+    )
+
+# إعدادات النقاط
+@callback_router.route("settings_points")
+async def _cb_settings_points(query, context, data):
+    user_id = query.from_user.id
+    if not is_admin(user_id):
+        await query.answer("❌ هذا الإجراء متاح للمشرفين فقط", show_alert=True)
+        return
+
+    current = get_setting("points")
+    await query.message.reply_text(
+        f"⚙️ <b>إعدادات النقاط الحالية:</b> {current}\n\n"
+        f"للتغيير، استخدم الأمر:\n<code>/setpoints &lt;القيمة&gt;</code>",
+        parse_mode="HTML"
+    )
+    try:
+        await query.message.delete()
+    except:
+        pass
+
+# إعدادات التأخير
+@callback_router.route("settings_delay")
+async def _cb_settings_delay(query, context, data):
+    user_id = query.from_user.id
+    if not is_admin(user_id):
+        await query.answer("❌ هذا الإجراء متاح للمشرفين فقط", show_alert=True)
+        return
+
+    current = get_setting("delay")
+    await query.message.reply_text(
+        f"⏱️ <b>إعدادات التأخير الحالية:</b> {current} دقيقة\n\n"
+        f"للتغيير، استخدم الأمر:\n<code>/setdelay &lt;القيمة&gt;</code>",
+        parse_mode="HTML"
+    )
+    try:
+        await query.message.delete()
+    except:
+        pass
+
+# قائمة البث
+@callback_router.route("broadcast_menu")
+async def _cb_broadcast_menu(query, context, data):
+    user_id = query.from_user.id
+    if not is_admin(user_id):
+        await query.answer("❌ هذا الإجراء متاح للمشرفين فقط", show_alert=True)
+        return
+
+    await query.message.reply_text(
+        "📢 <b>بث رسالة جماعية</b>\n\n"
+        f"لإرسال بث، استخدم الأمر:\n<code>/broadcast &lt;الرسالة&gt;</code>\n\n"
+        "مثال:\n<code>/broadcast مسابقة جديدة تبدأ بعد ساعة! 🚀</code>\n\n"
+        "🖼 لبث صورة أو رسالة منسقة: رد عليها بالأمر <code>/broadcast</code>",
+        parse_mode="HTML"
+    )
+    try:
+        await query.message.delete()
+    except:
+        pass
+
+# حالة آخر مهمة بث أو تحديث مهمة محددة (من جدول المستلمين)
+@callback_router.route("broadcast_status")
+@callback_router.prefix("broadcast_progress_")
+async def _cb_broadcast_status(query, context, data):
+    user_id = query.from_user.id
+    if not is_admin(user_id):
+        await query.answer("❌ هذا الإجراء متاح للمشرفين فقط", show_alert=True)
+        return
+
+    if data == "broadcast_status":
+        job_id = (await db.fetchone("SELECT MAX(id) FROM broadcast_jobs"))[0]
+        if not job_id:
+            await query.message.reply_text("📭 لم يتم تنفيذ أي بث بعد")
+            return
+        await query.message.reply_text(
+            await broadcast_progress_text(job_id),
+            parse_mode="HTML",
+            reply_markup=broadcast_progress_keyboard(job_id)
         )
+        return
 
-        success, failed = 0, 0
-        for i, (user_id,) in enumerate(users, 1):
-            try:
-                await context.bot.send_message(
-                    chat_id=user_id,
-                    text=f"📢 <b>إعلان:</b>\n\n{safe_message}",
-                    parse_mode="HTML"
-                )
-                success += 1
-                
-                if i % BROADCAST_LIMIT == 0:
-                    try:
-                        await status_msg.edit_text(
-                            f"📤 جاري الإرسال...\n"
-                            f"✅ ناجح: {success} | ❌ فشل: {failed} | 📊 {i}/{total}"
-                        )
-                    except:
-                        pass
-                    await asyncio.sleep(1)
-                
-            except Exception as e:
-                failed += 1
-                error_msg = str(e).lower()
-                if "bot was blocked" in error_msg or "user is deactivated" in error_msg:
-                    cursor.execute("UPDATE users SET can_receive_broadcast=0 WHERE user_id=?", (user_id,))
-                    conn.commit()
-            
-            await asyncio.sleep(0.2)
-
-        result_msg = (
-            f"✅ <b>اكتمل البث بنجاح!</b>\n\n"
-            f"📊 الإحصائيات:\n"
-            f"✅ ناجح: {success}\n"
-            f"❌ فشل: {failed}\n"
-            f"👥 المجموع: {total}"
+    job_id = int(data.replace("broadcast_progress_", ""))
+    try:
+        await query.edit_message_text(
+            await broadcast_progress_text(job_id),
+            parse_mode="HTML",
+            reply_markup=broadcast_progress_keyboard(job_id)
         )
+    except Exception:
+        pass  # لم تتغير الأرقام منذ آخر تحديث
+
+# قائمة الرسائل الفردية
+@callback_router.route("send_menu")
+async def _cb_send_menu(query, context, data):
+    user_id = query.from_user.id
+    if not is_admin(user_id):
+        await query.answer("❌ هذا الإجراء متاح للمشرفين فقط", show_alert=True)
+        return
+
+    await query.message.reply_text(
+        "✉️ <b>إرسال رسالة فردية</b>\n\n"
+        f"لإرسال رسالة، استخدم الأمر:\n<code>/send &lt;user_id&gt; &lt;الرسالة&gt;</code>\n\n"
+        "مثال:\n<code>/send 123456789 مرحباً! تم قبول إحالتك ✅</code>",
+        parse_mode="HTML"
+    )
+    try:
+        await query.message.delete()
+    except:
+        pass
+
+# قائمة النسخ الاحتياطي
+@callback_router.route("backup_menu")
+async def _cb_backup_menu(query, context, data):
+    user_id = query.from_user.id
+    if not is_admin(user_id):
+        await query.answer("❌ هذا الإجراء متاح للمشرفين فقط", show_alert=True)
+        return
+
+    await query.message.reply_text(
+        "💾 <b>النسخ الاحتياطي</b>\n\n"
+        f"لإنشاء نسخة احتياطية، استخدم الأمر:\n<code>/export</code>\n\n"
+        "سيتم إرسال ملف NDJSON مضغوط (gzip) يحتوي على جميع البيانات.\n"
+        "لملف غير مضغوط: <code>/export plain</code>",
+        parse_mode="HTML"
+    )
+    try:
+        await query.message.delete()
+    except:
+        pass
+
+# قائمة الاستيراد
+@callback_router.route("import_menu")
+async def _cb_import_menu(query, context, data):
+    user_id = query.from_user.id
+    if not is_admin(user_id):
+        await query.answer("❌ هذا الإجراء متاح للمشرفين فقط", show_alert=True)
+        return
+
+    await query.message.reply_text(
+        "🔄 <b>استيراد البيانات</b>\n\n"
+        "1. قم بتصدير ملف احتياطي سابق (باستخدام /export)\n"
+        "2. أرسل الملف هنا في المحادثة\n"
+        "3. رد على الملف بأمر:\n<code>/import</code>",
+        parse_mode="HTML"
+    )
+    try:
+        await query.message.delete()
+    except:
+        pass
+
+@callback_router.route("cancel_broadcast")
+@callback_router.prefix("cancel_broadcast|")
+async def _cb_cancel_broadcast(query, context, data):
+    if "|" in data:
+        await broadcast_drafts.discard(data.split("|", 1)[1])
+    await query.edit_message_text("❌ تم إلغاء عملية البث")
+
+@callback_router.prefix("confirm_broadcast|")
+async def _cb_confirm_broadcast(query, context, data):
+    if not is_admin(query.from_user.id):
+        await query.answer("❌ هذا الإجراء متاح للمشرفين فقط", show_alert=True)
+        return
+        
+    payload = await broadcast_drafts.take(data.split("|", 1)[1])
+    if payload is None:
+        await query.edit_message_text("❌ انتهت صلاحية مسودة البث أو أُرسلت مسبقًا - أعد استخدام /broadcast")
+        return
+
+    status_msg = await query.edit_message_text("📤 جاري تجهيز قائمة المستلمين...")
+    job_id = await create_broadcast_job(payload.pop("summary"), status_msg.chat_id, status_msg.message_id, payload)
+    await status_msg.edit_text(
+        await broadcast_progress_text(job_id),
+        parse_mode="HTML",
+        reply_markup=broadcast_progress_keyboard(job_id)
+    )
+    start_broadcast_job(context.bot, job_id)
+    logger.info(f"بدأت مهمة البث #{job_id}")
+
+# ================= UPDATE PROCESSOR =================
+def update_owner(update):
+    """مفتاح التسلسل: المستخدم صاحب التحديث، أو المحادثة إن لم يكن هناك مستخدم"""
+    if isinstance(update, Update):
+        if update.effective_user:
+            return update.effective_user.id
+        if update.effective_chat:
+            return update.effective_chat.id
+    return None
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """معالجة متوازية بحد أقصى، وتحديثات المستخدم الواحد تُعالج بترتيب وصولها واحدًا تلو الآخر"""
+
+    def __init__(self, max_concurrent_updates):
+        # سيمافور الأساس يُحجز قبل قفل المستخدم، فلو كان هو الحد لاحتلت رسائل مستخدم واحد المتتالية كل الخانات
+        # وهي تنتظر دورها؛ لذا نوسّعه بـ UPDATE_QUEUE_FACTOR ونطبّق الحد الفعلي بعد الحصول على القفل
+        super().__init__(max_concurrent_updates * UPDATE_QUEUE_FACTOR)
+        self._limit = max_concurrent_updates
+        self._running = asyncio.Semaphore(max_concurrent_updates)
+        self._locks = {}  # owner -> [lock, عدد المنتظرين]
+        self.active = 0
+        self.serialized = 0
+
+    async def do_process_update(self, update, coroutine):
+        owner = update_owner(update)
+        if owner is None:
+            async with self._running:
+                await self._run(coroutine)
+            return
+        # التسجيل قبل أي await يضمن أن يأخذ كل تحديث مكانه في طابور القفل بترتيب الوصول
+        entry = self._locks.get(owner)
+        if entry is None:
+            entry = self._locks[owner] = [asyncio.Lock(), 0]
+        elif entry[0].locked():
+            self.serialized += 1
+        entry[1] += 1
         try:
-            await status_msg.edit_text(result_msg, parse_mode="HTML")
-        except:
-            await query.message.reply_text(result_msg, parse_mode="HTML")
-        logger.info(f"اكتمل البث: ناجح {success} / فشل {failed} من أصل {total}")
+            async with entry[0], self._running:
+                await self._run(coroutine)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[owner]
+
+    async def _run(self, coroutine):
+        self.active += 1
+        UPDATES_IN_PROGRESS.set(self.active)
+        try:
+            await coroutine
+        finally:
+            self.active -= 1
+            UPDATES_IN_PROGRESS.set(self.active)
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def stats(self):
+        return {
+            "limit": self._limit,
+            "running": self.active,
+            "owners": len(self._locks),
+            "serialized": self.serialized,
+        }
 
 # ================= SHUTDOWN HANDLER =================
 async def shutdown(app):
+    """يُستدعى بعد توقف التطبيق (post_stop) وقبل إغلاق اتصال Bot API"""
     global background_task
+    logger.info("🔄 جارٍ الإغلاق الآمن...")
     try:
+        if snapshot_task and not snapshot_task.done():
+            snapshot_task.cancel()
+        if metrics_server:
+            metrics_server.close()
         if background_task and not background_task.done():
             background_task.cancel()
             try:
                 await background_task
             except asyncio.CancelledError:
                 pass
-        conn.close()
+        contest_timer.cancel()
+        # البث: إكمال الرسائل الجارية وإعادة المحجوزين للانتظار، والإلغاء فقط إن طال ذلك
+        broadcast_stop.set()
+        if broadcast_tasks:
+            _, pending = await asyncio.wait(list(broadcast_tasks.values()), timeout=BROADCAST_STOP_TIMEOUT)
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+        await broadcast_drafts.flush()
+        await db.group.flush()
+        db.close()
         logger.info("تم إغلاق البوت بشكل آمن")
     except Exception as e:
         logger.error(f"خطأ أثناء الإغلاق: {e}")
 
 # ================= MAIN (بدون Job Queue) =================
-def main():
-    global background_task
-    
-    app = ApplicationBuilder().token(TOKEN).build()
+def instrument_handlers(app):
+    """تغليف كل معالج مسجل بقياس الزمن؛ الأوامر باسمها وبقية المعالجات باسم الدالة"""
+    for handlers in app.handlers.values():
+        for handler in handlers:
+            commands = getattr(handler, "commands", None)
+            name = f"/{min(commands)}" if commands else handler.callback.__name__
+            handler.callback = timed_handler(name, handler.callback)
+
+def build_application():
+    """بناء التطبيق وتسجيل المعالجات (مشترك بين وضعي polling و webhook)"""
+    builder = (
+        ApplicationBuilder()
+        .token(TOKEN)
+        .concurrent_updates(PerUserUpdateProcessor(UPDATE_CONCURRENCY))
+        # طلب مخصص يتجاوز إعدادات المنشئ، فنمرر حجم المجمع والمهل صراحة (مهل المنشئ الافتراضية)
+        .request(InstrumentedRequest(
+            connection_pool_size=TELEGRAM_POOL_SIZE,
+            connect_timeout=5.0,
+            read_timeout=5.0,
+            write_timeout=5.0,
+            pool_timeout=1.0,
+        ))
+    )
+    if BOT_API_BASE_URL:
+        base = BOT_API_BASE_URL.rstrip("/")
+        builder = builder.base_url(f"{base}/bot").base_file_url(f"{base}/file/bot")
+    app = builder.build()
 
     # تسجيل المعالجات
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("me", me))
     app.add_handler(CommandHandler("top", top_command))
+    app.add_handler(CommandHandler("rank", rank_command))
     app.add_handler(CommandHandler("startcontest", start_contest_command))
     app.add_handler(CommandHandler("endcontest", end_contest_manual_command))
     app.add_handler(CommandHandler("setpoints", set_points_command))
@@ -1405,28 +3300,73 @@ def main():
     app.add_handler(CommandHandler("export", export_data_command))
     app.add_handler(CommandHandler("import", import_data_command))
     app.add_handler(CommandHandler("panel", admin_panel))
+    app.add_handler(CommandHandler("cachestats", cache_stats_command))
+    app.add_handler(CommandHandler("snapshot", snapshot_command))
+    app.add_handler(CommandHandler("callbackstats", callback_stats_command))
+    app.add_handler(ChatMemberHandler(channel_member_update, ChatMemberHandler.CHAT_MEMBER))
 
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_menu_buttons))
-    app.add_handler(CallbackQueryHandler(unified_callback_handler))
-    app.add_handler(CallbackQueryHandler(broadcast_callback_handler, pattern="^confirm_broadcast\|"))
+    app.add_handler(CallbackQueryHandler(callback_router.dispatch))
+    instrument_handlers(app)
 
     # تشغيل المهمة الخلفية بدون Job Queue
     async def start_background_task(application):
-        global background_task
+        global background_task, snapshot_task
+        await load_settings()
+        await load_leaderboard()
         background_task = asyncio.create_task(background_tasks(application))
         logger.info("✅ المهمة الخلفية بدأت بالعمل")
+        contest_timer.attach(application)
+        await contest_timer.rearm_from_db()
+        await resume_broadcast_jobs(application.bot)
+        if SNAPSHOT_INTERVAL_HOURS > 0:
+            snapshot_task = asyncio.create_task(snapshot_loop())
+        await start_metrics_server()
 
     app.post_init = start_background_task
+    # run_polling/run_webhook يلتقطان SIGINT/SIGTERM ويوقفان التطبيق ثم يستدعيان post_stop
+    app.post_stop = shutdown
+    return app
+
+def parse_mode(argv=None):
+    """وضع التشغيل من سطر الأوامر، وإلا من BOT_MODE"""
+    import argparse
+    parser = argparse.ArgumentParser(description="Elite Referral Bot")
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument("--webhook", dest="mode", action="store_const", const="webhook")
+    group.add_argument("--polling", dest="mode", action="store_const", const="polling")
+    return parser.parse_args(argv).mode or BOT_MODE
+
+def webhook_url():
+    """العنوان الذي يُسجَّل لدى تيليجرام؛ بدون WEBHOOK_URL لا يُقبل إلا مع خادم Bot API محلي"""
+    if WEBHOOK_URL:
+        return f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}"
+    if BOT_API_BASE_URL:
+        # خادم Bot API المحلي يصل إلى عنوان الاستماع مباشرة (PTB يبنيه من listen/port/path)
+        logger.info("ℹ️ WEBHOOK_URL غير محدد؛ سيُسجَّل عنوان الاستماع المحلي لدى BOT_API_BASE_URL")
+        return None
+    raise ValueError("❌ وضع webhook يتطلب WEBHOOK_URL (العنوان العام https الذي يصل إليه تيليجرام)")
+
+def run_webhook(app, url):
+    """استقبال التحديثات عبر خادم HTTP مدمج بدل الاستطلاع"""
+    logger.info(f"🌐 وضع webhook: {WEBHOOK_LISTEN}:{WEBHOOK_PORT}/{WEBHOOK_PATH} (max_connections={WEBHOOK_MAX_CONNECTIONS})")
+    # الطلبات التي لا تحمل الرمز السري الصحيح تُرفض بـ 403 قبل أن تصل إلى المعالجات
+    app.run_webhook(
+        listen=WEBHOOK_LISTEN,
+        port=WEBHOOK_PORT,
+        url_path=WEBHOOK_PATH,
+        webhook_url=url,
+        secret_token=WEBHOOK_SECRET,
+        max_connections=WEBHOOK_MAX_CONNECTIONS,
+        allowed_updates=Update.ALL_TYPES,
+        close_loop=False,
+    )
 
-    # معالجة الإغلاق النظيف
-    import signal
-    def graceful_shutdown(signum, frame):
-        logger.info("🔄 جارٍ الإغلاق الآمن...")
-        asyncio.create_task(shutdown(app))
-        exit(0)
-    
-    signal.signal(signal.SIGINT, graceful_shutdown)
-    signal.signal(signal.SIGTERM, graceful_shutdown)
+def main(argv=None):
+    mode = parse_mode(argv)
+    # خطأ الإعداد يظهر قبل أي اتصال بتيليجرام
+    url = webhook_url() if mode == "webhook" else None
+    app = build_application()
 
     logger.info("🚀 Elite Referral Bot يعمل الآن...")
     print("="*50)
@@ -1446,8 +3386,14 @@ def main():
         print("🤖 يوزر البوت: سيتم عرضه بعد التشغيل")
     print(f"👑 معرف المشرف: {ADMIN_ID}")
     print(f"📢 القناة: {CHANNEL_USERNAME}")
+    print(f"🔌 وضع التشغيل: {mode}")
     print("="*50)
-    app.run_polling(close_loop=False)
+    if mode == "webhook":
+        run_webhook(app, url)
+        return
+    # ALL_TYPES لاستقبال تحديثات chat_member من القناة (تتطلب أن يكون البوت مشرفًا فيها)
+    # run_polling يحذف أي webhook مسجل قبل البدء، فالتبديل بين الوضعين لا يحتاج خطوة يدوية
+    app.run_polling(close_loop=False, allowed_updates=Update.ALL_TYPES)
 
 if __name__ == "__main__":
     main()
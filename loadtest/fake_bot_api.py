@@ -0,0 +1,249 @@
+"""خادم Bot API وهمي (مكتبة قياسية فقط) لاختبار البوت تحت الحمل دون الاتصال بتيليجرام
+
+يطبّق ما يستدعيه البوت: getMe و getUpdates (استطلاع طويل) و sendMessage و copyMessage و editMessageText
+و answerCallbackQuery و getChatMember و deleteMessage، وأي طريقة أخرى تُجاب بـ true.
+يمكن حقن زمن استجابة، وردود 429 (RetryAfter)، وردود 403 "bot was blocked by the user".
+
+يُشغَّل عادة من loadtest/run.py، ويمكن تشغيله وحده:
+    python loadtest/fake_bot_api.py --port 8081 --latency-ms 30
+ثم تشغيل البوت بـ BOT_API_BASE_URL=http://127.0.0.1:8081
+"""
+import argparse
+import asyncio
+import collections
+import itertools
+import json
+import random
+import time
+import urllib.parse
+
+# حقول نصية يرسلها PTB كما هي؛ بقية الحقول مرمّزة JSON
+STRING_FIELDS = {"text", "caption", "parse_mode", "callback_query_id", "url", "secret_token"}
+SEND_METHODS = {"sendMessage", "copyMessage", "sendPhoto", "sendDocument"}
+REASONS = {200: "OK", 400: "Bad Request", 401: "Unauthorized", 403: "Forbidden", 404: "Not Found", 429: "Too Many Requests"}
+
+
+class FakeBotAPI:
+    """حالة الخادم: طابور التحديثات، الرسائل المرسلة، المستخدمون المحظورون، وعدادات الطرق"""
+
+    def __init__(self, token, channel, latency=0.0, jitter=0.0, ratelimit_ratio=0.0, retry_after=1,
+                 member_ratio=1.0, seed=None):
+        self.token = token
+        self.channel = channel
+        self.latency = latency
+        self.jitter = jitter
+        self.ratelimit_ratio = ratelimit_ratio
+        self.retry_after = retry_after
+        self.member_ratio = member_ratio
+        self.rng = random.Random(seed)
+        self.bot_user = {"id": int(token.split(":")[0]), "is_bot": True, "first_name": "LoadTest", "username": "loadtest_bot"}
+        self.blocked = set()
+        self.members = {}
+        self.calls = collections.Counter()
+        self.errors = collections.Counter()
+        self.listeners = []  # fn(method, params, status, result) عند وصول كل طلب
+        self._updates = collections.deque()
+        self._next_update_id = 1
+        self._next_message_id = 1
+        self._arrived = asyncio.Event()
+        self._server = None
+
+    # ---------- التحكم من المشغّل ----------
+    def push_update(self, update):
+        """إضافة تحديث إلى طابور getUpdates؛ يعيد update_id"""
+        update = {"update_id": self._next_update_id, **update}
+        self._next_update_id += 1
+        self._updates.append(update)
+        self._arrived.set()
+        return update["update_id"]
+
+    def block(self, user_ids):
+        """المستخدمون الذين حظروا البوت: كل إرسال إليهم يُرد بـ 403"""
+        self.blocked.update(user_ids)
+
+    def message_id(self):
+        self._next_message_id += 1
+        return self._next_message_id
+
+    # ---------- الطرق ----------
+    def _chat(self, chat_id):
+        if isinstance(chat_id, str) and chat_id.startswith("@"):
+            return {"id": -1000000000001, "type": "channel", "title": chat_id[1:], "username": chat_id[1:]}
+        return {"id": int(chat_id), "type": "private", "first_name": f"user{chat_id}"}
+
+    def _message(self, chat_id, text=None, message_id=None):
+        message = {"message_id": message_id or self.message_id(), "date": int(time.time()),
+                   "chat": self._chat(chat_id), "from": self.bot_user}
+        if text is not None:
+            message["text"] = text
+        return message
+
+    def _is_member(self, user_id):
+        if user_id not in self.members:
+            self.members[user_id] = self.rng.random() < self.member_ratio
+        return self.members[user_id]
+
+    async def _get_updates(self, params):
+        offset = int(params.get("offset") or 0)
+        limit = int(params.get("limit") or 100)
+        deadline = time.monotonic() + float(params.get("timeout") or 0)
+        while True:
+            # offset يؤكد استلام كل ما قبله فيُحذف من الطابور
+            while self._updates and self._updates[0]["update_id"] < offset:
+                self._updates.popleft()
+            if self._updates:
+                return list(itertools.islice(self._updates, limit))
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return []
+            self._arrived.clear()
+            try:
+                await asyncio.wait_for(self._arrived.wait(), remaining)
+            except asyncio.TimeoutError:
+                return []
+
+    def _error(self, method, params):
+        """الأخطاء المحقونة: 403 للمحظورين، و429 بالنسبة المحددة على طرق الإرسال"""
+        if method not in SEND_METHODS and method != "editMessageText":
+            return None
+        chat_id = params.get("chat_id")
+        if isinstance(chat_id, int) and chat_id in self.blocked:
+            return 403, {"ok": False, "error_code": 403, "description": "Forbidden: bot was blocked by the user"}
+        if method in SEND_METHODS and self.ratelimit_ratio and self.rng.random() < self.ratelimit_ratio:
+            return 429, {"ok": False, "error_code": 429,
+                         "description": f"Too Many Requests: retry after {self.retry_after}",
+                         "parameters": {"retry_after": self.retry_after}}
+        return None
+
+    def _result(self, method, params):
+        if method == "getMe":
+            return self.bot_user
+        if method in ("sendMessage", "sendPhoto", "sendDocument"):
+            return self._message(params.get("chat_id"), params.get("text") or params.get("caption"))
+        if method == "copyMessage":
+            return {"message_id": self.message_id()}
+        if method == "editMessageText":
+            if "inline_message_id" in params:
+                return True
+            return self._message(params.get("chat_id"), params.get("text"), params.get("message_id"))
+        if method == "getChatMember":
+            user_id = int(params.get("user_id"))
+            user = {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"}
+            return {"status": "member" if self._is_member(user_id) else "left", "user": user}
+        if method == "getChat":
+            return self._chat(params.get("chat_id"))
+        return True
+
+    async def call(self, method, params):
+        """تنفيذ طريقة واحدة؛ يعيد (رمز HTTP، جسم الرد)"""
+        self.calls[method] += 1
+        if method == "getUpdates":
+            return 200, {"ok": True, "result": await self._get_updates(params)}
+
+        error = self._error(method, params)
+        if error:
+            self.errors[(method, error[0])] += 1
+            status, body, result = error[0], error[1], None
+        else:
+            result = self._result(method, params)
+            status, body = 200, {"ok": True, "result": result}
+        # المستمعون يرون الطلب لحظة وصوله، أي لحظة "خروج" الرد من البوت
+        for listener in self.listeners:
+            listener(method, params, status, result)
+        delay = self.latency + (self.rng.uniform(0, self.jitter) if self.jitter else 0)
+        if delay:
+            await asyncio.sleep(delay)
+        return status, body
+
+    # ---------- HTTP ----------
+    def _parse(self, headers, body):
+        content_type = headers.get("content-type", "")
+        if content_type.startswith("application/json"):
+            return json.loads(body or b"{}")
+        if content_type.startswith("multipart/"):
+            return {}  # الملفات (sendDocument) لا تهم الاختبار
+        params = {}
+        for key, value in urllib.parse.parse_qsl(body.decode(), keep_blank_values=True):
+            if key in STRING_FIELDS:
+                params[key] = value
+                continue
+            try:
+                params[key] = json.loads(value)
+            except ValueError:
+                params[key] = value
+        return params
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                _, path, _ = line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    header = await reader.readline()
+                    if header in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = header.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+                prefix, _, method = urllib.parse.urlsplit(path).path.rpartition("/")
+                if prefix != f"/bot{self.token}":
+                    status, payload = 401, {"ok": False, "error_code": 401, "description": "Unauthorized"}
+                else:
+                    status, payload = await self.call(method, self._parse(headers, body))
+
+                data = json.dumps(payload, ensure_ascii=False).encode()
+                writer.write(
+                    f"HTTP/1.1 {status} {REASONS.get(status, 'Error')}\r\n"
+                    f"Content-Type: application/json\r\nContent-Length: {len(data)}\r\n\r\n".encode() + data
+                )
+                await writer.drain()
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError, asyncio.CancelledError):
+            # CancelledError: استطلاع طويل معلّق عند إيقاف الخادم
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, host="127.0.0.1", port=0):
+        """تشغيل الخادم؛ يعيد عنوان القاعدة الذي يُمرَّر للبوت في BOT_API_BASE_URL"""
+        self._server = await asyncio.start_server(self._handle, host, port, backlog=1024)
+        port = self._server.sockets[0].getsockname()[1]
+        return f"http://{host}:{port}"
+
+    async def stop(self):
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+
+
+async def _serve(args):
+    api = FakeBotAPI(args.token, args.channel, args.latency_ms / 1000, args.jitter_ms / 1000,
+                     args.ratelimit_ratio, args.retry_after, args.member_ratio)
+    print(f"Bot API وهمي على {await api.start(args.host, args.port)} (Ctrl+C للإيقاف)")
+    await asyncio.Event().wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="خادم Bot API وهمي")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--token", default="123456:LOADTEST")
+    parser.add_argument("--channel", default="@loadtest_channel")
+    parser.add_argument("--latency-ms", type=float, default=0)
+    parser.add_argument("--jitter-ms", type=float, default=0)
+    parser.add_argument("--ratelimit-ratio", type=float, default=0)
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--member-ratio", type=float, default=1.0)
+    try:
+        asyncio.run(_serve(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,397 @@
+"""اختبار حمل شامل: البوت الحقيقي في عملية منفصلة مقابل خادم Bot API وهمي
+
+يحاكي آلاف المستخدمين: /start مع روابط إحالة، ضغطات القائمة والأزرار، ثم دورة كاملة للمشرف
+(ضبط التأخير، بدء مسابقة، بث جماعي مع محظورين وردود 429، إنهاء المسابقة وإعلان الفائزين).
+يقيس زمن كل معالج من لحظة إتاحة التحديث في getUpdates حتى وصول أول رد مرئي من البوت،
+ويطبع الإنتاجية و p50/p99 لكل معالج.
+
+التشغيل:
+    python loadtest/run.py --users 1000 --concurrency 200 --latency-ms 30 --jitter-ms 20
+    python loadtest/run.py --users 300 --ratelimit-ratio 0.02 --blocked-ratio 0.05 --bot-env GLOBAL_RATE_LIMIT=200
+    python loadtest/run.py --users 500 --restart-during-broadcast   # استئناف البث بعد SIGTERM دون تكرار
+"""
+import argparse
+import asyncio
+import collections
+import itertools
+import json
+import os
+import random
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from fake_bot_api import FakeBotAPI  # noqa: E402
+
+BOT_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "elite_referrals.py")
+TOKEN = "123456:LOADTEST"
+CHANNEL = "@loadtest_channel"
+ADMIN_ID = 1
+USER_BASE = 10_000_000
+BROADCAST_MARKER = "loadtest-broadcast"
+RESPONSE_METHODS = {"sendMessage", "editMessageText", "copyMessage", "sendDocument", "sendPhoto"}
+
+MENU_ACTIONS = [
+    ("menu:profile", "👤 ملفي"),
+    ("menu:link", "🔗 رابط الإحالة"),
+    ("menu:top", "🏆 الترتيب"),
+    ("menu:contest", "🎯 حالة المسابقة"),
+    ("menu:help", "ℹ️ كيفية الاستخدام"),
+]
+CALLBACK_ACTIONS = [
+    ("cb:show_ranking", "show_ranking"),
+    ("cb:show_contest_status", "show_contest_status"),
+    ("cb:main_menu", "main_menu"),
+    ("cb:show_link", "show_link_{uid}"),
+]
+
+
+def any_response(method, params, status):
+    return True
+
+
+class Probe:
+    """انتظار رد البوت على تحديث واحد في محادثة معينة"""
+    __slots__ = ("label", "done", "future", "started")
+
+    def __init__(self, label, done):
+        self.label = label
+        self.done = done
+        self.future = asyncio.get_running_loop().create_future()
+        self.started = time.perf_counter()
+
+
+class Harness:
+    """يربط التحديثات المحقونة بردود البوت التي يراها الخادم الوهمي ويجمع الأزمنة"""
+
+    def __init__(self, api, timeout):
+        self.api = api
+        self.timeout = timeout
+        self.pending = collections.defaultdict(list)
+        self.samples = collections.defaultdict(list)
+        self.failures = collections.Counter()
+        self.spans = {}
+        self.broadcast = collections.Counter()
+        self.broadcast_final = {}
+        self.broadcast_delivered = collections.Counter()  # رسائل بث ناجحة لكل مستلم (أكثر من 1 = تكرار)
+        self.channel_posts = 0
+        self._ids = itertools.count(1_000_000)
+        api.listeners.append(self._on_call)
+
+    # ---------- بناء التحديثات ----------
+    def _user(self, uid):
+        return {"id": uid, "is_bot": False, "first_name": f"user{uid}", "language_code": "ar"}
+
+    def _chat(self, uid):
+        return {"id": uid, "type": "private", "first_name": f"user{uid}"}
+
+    def message(self, uid, text):
+        message = {"message_id": next(self._ids), "date": int(time.time()), "chat": self._chat(uid),
+                   "from": self._user(uid), "text": text}
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return {"message": message}
+
+    def callback(self, uid, data):
+        message = {"message_id": next(self._ids), "date": int(time.time()), "chat": self._chat(uid),
+                   "from": self.api.bot_user, "text": "…"}
+        return {"callback_query": {"id": str(next(self._ids)), "from": self._user(uid),
+                                   "chat_instance": str(uid), "data": data, "message": message}}
+
+    # ---------- الربط ----------
+    def _on_call(self, method, params, status, result):
+        if method not in RESPONSE_METHODS:
+            return
+        chat_id = params.get("chat_id")
+        text = params.get("text") or ""
+        if chat_id == CHANNEL:
+            self.channel_posts += status == 200
+            return
+        if BROADCAST_MARKER in text and chat_id != ADMIN_ID:
+            self.broadcast[status] += 1
+            if status in (200, 403):
+                self.broadcast_final[chat_id] = status
+            if status == 200:
+                self.broadcast_delivered[chat_id] += 1
+            return
+        if not isinstance(chat_id, int):
+            return
+        probes = self.pending.get(chat_id)
+        for probe in probes or ():
+            if probe.done(method, params, status):
+                probes.remove(probe)
+                probe.future.set_result((status, params, time.perf_counter()))
+                break
+
+    def expect(self, label, chat_id, done=any_response):
+        probe = Probe(label, done)
+        self.pending[chat_id].append(probe)
+        return chat_id, probe
+
+    async def wait(self, expected, timeout=None):
+        chat_id, probe = expected
+        try:
+            status, params, finished = await asyncio.wait_for(asyncio.shield(probe.future), timeout or self.timeout)
+        except asyncio.TimeoutError:
+            self.pending[chat_id].remove(probe)
+            self.failures[(probe.label, "timeout")] += 1
+            return None
+        span = self.spans.setdefault(probe.label, [probe.started, finished])
+        span[0], span[1] = min(span[0], probe.started), max(span[1], finished)
+        if status != 200:
+            self.failures[(probe.label, f"http {status}")] += 1
+            return None
+        self.samples[probe.label].append(finished - probe.started)
+        return params
+
+    async def act(self, label, chat_id, update, done=any_response, timeout=None):
+        expected = self.expect(label, chat_id, done)
+        self.api.push_update(update)
+        return await self.wait(expected, timeout)
+
+
+# ================= السيناريو =================
+async def users_phase(args, harness, rng):
+    started = []
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def simulate(i):
+        if args.arrival_rate:
+            await asyncio.sleep(i / args.arrival_rate)
+        uid = USER_BASE + i
+        async with semaphore:
+            referrer = rng.choice(started) if started and rng.random() < args.referral_ratio else None
+            text = f"/start {referrer}" if referrer else "/start"
+            if await harness.act("start+ref" if referrer else "start", uid, harness.message(uid, text)) is None:
+                return
+            started.append(uid)
+            for _ in range(args.actions):
+                if args.think_ms:
+                    await asyncio.sleep(rng.uniform(0, args.think_ms / 1000))
+                if rng.random() < 0.5:
+                    label, text = rng.choice(MENU_ACTIONS)
+                    await harness.act(label, uid, harness.message(uid, text))
+                else:
+                    label, data = rng.choice(CALLBACK_ACTIONS)
+                    await harness.act(label, uid, harness.callback(uid, data.format(uid=uid)))
+
+    await asyncio.gather(*(simulate(i) for i in range(args.users)))
+    return started
+
+
+async def broadcast_phase(args, harness, api, rng, recipients, restart=None):
+    if args.blocked_ratio:
+        api.block(rng.sample(recipients, int(len(recipients) * args.blocked_ratio)))
+    preview = await harness.act("admin:/broadcast", ADMIN_ID, harness.message(ADMIN_ID, f"/broadcast {BROADCAST_MARKER} 🚀"))
+    if preview is None:
+        return None
+    confirm = preview["reply_markup"]["inline_keyboard"][0][0]["callback_data"]
+
+    # يُسجَّل انتظار "اكتمل البث" قبل التأكيد حتى لا يفوتنا إن انتهى البث بسرعة
+    finished = harness.expect("broadcast:job", ADMIN_ID, lambda m, p, s: "اكتمل البث" in (p.get("text") or ""))
+    started = time.perf_counter()
+    await harness.act("admin:confirm_broadcast", ADMIN_ID, harness.callback(ADMIN_ID, confirm))
+    if restart:
+        # إيقاف البوت (SIGTERM) في منتصف البث ثم تشغيله: المهمة تُستأنف دون تكرار أي رسالة
+        while len(harness.broadcast_final) < len(recipients) // 2:
+            await asyncio.sleep(0.05)
+        await restart()
+    await harness.wait(finished, args.broadcast_timeout)
+    elapsed = time.perf_counter() - started
+    delivered = sum(1 for status in harness.broadcast_final.values() if status == 200)
+    return {
+        "recipients": len(recipients),
+        "delivered": delivered,
+        "blocked": sum(1 for status in harness.broadcast_final.values() if status == 403),
+        "retry_after_429": harness.broadcast[429],
+        "duplicates": sum(n - 1 for n in harness.broadcast_delivered.values()),
+        "seconds": round(elapsed, 2),
+        "messages_per_second": round(delivered / elapsed, 1) if elapsed else 0,
+    }
+
+
+async def contest_end_phase(harness):
+    await harness.act("admin:end_warning", ADMIN_ID, harness.callback(ADMIN_ID, "confirm_end_contest_warning"))
+    # الرد الأول "جاري إنهاء المسابقة..."؛ نقيس حتى ملخص الفائزين
+    await harness.act(
+        "admin:end_contest", ADMIN_ID, harness.callback(ADMIN_ID, "confirm_end_contest"),
+        done=lambda m, p, s: m == "editMessageText" and not (p.get("text") or "").startswith("🔄"),
+    )
+
+
+# ================= تشغيل البوت =================
+def start_bot(base_url, workdir, extra_env, log_name="bot.log"):
+    env = dict(os.environ)
+    env.update({
+        "TOKEN": TOKEN,
+        "ADMIN_ID": str(ADMIN_ID),
+        "CHANNEL_USERNAME": CHANNEL,
+        "BOT_API_BASE_URL": base_url,
+        "DB_PATH": os.path.join(workdir, "loadtest.db"),
+        "SNAPSHOT_DIR": os.path.join(workdir, "snapshots"),
+        "SNAPSHOT_INTERVAL_HOURS": "0",
+        "METRICS_PORT": "0",  # لا تتصادم التشغيلات المتوازية على منفذ واحد؛ يمكن تفعيله عبر --bot-env
+        "NO_PROXY": "127.0.0.1,localhost",
+    })
+    env.update(extra_env)
+    log = open(os.path.join(workdir, log_name), "wb")
+    return subprocess.Popen([sys.executable, os.path.abspath(BOT_SCRIPT), "--polling"],
+                            cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+
+async def wait_ready(api, process, timeout=30):
+    deadline = time.monotonic() + timeout
+    polls = api.calls["getUpdates"]
+    while api.calls["getUpdates"] == polls:
+        if process.poll() is not None:
+            raise SystemExit("❌ توقف البوت قبل أن يبدأ الاستطلاع - راجع bot.log")
+        if time.monotonic() > deadline:
+            raise SystemExit("❌ لم يبدأ البوت الاستطلاع خلال المهلة - راجع bot.log")
+        await asyncio.sleep(0.1)
+
+
+async def stop_bot(process, sig=signal.SIGINT):
+    if process.poll() is None:
+        process.send_signal(sig)
+        try:
+            await asyncio.to_thread(process.wait, 15)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+# ================= التقرير =================
+def percentile(values, q):
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+def build_report(harness, api, phases, broadcast):
+    handlers = {}
+    for label in sorted(set(harness.samples) | {label for label, _ in harness.failures}):
+        values = sorted(harness.samples.get(label, []))
+        errors = {reason: n for (name, reason), n in harness.failures.items() if name == label}
+        span = harness.spans.get(label)
+        seconds = span[1] - span[0] if span else 0
+        handlers[label] = {
+            "count": len(values),
+            "errors": errors,
+            "per_second": round(len(values) / seconds, 1) if seconds and len(values) > 1 else None,
+            "p50_ms": round(percentile(values, 0.50) * 1000, 1) if values else None,
+            "p99_ms": round(percentile(values, 0.99) * 1000, 1) if values else None,
+            "max_ms": round(values[-1] * 1000, 1) if values else None,
+        }
+    return {
+        "phases_seconds": {name: round(seconds, 2) for name, seconds in phases.items()},
+        "handlers": handlers,
+        "broadcast": broadcast,
+        "channel_posts": harness.channel_posts,
+        "api_calls": dict(api.calls.most_common()),
+        "api_injected_errors": {f"{method} {status}": n for (method, status), n in api.errors.items()},
+    }
+
+
+def print_report(report):
+    print()
+    print(f"{'handler':<26}{'n':>7}{'err':>6}{'req/s':>9}{'p50 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for label, row in report["handlers"].items():
+        print(f"{label:<26}{row['count']:>7}{sum(row['errors'].values()):>6}"
+              f"{row['per_second'] or '-':>9}{row['p50_ms'] or '-':>10}{row['p99_ms'] or '-':>10}{row['max_ms'] or '-':>10}")
+    print()
+    print("المراحل (ث):", report["phases_seconds"])
+    if report["broadcast"]:
+        print("البث:", report["broadcast"])
+    print("منشورات القناة:", report["channel_posts"])
+    print("استدعاءات Bot API:", report["api_calls"])
+    if report["api_injected_errors"]:
+        print("أخطاء محقونة:", report["api_injected_errors"])
+
+
+async def run(args):
+    rng = random.Random(args.seed)
+    api = FakeBotAPI(TOKEN, CHANNEL, args.latency_ms / 1000, args.jitter_ms / 1000,
+                     args.ratelimit_ratio, args.retry_after, args.member_ratio, seed=args.seed)
+    harness = Harness(api, args.timeout)
+    base_url = await api.start()
+    workdir = args.workdir or tempfile.mkdtemp(prefix="elite-loadtest-")
+    os.makedirs(workdir, exist_ok=True)
+    extra_env = dict(item.split("=", 1) for item in args.bot_env)
+    process = start_bot(base_url, workdir, extra_env)
+    print(f"🧪 Bot API وهمي على {base_url}، ملفات التشغيل في {workdir}")
+
+    async def restart():
+        nonlocal process
+        await stop_bot(process, signal.SIGTERM)
+        print(f"🔁 أُعيد تشغيل البوت أثناء البث (رمز الخروج {process.returncode})")
+        process = start_bot(base_url, workdir, extra_env, "bot-restart.log")
+        await wait_ready(api, process)
+
+    phases = {}
+    broadcast = None
+    try:
+        await wait_ready(api, process)
+        clock = time.perf_counter()
+        await harness.act("admin:/setdelay", ADMIN_ID, harness.message(ADMIN_ID, f"/setdelay {args.delay_minutes}"))
+        await harness.act("admin:/startcontest", ADMIN_ID,
+                          harness.message(ADMIN_ID, f"/startcontest {args.contest_minutes} {args.winners}"))
+        phases["setup"] = time.perf_counter() - clock
+
+        clock = time.perf_counter()
+        recipients = await users_phase(args, harness, rng)
+        phases["users"] = time.perf_counter() - clock
+        print(f"👥 {len(recipients)} مستخدم أنهوا /start في {phases['users']:.1f} ث")
+
+        if not args.skip_broadcast:
+            clock = time.perf_counter()
+            broadcast = await broadcast_phase(args, harness, api, rng, recipients,
+                                              restart if args.restart_during_broadcast else None)
+            phases["broadcast"] = time.perf_counter() - clock
+
+        clock = time.perf_counter()
+        await contest_end_phase(harness)
+        phases["contest_end"] = time.perf_counter() - clock
+    finally:
+        await stop_bot(process)
+        await api.stop()
+
+    report = build_report(harness, api, phases, broadcast)
+    print_report(report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    return 0 if not harness.failures or args.allow_errors else 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description="اختبار حمل البوت مقابل Bot API وهمي")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=200, help="مستخدمون نشطون في الوقت نفسه")
+    parser.add_argument("--arrival-rate", type=float, default=0, help="مستخدمون جدد في الثانية (0 = دفعة واحدة)")
+    parser.add_argument("--actions", type=int, default=4, help="ضغطات قائمة/أزرار لكل مستخدم بعد /start")
+    parser.add_argument("--think-ms", type=float, default=50)
+    parser.add_argument("--referral-ratio", type=float, default=0.7)
+    parser.add_argument("--member-ratio", type=float, default=0.9, help="نسبة المشتركين في القناة")
+    parser.add_argument("--latency-ms", type=float, default=0, help="زمن استجابة Bot API المحقون")
+    parser.add_argument("--jitter-ms", type=float, default=0)
+    parser.add_argument("--ratelimit-ratio", type=float, default=0, help="نسبة ردود 429 على طرق الإرسال")
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--blocked-ratio", type=float, default=0.05, help="نسبة من حظروا البوت قبل البث")
+    parser.add_argument("--delay-minutes", type=int, default=1)
+    parser.add_argument("--contest-minutes", type=int, default=60, help="يجب أن تتجاوز مدة الاختبار؛ المسابقة تُنهى يدويًا")
+    parser.add_argument("--winners", type=int, default=3)
+    parser.add_argument("--skip-broadcast", action="store_true")
+    parser.add_argument("--broadcast-timeout", type=float, default=900)
+    parser.add_argument("--restart-during-broadcast", action="store_true",
+                        help="إيقاف البوت بـ SIGTERM في منتصف البث ثم تشغيله للتحقق من الاستئناف دون تكرار")
+    parser.add_argument("--timeout", type=float, default=30, help="أقصى انتظار لرد على تحديث واحد")
+    parser.add_argument("--bot-env", action="append", default=[], metavar="KEY=VALUE", help="متغيرات بيئة إضافية للبوت")
+    parser.add_argument("--workdir")
+    parser.add_argument("--json", help="حفظ التقرير بصيغة JSON")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--allow-errors", action="store_true", help="رمز خروج 0 حتى مع أخطاء/مهل")
+    sys.exit(asyncio.run(run(parser.parse_args())))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,10 @@
+"""تهيئة مشتركة للاختبارات: البوت يقرأ إعداداته ويفتح قاعدة البيانات عند الاستيراد"""
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+os.environ.setdefault("TOKEN", "0:test")
+os.environ.setdefault("ADMIN_ID", "1")
+os.environ.setdefault("CHANNEL_USERNAME", "@test")
+os.environ.setdefault("DB_PATH", os.path.join(tempfile.mkdtemp(prefix="elite-tests-"), "test.db"))
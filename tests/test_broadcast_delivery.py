@@ -0,0 +1,76 @@
+"""محرك البث لا يعيد إرسال رسالة ربما وصلت إلى تيليجرام"""
+import asyncio
+
+import httpx
+from telegram.error import NetworkError, TimedOut
+
+import elite_referrals as er
+
+
+def failing_send(ptb_error, cause):
+    """send يفشل دائمًا بخطأ PTB سببه خطأ httpx (كما يرفعه HTTPXRequest) ويسجل المحاولات"""
+    attempts = []
+
+    async def send(chat_id):
+        attempts.append(chat_id)
+        raise ptb_error from cause
+
+    return send, attempts
+
+
+def deliver(send):
+    engine = er.BroadcastEngine(er.TelegramRateLimiter(1000, 1000), workers=1, max_retries=1)
+    return asyncio.run(engine._deliver(send, 42))
+
+
+def test_read_timeout_is_not_resent():
+    send, attempts = failing_send(TimedOut(), httpx.ReadTimeout("read"))
+    assert deliver(send) == "unknown"
+    assert attempts == [42]
+
+
+def test_connection_reset_is_not_resent():
+    send, attempts = failing_send(NetworkError("httpx.ReadError"), httpx.ReadError("reset"))
+    assert deliver(send) == "unknown"
+    assert attempts == [42]
+
+
+def test_connect_error_is_retried():
+    send, attempts = failing_send(NetworkError("httpx.ConnectError"), httpx.ConnectError("refused"))
+    assert deliver(send) == "failed"
+    assert attempts == [42, 42]
+
+
+def test_slow_recipient_does_not_stall_the_next_batch():
+    batches = [[batch * 4 + i for i in range(4)] for batch in range(5)]
+    slow = {batch[0] for batch in batches}
+
+    async def refill():
+        return batches.pop(0) if batches else []
+
+    async def send(chat_id):
+        await asyncio.sleep(0.3 if chat_id in slow else 0.01)
+
+    engine = er.BroadcastEngine(er.TelegramRateLimiter(1000, 1000), workers=4)
+    stats = asyncio.run(engine.run([], send, refill=refill))
+
+    assert stats["sent"] == stats["total"] == 20
+    # حاجز لكل دفعة يعني 5 × 0.3 ث على الأقل
+    assert stats["elapsed"] < 1.0
+
+
+def test_stop_finishes_in_flight_and_returns_unstarted():
+    stop = asyncio.Event()
+    sent = []
+
+    async def send(chat_id):
+        await asyncio.sleep(0.05)
+        sent.append(chat_id)
+        stop.set()  # الإغلاق يبدأ بينما بقية العمال في منتصف إرسالهم
+
+    engine = er.BroadcastEngine(er.TelegramRateLimiter(1000, 1000), workers=2)
+    stats = asyncio.run(engine.run(list(range(10)), send, stop=stop))
+
+    assert sorted(sent) == [0, 1]
+    assert stats["sent"] == 2
+    assert stats["unstarted"] == list(range(2, 10))
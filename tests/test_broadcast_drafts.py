@@ -0,0 +1,27 @@
+"""مسودات البث في الذاكرة تُنقل إلى القاعدة عند الإغلاق فيبقى زر التأكيد صالحًا بعد إعادة التشغيل"""
+import asyncio
+from types import SimpleNamespace
+
+import elite_referrals as er
+
+
+def test_draft_survives_shutdown(monkeypatch):
+    payload = {"kind": "text", "text": "إعلان مهم 📢"}
+
+    async def before_restart():
+        # اتصال مستقل بنفس الملف: الإغلاق يغلقه دون أن يمس قاعدة الاختبارات المشتركة
+        monkeypatch.setattr(er, "db", er.Database(er.DB_PATH))
+        monkeypatch.setattr(er, "broadcast_stop", asyncio.Event())
+        draft_id = await er.broadcast_drafts.put(payload)
+        await er.shutdown(SimpleNamespace())
+        return draft_id
+
+    async def after_restart(draft_id):
+        monkeypatch.setattr(er, "db", er.Database(er.DB_PATH))
+        try:
+            return await er.DraftStore().take(draft_id)
+        finally:
+            er.db.close()
+
+    draft_id = asyncio.run(before_restart())
+    assert asyncio.run(after_restart(draft_id)) == payload
@@ -0,0 +1,76 @@
+"""النسخ التفاضلية لا تُطبَّق إلا فوق النسخة التي بُنيت عليها أو ما بعدها وقبل نهايتها"""
+import sqlite3
+
+import pytest
+
+import elite_referrals as er
+
+
+def empty_database(path):
+    """نسخة من مخطط قاعدة الاختبار بلا بيانات"""
+    connection = sqlite3.connect(path, isolation_level=None)
+    er.db.writer.backup(connection)
+    for table in ("users", "referrals", "contest_scores", "contest"):
+        connection.execute(f"DELETE FROM {table}")
+    return connection
+
+
+def rename(connection, name):
+    connection.execute("UPDATE users SET first_name=? WHERE user_id=1", (name,))
+
+
+@pytest.fixture
+def chain(tmp_path):
+    """نسخة كاملة ثم تفاضليتان متتاليتان لمستخدم تغيّر اسمه مرتين"""
+    source = empty_database(str(tmp_path / "source.db"))
+    source.execute("INSERT INTO users (user_id, first_name) VALUES (1, 'أول')")
+    paths = {}
+
+    def export(name, since=None):
+        paths[name] = str(tmp_path / f"{name}.ndjson")
+        _, seq = er._stream_export(source, paths[name], False, since)
+        return seq
+
+    full_seq = export("full")
+    rename(source, "ثانٍ")
+    first_seq = export("delta1", full_seq)
+    rename(source, "ثالث")
+    export("delta2", first_seq)
+    source.close()
+    return paths, empty_database(str(tmp_path / "target.db"))
+
+
+def load(connection, path):
+    connection.execute("BEGIN")
+    er._stream_import(connection, path)
+    connection.execute("COMMIT")
+
+
+def name(connection):
+    return connection.execute("SELECT first_name FROM users WHERE user_id=1").fetchone()[0]
+
+
+def test_delta_chain_applies_in_order(chain):
+    paths, target = chain
+    for step in ("full", "delta1", "delta2"):
+        load(target, paths[step])
+    assert name(target) == "ثالث"
+
+
+def test_old_delta_does_not_roll_back(chain):
+    paths, target = chain
+    for step in ("full", "delta1", "delta2"):
+        load(target, paths[step])
+    with pytest.raises(ValueError, match="أقدم أو مطبقة مسبقًا"):
+        load(target, paths["delta1"])
+    target.execute("ROLLBACK")
+    assert name(target) == "ثالث"
+
+
+def test_delta_with_gap_is_rejected(chain):
+    paths, target = chain
+    load(target, paths["full"])
+    with pytest.raises(ValueError, match="استورد النسخ السابقة"):
+        load(target, paths["delta2"])
+    target.execute("ROLLBACK")
+    assert name(target) == "أول"
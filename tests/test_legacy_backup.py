@@ -0,0 +1,78 @@
+"""قارئ نسخ JSON القديمة (2.x) التدريجي يعطي نفس السجلات التي يعطيها json.load مهما صغرت القطع"""
+import io
+import json
+
+import pytest
+
+import elite_referrals as er
+
+
+def legacy_backup():
+    users = [
+        {"user_id": 1000 + i, "username": f"مستخدم_{i}" if i % 3 else None,
+         "first_name": f"محمد \"النجم\" {i} 🌟", "points": i * 7, "last_seen": "2024-05-01T10:00:00+00:00"}
+        for i in range(300)
+    ]
+    referrals = [
+        {"new_user": 1000 + i, "referrer": 1000 + i // 4, "joined_at": "2024-05-01T10:00:00Z", "counted": i % 2}
+        for i in range(1, 300)
+    ]
+    return {
+        # بنية تصدير 2.x: metadata كائن وبقية الأقسام قوائم صفوف (contest فارغة حين لا توجد مسابقة)
+        "metadata": {"exported_at": "2024-05-02T00:00:00+00:00", "version": "2.1", "channel": "@قناة"},
+        "users": users,
+        "referrals": referrals,
+        "settings": [{"key": "points", "value": 10}, {"key": "delay", "value": 5}],
+        "contest": [],
+    }
+
+
+def expected_records(data):
+    records = []
+    for section, value in data.items():
+        if isinstance(value, list):
+            records.extend((section, item) for item in value)
+        else:
+            records.append((section, value))
+    return records
+
+
+class TrickleRaw(io.RawIOBase):
+    """مصدر بايتات يعيد 3 بايتات على الأكثر في كل قراءة فتنقسم الحروف العربية بين القراءات"""
+
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        piece = self.data[self.pos:self.pos + min(3, len(buffer))]
+        buffer[:len(piece)] = piece
+        self.pos += len(piece)
+        return len(piece)
+
+
+def open_text(payload):
+    return io.TextIOWrapper(io.BufferedReader(TrickleRaw(payload.encode("utf-8")), buffer_size=8), encoding="utf-8")
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 4096])
+@pytest.mark.parametrize("indent", [None, 2])
+def test_matches_json_load(chunk_size, indent):
+    payload = json.dumps(legacy_backup(), ensure_ascii=False, indent=indent)
+    reader = er.LegacyBackupReader(open_text(payload), chunk_size=chunk_size)
+
+    assert list(reader) == expected_records(json.loads(payload))
+    assert reader.sections == set(legacy_backup())
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 4096])
+@pytest.mark.parametrize("fraction", [0.1, 0.5, 0.99])
+def test_truncated_file_is_rejected(chunk_size, fraction):
+    payload = json.dumps(legacy_backup(), ensure_ascii=False)
+    truncated = payload[:int(len(payload) * fraction)]
+
+    with pytest.raises(ValueError):
+        list(er.LegacyBackupReader(open_text(truncated), chunk_size=chunk_size))
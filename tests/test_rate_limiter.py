@@ -0,0 +1,40 @@
+"""موجة 429 واحدة تخفض المعدل مرة واحدة مهما كان عدد العمال الذين أصابتهم"""
+import asyncio
+
+from telegram.error import RetryAfter
+
+import elite_referrals as er
+
+
+def test_repeated_flood_during_pause_halves_once():
+    limiter = er.TelegramRateLimiter(100, 100)
+    for _ in range(6):
+        limiter.on_flood(1)
+    assert limiter.global_bucket.rate == 50
+
+
+def test_flood_after_pause_halves_again():
+    limiter = er.TelegramRateLimiter(100, 100)
+    limiter.on_flood(0.01)
+    asyncio.run(asyncio.sleep(0.02))
+    limiter.on_flood(0.01)
+    assert limiter.global_bucket.rate == 25
+
+
+def test_concurrent_retry_after_halves_once():
+    limiter = er.TelegramRateLimiter(100, 100)
+    engine = er.BroadcastEngine(limiter, workers=8)
+    flooded = set()
+
+    async def send(chat_id):
+        await asyncio.sleep(0.01)  # كل العمال في منتصف الطلب لحظة الموجة
+        if chat_id not in flooded:
+            flooded.add(chat_id)
+            raise RetryAfter(1)
+
+    stats = asyncio.run(engine.run(list(range(8)), send))
+
+    assert stats["sent"] == 8
+    assert len(flooded) == 8
+    # تخفيض واحد (100 -> 50) ثم زيادة جمعية صغيرة مع كل نجاح
+    assert 50 <= limiter.global_bucket.rate <= 50 + 0.05 * 8
@@ -0,0 +1,80 @@
+"""الإحالات المسحوبة من كومة المواعيد لا تضيع إذا فشلت دورة الاحتساب"""
+import asyncio
+from types import SimpleNamespace
+
+import elite_referrals as er
+
+REFERRER, NEW_USER = 1001, 1002
+JOINED_LONG_AGO = "2020-01-01T00:00:00+00:00"
+
+
+class FakeBot:
+    def __init__(self):
+        self.sent = []
+
+    async def get_chat_member(self, chat_id, user_id):
+        return SimpleNamespace(status="member")
+
+    async def send_message(self, chat_id, text=None, **kwargs):
+        self.sent.append((chat_id, text))
+
+
+async def counted(new_user):
+    row = await er.db.fetchone("SELECT counted FROM referrals WHERE new_user=?", (new_user,))
+    return row[0]
+
+
+async def run_sweep_until_credited(monkeypatch):
+    await er.load_settings()
+    await er.db.execute(
+        "INSERT OR REPLACE INTO users (user_id, username, first_name) VALUES (?, 'ref', 'Ref'), (?, 'new', 'New')",
+        (REFERRER, NEW_USER)
+    )
+    await er.db.execute(
+        "INSERT OR REPLACE INTO referrals (new_user, referrer, joined_at, counted) VALUES (?, ?, ?, 0)",
+        (NEW_USER, REFERRER, JOINED_LONG_AGO)
+    )
+
+    real_check_members = er.check_members
+    calls = []
+
+    async def flaky_check_members(bot, user_ids):
+        calls.append(list(user_ids))
+        if len(calls) == 1:
+            raise RuntimeError("telegram unavailable")
+        return await real_check_members(bot, user_ids)
+
+    monkeypatch.setattr(er, "check_members", flaky_check_members)
+    monkeypatch.setattr(er, "REFERRAL_RECHECK_INTERVAL", 0)
+    monkeypatch.setattr(er.scheduler, "batch_window", 0)
+
+    bot = FakeBot()
+    task = asyncio.create_task(er.background_tasks(SimpleNamespace(bot=bot)))
+    try:
+        for _ in range(200):
+            if await counted(NEW_USER):
+                break
+            await asyncio.sleep(0.05)
+    finally:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+    return calls, bot, await counted(NEW_USER)
+
+
+def sweeps_observed():
+    return sum(count for _, _, count in er.SWEEP_SECONDS._values.values())
+
+
+def test_failed_sweep_is_retried(monkeypatch):
+    errors_before = er.SWEEP_ERRORS._values.get((), 0)
+    sweeps_before = sweeps_observed()
+
+    calls, bot, is_counted = asyncio.run(run_sweep_until_credited(monkeypatch))
+
+    assert calls[0] == [NEW_USER]
+    assert len(calls) >= 2, "الإحالة لم تُعد إلى الكومة بعد فشل التحقق"
+    assert is_counted == 1
+    assert [chat_id for chat_id, _ in bot.sent] == [REFERRER]
+    # الدورة الفاشلة تُقاس وتُعد مثل الناجحة
+    assert er.SWEEP_ERRORS._values.get((), 0) == errors_before + 1
+    assert sweeps_observed() - sweeps_before >= len(calls)
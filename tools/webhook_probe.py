@@ -0,0 +1,99 @@
+"""عميل HTTP محلي يحلّ محل تيليجرام: يرسل تحديثات مصطنعة إلى نقطة الـ webhook ويقيس زمن الاستجابة
+
+التشغيل (بعد تشغيل البوت بـ --webhook وبنفس WEBHOOK_SECRET):
+    python tools/webhook_probe.py --url http://127.0.0.1:8443/telegram --secret "$WEBHOOK_SECRET" -n 200 -c 20
+
+يتحقق أولًا من رفض الطلبات ذات الرمز السري الخاطئ (403)، ثم يرسل -n تحديثًا بتوازي -c.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import statistics
+import sys
+import time
+import urllib.error
+import urllib.request
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+_update_ids = itertools.count(int(time.time()))
+
+
+def fake_update(user_id, text="/start"):
+    """تحديث رسالة خاصة بالشكل الذي يرسله تيليجرام"""
+    user = {"id": user_id, "is_bot": False, "first_name": f"probe{user_id}"}
+    return {
+        "update_id": next(_update_ids),
+        "message": {
+            "message_id": 1,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private", "first_name": user["first_name"]},
+            "from": user,
+            "text": text,
+            "entities": [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}] if text.startswith("/") else [],
+        },
+    }
+
+
+def post(url, secret, payload, timeout):
+    """إرسال تحديث واحد وإرجاع (رمز الحالة، الزمن بالثواني)"""
+    request = urllib.request.Request(
+        url,
+        data=json.dumps(payload).encode(),
+        headers={"Content-Type": "application/json", **({SECRET_HEADER: secret} if secret is not None else {})},
+        method="POST",
+    )
+    started = time.perf_counter()
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            status = response.status
+    except urllib.error.HTTPError as e:
+        status = e.code
+    except (urllib.error.URLError, OSError):
+        status = 0
+    return status, time.perf_counter() - started
+
+
+async def probe(args):
+    status, _ = await asyncio.to_thread(post, args.url, args.secret + "x", fake_update(args.base_user), args.timeout)
+    print(f"رمز سري خاطئ -> {status} ({'✅' if status == 403 else '❌ المتوقع 403'})")
+    status, _ = await asyncio.to_thread(post, args.url, None, fake_update(args.base_user), args.timeout)
+    print(f"بدون رمز سري -> {status} ({'✅' if status == 403 else '❌ المتوقع 403'})")
+
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def one(i):
+        async with semaphore:
+            text = args.text.format(i=i)
+            return await asyncio.to_thread(post, args.url, args.secret, fake_update(args.base_user + i, text), args.timeout)
+
+    started = time.perf_counter()
+    results = await asyncio.gather(*(one(i) for i in range(args.count)))
+    elapsed = time.perf_counter() - started
+
+    codes = {}
+    for status, _ in results:
+        codes[status] = codes.get(status, 0) + 1
+    latencies = sorted(latency * 1000 for status, latency in results if status == 200)
+    print(f"أُرسل {args.count} تحديثًا في {elapsed:.2f} ث ({args.count / elapsed:.0f} تحديث/ث)، الحالات: {codes}")
+    if latencies:
+        p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+        print(f"الزمن: p50={statistics.median(latencies):.1f} ms  p95={p95:.1f} ms  max={latencies[-1]:.1f} ms")
+    return 0 if codes.get(200) == args.count else 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", default=f"http://127.0.0.1:{os.getenv('WEBHOOK_PORT', 8443)}/{os.getenv('WEBHOOK_PATH', 'telegram').strip('/')}")
+    parser.add_argument("--secret", default=os.getenv("WEBHOOK_SECRET", ""))
+    parser.add_argument("-n", "--count", type=int, default=100)
+    parser.add_argument("-c", "--concurrency", type=int, default=10)
+    parser.add_argument("--base-user", type=int, default=900000000)
+    parser.add_argument("--text", default="/start", help="نص الرسالة؛ {i} يُستبدل برقم التحديث")
+    parser.add_argument("--timeout", type=float, default=10)
+    sys.exit(asyncio.run(probe(parser.parse_args())))
+
+
+if __name__ == "__main__":
+    main()